@@ -6,13 +6,29 @@ import pandas as pd
 import matplotlib.pyplot as plt
 import numpy as np
 import os
-from config import OUTPUT_DIR, NOT_ENOUGH_BIRTHS_MARKER, COLUMN_NAMES, DEFAULT_YEAR
+from typing import Optional
+from config import (
+    OUTPUT_DIR, NOT_ENOUGH_BIRTHS_MARKER, COLUMN_NAMES, DEFAULT_YEAR, CONFIDENCE_LEVEL, FUNNEL_LEVELS, KNN_NEIGHBORS,
+    NEIGHBOR_OUTLIERS
+)
+from rate_statistics import (
+    add_rate_statistics, funnel_limits, WILSON_LOW, WILSON_HIGH, BOOTSTRAP_LOW, BOOTSTRAP_HIGH, FUNNEL_POSITION
+)
+from rankings import add_rankings, STATE, NATIONAL_PERCENTILE, NEIGHBOR_MEAN
 from matplotlib.colors import LinearSegmentedColormap
+from file_utils import atomic_open
+
+def read_statistics_csv(year: int, chunksize: Optional[int] = None) -> pd.DataFrame:
+    """Read the hospital_statistics.csv of a year, keeping identifiers and postal codes as strings
+    and coordinates exactly as written. With chunksize, returns an iterator over frames of that many rows."""
+    filepath = os.path.join(OUTPUT_DIR, str(year), f"hospital_statistics.csv")
+    return pd.read_csv(filepath, index_col=0, float_precision="round_trip", chunksize=chunksize, dtype={
+        COLUMN_NAMES["postal_code"]: str, COLUMN_NAMES["ik"]: str, COLUMN_NAMES["location_number"]: str
+    })
 
 def load_data(year: int) -> pd.DataFrame:
     """Load and clean the processed hospital data."""
-    filepath = os.path.join(OUTPUT_DIR, str(year), f"hospital_statistics.csv")
-    df = pd.read_csv(filepath, index_col=0)
+    df = read_statistics_csv(year)
     
     # Clean and convert data types
     births_col = f"{COLUMN_NAMES['total_births']} {year}"
@@ -91,7 +107,8 @@ def create_visualizations(df: pd.DataFrame, year: int):
     plt.grid(True, alpha=0.3)
     
     plt.tight_layout()
-    plt.savefig(os.path.join(output_dir, f'csection_rate_distribution.png'), dpi=300, bbox_inches='tight')
+    with atomic_open(os.path.join(output_dir, f'csection_rate_distribution.png'), 'wb') as f:
+        plt.savefig(f, format='png', dpi=300, bbox_inches='tight')
     plt.close()
     
     # 3. Hospital size vs C-section rate
@@ -109,15 +126,76 @@ def create_visualizations(df: pd.DataFrame, year: int):
              label=f'Trend: slope={z[0]:.3f}')
     plt.legend()
     plt.grid(True, alpha=0.3)
-    plt.savefig(os.path.join(output_dir, f'size_vs_rate.png'), dpi=300, bbox_inches='tight')
+    with atomic_open(os.path.join(output_dir, f'size_vs_rate.png'), 'wb') as f:
+        plt.savefig(f, format='png', dpi=300, bbox_inches='tight')
+    plt.close()
+
+    # 4. Funnel plot against the national rate
+    csections_col = f"{COLUMN_NAMES['csections']} {year}"
+    overall_rate = df[csections_col].sum() / df[births_col].sum()
+    sizes = np.linspace(max(df[births_col].min(), 1), df[births_col].max(), 500)
+    limits = funnel_limits(sizes, overall_rate)
+    plt.figure(figsize=(10, 6))
+    plt.scatter(df[births_col], df['csection_rate_numeric'] * 100, alpha=0.6, s=50)
+    plt.axhline(overall_rate * 100, color='black', label=f'National rate: {overall_rate:.1%}')
+    for level, (lower, upper), style in zip(FUNNEL_LEVELS, limits, ['--', ':']):
+        plt.plot(sizes, lower * 100, color='red', linestyle=style, label=f'{level:.1%} control limits')
+        plt.plot(sizes, upper * 100, color='red', linestyle=style)
+    plt.xlabel('Total Births')
+    plt.ylabel('C-section Rate (%)')
+    plt.title(f'Funnel Plot of C-section Rates ({year})')
+    plt.legend()
+    plt.grid(True, alpha=0.3)
+    with atomic_open(os.path.join(output_dir, f'funnel_plot.png'), 'wb') as f:
+        plt.savefig(f, format='png', dpi=300, bbox_inches='tight')
     plt.close()
     return output_dir
 
+def format_outlier_table(df: pd.DataFrame, year: int) -> str:
+    """Markdown table of the hospitals outside the widest funnel-plot control limits."""
+    births_col = f"{COLUMN_NAMES['total_births']} {year}"
+    outliers = df[df[FUNNEL_POSITION].abs() == len(FUNNEL_LEVELS)].sort_values('csection_rate_numeric', ascending=False)
+    if outliers.empty:
+        return "No hospital lies outside these limits."
+    lines = [f"| Hospital | Births | Rate | {CONFIDENCE_LEVEL:.0%} Wilson CI | {CONFIDENCE_LEVEL:.0%} Bootstrap CI |",
+             "|---|---:|---:|---|---|"]
+    for _, row in outliers.iterrows():
+        lines.append(f"| {row[COLUMN_NAMES['hospital_name']]}, {row[COLUMN_NAMES['city']]} | {row[births_col]:,.0f} "
+                     f"| {row['csection_rate_numeric']:.0%} | {row[WILSON_LOW]:.1%} - {row[WILSON_HIGH]:.1%} "
+                     f"| {row[BOOTSTRAP_LOW]:.1%} - {row[BOOTSTRAP_HIGH]:.1%} |")
+    return "\n".join(lines)
+
+def format_regional_comparison(df: pd.DataFrame, year: int) -> str:
+    """Markdown tables of the rates per state and of the hospitals differing most from their nearest wards,
+    read from the ranking columns."""
+    births_col = f"{COLUMN_NAMES['total_births']} {year}"
+    csections_col = f"{COLUMN_NAMES['csections']} {year}"
+    states = df.groupby(STATE).agg(hospitals=(births_col, 'size'), births=(births_col, 'sum'),
+                                   csections=(csections_col, 'sum'), median=('csection_rate_numeric', 'median'))
+    states['rate'] = states['csections'] / states['births']
+    lines = ["| State | Hospitals | Births | Rate | Median Hospital Rate |", "|---|---:|---:|---:|---:|"]
+    for state, row in states.sort_values('rate', ascending=False).iterrows():
+        lines.append(f"| {state} | {row['hospitals']:.0f} | {row['births']:,.0f} | {row['rate']:.1%} | {row['median']:.1%} |")
+
+    differences = (df['csection_rate_numeric'] * 100 - df[NEIGHBOR_MEAN]).dropna()
+    largest = differences.abs().sort_values(ascending=False, kind='stable').index[:NEIGHBOR_OUTLIERS]
+    lines += ["", "### Largest Differences to the Nearest Maternity Wards", "",
+              "| Hospital | Rate | Mean of Nearest Wards | National Percentile |", "|---|---:|---:|---:|"]
+    for index in largest:
+        row = df.loc[index]
+        lines.append(f"| {row[COLUMN_NAMES['hospital_name']]}, {row[COLUMN_NAMES['city']]} "
+                     f"| {row['csection_rate_numeric']:.0%} | {row[NEIGHBOR_MEAN]:.0f}% | {row[NATIONAL_PERCENTILE]} |")
+    return "\n".join(lines)
+
 def generate_analysis_report(df: pd.DataFrame, year: int):
     output_file = os.path.join(OUTPUT_DIR, str(year), f"analysis_report.md")
 
+    df = add_rankings(df, year)
     stats = generate_summary_statistics(df, year)
-    
+    df_stats = add_rate_statistics(df, year, bootstrap=True)
+    positions = df_stats[FUNNEL_POSITION]
+    outer_level = FUNNEL_LEVELS[-1]
+
     report = f"""# C-Section Rate Analysis Report - {year}
 
 ## Executive Summary
@@ -131,6 +209,25 @@ covering **{stats['total_births']:,} total births** and **{stats['total_csection
 - **Median Hospital Rate**: {stats['median_rate']:.1%}
 - **Range**: {stats['min_rate']:.0%} - {stats['max_rate']:.0%}
 
+## Statistical Uncertainty
+
+Small hospitals report noisy rates, so every rate comes with a {CONFIDENCE_LEVEL:.0%} Wilson interval and a
+{CONFIDENCE_LEVEL:.0%} bootstrap interval, and is compared to the national rate with funnel-plot control limits.
+- **Median Wilson Interval Width**: {(df_stats[WILSON_HIGH] - df_stats[WILSON_LOW]).median():.1%}
+- **Median Bootstrap Interval Width**: {(df_stats[BOOTSTRAP_HIGH] - df_stats[BOOTSTRAP_LOW]).median():.1%}
+- **Above the {FUNNEL_LEVELS[0]:.0%} Control Limit**: {(positions >= 1).sum()} hospitals ({(positions >= 2).sum()} also above {outer_level:.1%})
+- **Below the {FUNNEL_LEVELS[0]:.0%} Control Limit**: {(positions <= -1).sum()} hospitals ({(positions <= -2).sum()} also below {outer_level:.1%})
+
+### Hospitals Outside the {outer_level:.1%} Control Limits
+
+{format_outlier_table(df_stats, year)}
+
+## Regional Comparison
+
+Rates per state, and hospitals compared to the mean rate of their {KNN_NEIGHBORS} nearest maternity wards.
+
+{format_regional_comparison(df, year)}
+
 ## Recommendations
 
 1. **Regional Analysis**: Investigate state-level variations for policy implications  
@@ -140,7 +237,7 @@ covering **{stats['total_births']:,} total births** and **{stats['total_csection
 *Report generated automatically from hospital quality data*
 """
     
-    with open(output_file, 'w', encoding='utf-8') as f:
+    with atomic_open(output_file, 'w', encoding='utf-8') as f:
         f.write(report)
     
     return output_file
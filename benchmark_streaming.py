@@ -0,0 +1,107 @@
+"""
+benchmark_streaming.py
+Peak memory of the streaming mode for growing numbers of synthetic hospital sites.
+The sites are written to a temporary directory and geocoded through the real geocoding stage and
+CoordinatesCache, with a cache file in that directory; only the Nominatim request is replaced by fixed
+coordinates, so no network access is needed. The run fails if the peak memory of the streaming mode grows
+by more than STREAM_MEMORY_GROWTH from the smallest to the largest size. Memory is traced with tracemalloc,
+which does not see the page caches of the SQLite databases; these are bounded by SQLite's cache size.
+With --batch, the regular processing is measured for comparison.
+"""
+import os
+import time
+import random
+import shutil
+import argparse
+import tempfile
+import tracemalloc
+from contextlib import redirect_stdout
+from typing import List, Optional, Tuple
+import streaming
+import process_hospital_data
+import get_gps_coordinates
+from config import STREAM_MEMORY_GROWTH
+
+YEAR = 2023
+CITIES = ["Berlin", "Hamburg", "München", "Köln", "Leipzig", "Flensburg", "Erbach", "Kiel"]
+
+
+def write_synthetic_sites(count: int, data_dir: str, seed: int = 52249) -> None:
+    """Write a das.xml and an xml.xml file for each of count synthetic hospital sites."""
+    rng = random.Random(seed)
+    os.makedirs(data_dir, exist_ok=True)
+    for i in range(count):
+        ik, site = f"26{i:07d}", f"77{i:07d}"
+        births = rng.randint(100, 3000)
+        if births < 150:
+            case_count = "<Fallzahl_Datenschutz>true</Fallzahl_Datenschutz>"
+        else:
+            case_count = (f"<Fallzahl><Grundgesamtheit>{births}</Grundgesamtheit>"
+                          f"<Beobachtete_Ereignisse>{int(births * rng.uniform(0.2, 0.45))}</Beobachtete_Ereignisse></Fallzahl>")
+        with open(os.path.join(data_dir, f"{ik}-{site}-{YEAR}-das.xml"), "w", encoding="utf-8") as f:
+            f.write(f"<Root><Ergebnis><Ergebnis_ID>52249</Ergebnis_ID>{case_count}</Ergebnis></Root>")
+        with open(os.path.join(data_dir, f"{ik}-{site}-{YEAR}-xml.xml"), "w", encoding="utf-8") as f:
+            f.write(f"<Root><Standortkontaktdaten><Name>Klinikum {i}</Name><Kontakt_Zugang>"
+                    f"<Strasse>Hauptstraße</Strasse><Hausnummer>{i % 200 + 1}</Hausnummer>"
+                    f"<Postleitzahl>{10000 + i % 89999}</Postleitzahl><Ort>{rng.choice(CITIES)}</Ort>"
+                    f"</Kontakt_Zugang></Standortkontaktdaten></Root>")
+
+
+def fixed_coordinates(clinic_data) -> Optional[Tuple[float, float]]:
+    """Stands in for the Nominatim request."""
+    return 51.16, 10.45
+
+
+def measure(run) -> tuple:
+    """Peak traced memory in MB and duration in seconds of a run, starting with an empty geocoding cache."""
+    for cache in get_gps_coordinates._caches.values():
+        cache.close()
+    get_gps_coordinates._caches.clear()
+    if os.path.exists(get_gps_coordinates.CACHE_FILE):
+        os.remove(get_gps_coordinates.CACHE_FILE)
+    with open(os.devnull, "w") as devnull, redirect_stdout(devnull):
+        tracemalloc.start()
+        start_time = time.time()
+        run()
+    elapsed = time.time() - start_time
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return peak / 2**20, elapsed
+
+
+def main(sizes: List[int], batch: bool = False) -> int:
+    """Print the peak memory and duration per size. Returns 1 if the streaming mode's memory was not flat."""
+    peaks = []
+    previous_dir = os.getcwd()
+    work_dir = tempfile.mkdtemp(prefix="streaming_benchmark_")
+    os.chdir(work_dir)
+    get_gps_coordinates.query_nominatim = fixed_coordinates
+    try:
+        print(f"{'Sites':>8} {'Streaming MB':>13} {'Seconds':>8}" + (f" {'Batch MB':>9} {'Seconds':>8}" if batch else ""))
+        for size in sizes:
+            shutil.rmtree("data", ignore_errors=True)
+            write_synthetic_sites(size, os.path.join("data", f"xml_{YEAR}"))
+            peak, elapsed = measure(lambda: streaming.main(YEAR))
+            peaks.append(peak)
+            line = f"{size:>8} {peak:>13.1f} {elapsed:>8.1f}"
+            if batch:
+                line += " {:>9.1f} {:>8.1f}".format(*measure(lambda: process_hospital_data.main(YEAR)))
+            print(line, flush=True)
+    finally:
+        os.chdir(previous_dir)
+        shutil.rmtree(work_dir, ignore_errors=True)
+    growth = max(peaks) / min(peaks)
+    if growth > STREAM_MEMORY_GROWTH:
+        print(f"Peak memory of the streaming mode grew by a factor of {growth:.2f} (at most {STREAM_MEMORY_GROWTH})")
+        return 1
+    print(f"Peak memory of the streaming mode is flat (factor {growth:.2f})")
+    return 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the memory use of the streaming mode")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000, 100000],
+                        help="Numbers of synthetic hospital sites")
+    parser.add_argument("--batch", action="store_true", help="Also measure the regular processing")
+    args = parser.parse_args()
+    raise SystemExit(main(args.sizes, batch=args.batch))
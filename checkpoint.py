@@ -0,0 +1,74 @@
+"""
+checkpoint.py
+Append-only journal of completed hospitals, so that an interrupted run can resume where it stopped.
+"""
+import os
+import json
+import logging
+from typing import Dict, Optional, Tuple
+from records import HospitalRecord
+
+SiteKey = Tuple[str, str]  # (IK, Standortnummer)
+
+
+class CheckpointJournal:
+    """
+    One JSON line per completed hospital: its IK, Standortnummer and record
+    (null for sites that do not produce a result, e.g. without obstetrics department).
+    Every line is flushed to disk before the next hospital is processed.
+    """
+
+    def __init__(self, path: str, resume: bool = False):
+        self.path = path
+        self.completed: Dict[SiteKey, Optional[HospitalRecord]] = {}
+        if resume:
+            self._replay()
+        else:
+            open(self.path, "w").close()
+        self.file = open(self.path, "a", encoding="utf-8")
+
+    def _replay(self) -> None:
+        """Read all complete lines; a line cut off by a crash, including one that lacks only its
+        newline, is removed from the journal."""
+        if not os.path.exists(self.path):
+            logging.info(f"No checkpoint journal found at {self.path}, starting from the first hospital")
+            return
+        valid_bytes = 0
+        with open(self.path, "rb") as f:
+            for line in f:
+                try:
+                    if not line.endswith(b"\n"):  # Cut off before its newline, even if the JSON is complete
+                        raise ValueError(line)
+                    entry = json.loads(line)
+                except ValueError:
+                    logging.warning(f"Discarding incomplete entry at the end of {self.path}")
+                    break
+                record = entry["record"]
+                self.completed[(entry["ik"], entry["location_number"])] = (
+                    HospitalRecord.from_dict(record) if record is not None else None)
+                valid_bytes += len(line)
+        with open(self.path, "r+b") as f:
+            f.truncate(valid_bytes)
+        logging.info(f"Resuming from {self.path}: {len(self.completed)} hospitals already completed")
+
+    def __contains__(self, site: SiteKey) -> bool:
+        return site in self.completed
+
+    def __getitem__(self, site: SiteKey) -> Optional[HospitalRecord]:
+        return self.completed[site]
+
+    def write(self, ik: str, location_number: str, record: Optional[HospitalRecord]) -> None:
+        entry = {"ik": ik, "location_number": location_number,
+                 "record": record.to_dict() if record is not None else None}
+        self.file.write(json.dumps(entry, ensure_ascii=False) + "\n")
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.completed[(ik, location_number)] = record
+
+    def close(self) -> None:
+        self.file.close()
+
+    def remove(self) -> None:
+        """Delete the journal after the outputs have been written."""
+        self.close()
+        os.remove(self.path)
@@ -9,6 +9,10 @@ Configuration constants for the C-section rate analysis project.
 DEFAULT_YEAR = 2022
 DATA_DIR = "data"
 OUTPUT_DIR = "output"
+PANEL_FILE = "output/panel.csv"  # Cross-year table with one row per hospital site and year
+PANEL_ROWS_FILE = "panel_rows.csv"  # The rows of one year in the panel, in output/{year}
+WEB_MAP_GEOJSON = "output/web_map.geojson"  # Map points of several years for web map clients
+WEB_MAP_BINARY = "output/web_map.bin"  # The same points in the compact binary point format
 
 # =========================
 # XML Processing Constants
@@ -31,6 +35,22 @@ COLUMN_NAMES = {
     "location_number": "Standortnummer"
 }  # In order to have german column names in the resulting .csv file
 
+# =========================
+# Quality Indicators
+# =========================
+# Ergebnis_IDs extracted from the das.xml files, with the output columns of their case count (total),
+# observed events and rate. All indicators are collected in a single parse of each file.
+# Sites are reported if they have statistics for TARGET_VALUE.
+INDICATORS = {
+    TARGET_VALUE: {  # Births and C-sections
+        "total": COLUMN_NAMES["total_births"],
+        "events": COLUMN_NAMES["csections"],
+        "rate": COLUMN_NAMES["csection_rate"],
+    },
+}
+if TARGET_VALUE not in INDICATORS:  # Its columns are the main results of every site
+    raise ValueError(f"INDICATORS must contain TARGET_VALUE ({TARGET_VALUE})")
+
 # =========================
 # File Extensions
 # =========================
@@ -46,4 +66,43 @@ LOG_FORMAT = '%(asctime)s %(levelname)s: %(message)s'
 # Processing Configuration
 # =========================
 PROGRESS_INTERVAL = 100  # Print progress every N hospitals
+WATCH_INTERVAL = 10  # Seconds between two scans of the data directory in watch mode
+GEOCODE_RETRY_INTERVAL = 30 * 24 * 3600  # Seconds after which addresses Nominatim could not resolve are queried again
+OUTPUT_WRITE_BUFFER = 1 << 20  # Buffer size in bytes for writing the output files
+STREAM_CHUNK_SIZE = 1000  # Hospitals held in memory at once in streaming mode
+STREAM_MEMORY_GROWTH = 1.25  # Largest ratio of the peak memory of the streaming benchmark between its largest and smallest size
+PREFETCH_DEPTH = 16  # Sites whose report files are read ahead during extraction; 0 disables the read-ahead
+PREFETCH_MEMORY_CAP = 64 * 2**20  # No further files are read ahead while this many bytes are being read or waiting to be parsed
+PREFETCH_WORKERS = 4  # Threads reading report files ahead
 NOT_ENOUGH_BIRTHS_MARKER = "Datenschutz"  # Placeholder for privacy-protected values in xml-files
+CHECKPOINT_FILE = "checkpoint.jsonl"  # Journal of completed hospitals in output/{year}, used by --resume
+SHARD_DIR = "shards"  # Subdirectory of output/{year} holding the partial results of --shard runs
+PIPELINE_MANIFEST = "pipeline_manifest.json"  # Digests of the inputs and outputs of every analysis stage, in output/{year}
+
+# =========================
+# Rate Statistics Configuration
+# =========================
+CONFIDENCE_LEVEL = 0.95  # Confidence level of the Wilson and bootstrap intervals
+BOOTSTRAP_RESAMPLES = 10000  # Number of bootstrap resamples per hospital
+BOOTSTRAP_SEED = 52249  # Fixed seed so that reports are reproducible
+FUNNEL_LEVELS = (0.95, 0.998)  # Control limits of the funnel plot (approx. 2 and 3 standard deviations)
+
+# =========================
+# Plausibility Checks
+# =========================
+VALIDATION_FILE = "validation_violations.csv"  # Violations table, in output/{year} and for all years in output/
+GERMANY_BOUNDS = (47.2, 55.1, 5.8, 15.1)  # Latitude min/max and longitude min/max of valid coordinates
+YOY_JUMP_THRESHOLD = 15  # Rate changes of a site between two years above this many percentage points are reported
+
+# =========================
+# Rankings Configuration
+# =========================
+KNN_NEIGHBORS = 3  # Number of nearest maternity wards each hospital is compared to
+NEIGHBOR_OUTLIERS = 10  # Hospitals differing most from their nearest wards listed in the report
+RANKINGS_FILE = "hospital_rankings.csv"  # Percentile ranks and nearest maternity wards, in output/{year}
+STATES = {  # Digits 3 and 4 of the IK identify the federal state
+    "01": "Schleswig-Holstein", "02": "Hamburg", "03": "Niedersachsen", "04": "Bremen",
+    "05": "Nordrhein-Westfalen", "06": "Hessen", "07": "Rheinland-Pfalz", "08": "Baden-Württemberg",
+    "09": "Bayern", "10": "Saarland", "11": "Berlin", "12": "Brandenburg", "13": "Mecklenburg-Vorpommern",
+    "14": "Sachsen", "15": "Sachsen-Anhalt", "16": "Thüringen",
+}
@@ -1,18 +1,30 @@
 """
 create_kml.py
-Create KML files from hospital statistics CSV data
+Create KML files and web map exports (GeoJSON and a compact binary point format) from hospital statistics CSV data
 """
 import os
+import json
+import struct
+import numpy as np
 import pandas as pd
 import argparse
-from config import DEFAULT_YEAR, OUTPUT_DIR, COLUMN_NAMES, NOT_ENOUGH_BIRTHS_MARKER
+from typing import Dict, Iterable, List, Tuple
+from config import (
+    DEFAULT_YEAR, OUTPUT_DIR, COLUMN_NAMES, NOT_ENOUGH_BIRTHS_MARKER, CONFIDENCE_LEVEL, WEB_MAP_GEOJSON, WEB_MAP_BINARY
+)
+from analysis import read_statistics_csv
+from file_utils import atomic_open
+from validation import validate_table, ValidationError
+from rate_statistics import add_rate_statistics, get_counts, WILSON_LOW, WILSON_HIGH, FUNNEL_POSITION, FUNNEL_LABELS
+from rankings import (
+    write_rankings, join_rankings, STATE, NATIONAL_PERCENTILE, STATE_PERCENTILE, NEIGHBOR_RATES, NEIGHBOR_DISTANCES,
+    NEIGHBOR_MEAN, LIST_SEPARATOR
+)
 
 
-def create_kml_from_csv(df, year):
-    """Create a KML file from CSV data with hospitals categorized by C-section rates.
-    The KML file can be uploaded to Google Maps to create a custom map."""
-        
-    kml_content = f'''<?xml version="1.0" encoding="UTF-8"?>
+def kml_header(year):
+    """Document head of the KML file, including the styles of the four rate categories."""
+    return f'''<?xml version="1.0" encoding="UTF-8"?>
 <kml xmlns="http://www.opengis.net/kml/2.2">
   <Document>
     <name>C-Section Rates in German Hospitals {year}</name>
@@ -186,84 +198,283 @@ def create_kml_from_csv(df, year):
       </Pair>
     </StyleMap>'''
 
-    # Create folders for each category
-    categories = [
-        ("<20%", "558B2F", lambda rate: rate < 20),
-        ("20-30%", "FFEA00", lambda rate: 20 <= rate < 30),
-        ("30-40%", "F9A825", lambda rate: 30 <= rate < 40),
-        (">40%", "A52714", lambda rate: rate >= 40)
-    ]
-    
+
+# Rate categories: folder name, style color and lower bound of the C-section rate in percent
+CATEGORIES = [
+    ("<20%", "558B2F", float("-inf")),
+    ("20-30%", "FFEA00", 20),
+    ("30-40%", "F9A825", 30),
+    (">40%", "A52714", 40),
+]
+
+
+def escape_xml(values: pd.Series) -> pd.Series:
+    """Escape XML characters in a column of strings."""
+    return values.str.replace('&', '&amp;', regex=False).str.replace('<', '&lt;', regex=False).str.replace('>', '&gt;', regex=False)
+
+
+# Columns added by map_points
+POINT_RATE = "rate"
+POINT_CATEGORY = "category"  # Index into CATEGORIES
+
+
+def rate_categories(rates: np.ndarray) -> np.ndarray:
+    """Index into CATEGORIES of every rate in percent."""
+    lower_bounds = [lower_bound for _, _, lower_bound in CATEGORIES]
+    return np.searchsorted(lower_bounds, rates, side='right') - 1
+
+
+def map_points(df, year):
+    """
+    The hospitals of a table that can be shown on a map: with counts, a rate and coordinates.
+    Privacy protected entries and rows with invalid data or without coordinates are skipped.
+    Adds the numeric rate and its category and converts the coordinates to numbers.
+    """
     rate_column = f"{COLUMN_NAMES['csection_rate']} {year}"
-    
-    for category_name, style_id, rate_filter in categories:
-        kml_content += f'''
-    <Folder>
-      <name><![CDATA[{category_name}]]></name>'''
-        
-        # Filter hospitals for this category
-        for idx, row in df.iterrows():
-            try:
-                # Skip privacy protected entries
-                if row[rate_column] == NOT_ENOUGH_BIRTHS_MARKER:
-                    continue
-                    
-                rate = row[rate_column]
-                
-                # Check if coordinates are available
-                latitude = row.get('Latitude', None)
-                longitude = row.get('Longitude', None)
-                if latitude is not None and longitude is not None:
-                    lat = float(latitude)
-                    lon = float(longitude)
-                    if rate_filter(rate) and lat and lon:
-                        hospital_name = str(row[COLUMN_NAMES["hospital_name"]])
-                        city = str(row[COLUMN_NAMES["city"]])
-                        street = str(row[COLUMN_NAMES["street_address"]])
-                        postal_code = str(row[COLUMN_NAMES["postal_code"]])
-                        total_births = row[f"{COLUMN_NAMES['total_births']} {year}"]
-                        csections = row[f"{COLUMN_NAMES['csections']} {year}"]
-                        
-                        # Escape XML characters
-                        hospital_name = hospital_name.replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;')
-                        city = city.replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;')
-                        street = street.replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;')
-                        
-                        description = f"""
+    rates = pd.to_numeric(df[rate_column].where(df[rate_column] != NOT_ENOUGH_BIRTHS_MARKER), errors='coerce')
+    if 'Latitude' in df.columns and 'Longitude' in df.columns:
+        latitudes = pd.to_numeric(df['Latitude'], errors='coerce')
+        longitudes = pd.to_numeric(df['Longitude'], errors='coerce')
+    else:
+        latitudes = longitudes = pd.Series(np.nan, index=df.index)
+    valid = rates.notna() & latitudes.notna() & longitudes.notna() & (latitudes != 0) & (longitudes != 0)
+    valid &= get_counts(df, year)[2]
+    points = df[valid].copy()
+    points['Latitude'], points['Longitude'] = latitudes[valid], longitudes[valid]
+    points[POINT_RATE] = rates[valid]
+    points[POINT_CATEGORY] = rate_categories(rates[valid].to_numpy(dtype=float))
+    return points
+
+
+def ranking_lines(df):
+    """Balloon lines with the percentiles and nearest wards joined from hospital_rankings.csv."""
+    percentiles = ("""<br/>
+                        <b>Perzentil:</b> """ + df[NATIONAL_PERCENTILE].map(str) + " national, "
+                   + df[STATE_PERCENTILE].map(str) + " in " + df[STATE].map(str))
+    percentiles = percentiles.where(df[NATIONAL_PERCENTILE].notna() & df[STATE].notna(), "")
+    neighbors = pd.Series([
+        ", ".join(f"{rate}% ({distance} km)" for rate, distance in
+                  zip(rates.split(LIST_SEPARATOR), distances.split(LIST_SEPARATOR)))
+        if isinstance(rates, str) else "" for rates, distances in zip(df[NEIGHBOR_RATES], df[NEIGHBOR_DISTANCES])
+    ], index=df.index, dtype=object)
+    neighbors = ("""<br/>
+                        <b>Nächste Geburtskliniken:</b> """ + neighbors + ", Mittel "
+                 + df[NEIGHBOR_MEAN].map("{:.0f}".format) + "%").where(neighbors != "", "")
+    return percentiles + neighbors
+
+
+def render_placemarks(df, year, pooled_rate=None):
+    """
+    Render the placemarks of a hospital table, building them column-wise.
+    Returns one string of concatenated placemarks per rate category, in the order of CATEGORIES.
+    pooled_rate is the national rate the funnel positions compare to, needed if df is only part of a year.
+    df needs the ranking columns, see rankings.join_rankings.
+    """
+    df = map_points(add_rate_statistics(df, year, pooled_rate=pooled_rate), year)
+    rates = df[POINT_RATE]
+
+    hospital_names = escape_xml(df[COLUMN_NAMES["hospital_name"]].map(str))
+    cities = escape_xml(df[COLUMN_NAMES["city"]].map(str))
+    streets = escape_xml(df[COLUMN_NAMES["street_address"]].map(str))
+    postal_codes = df[COLUMN_NAMES["postal_code"]].map(str)
+    total_births = df[f"{COLUMN_NAMES['total_births']} {year}"].map(str)
+    csections = df[f"{COLUMN_NAMES['csections']} {year}"].map(str)
+    rate_texts = rates.astype("Int64").map(str)
+    wilson_lows = df[WILSON_LOW].map("{:.0%}".format)
+    wilson_highs = df[WILSON_HIGH].map("{:.0%}".format)
+    funnel_labels = df[FUNNEL_POSITION].astype(int).map(FUNNEL_LABELS)
+    rankings = ranking_lines(df)
+    coordinates = df['Longitude'].map(str) + "," + df['Latitude'].map(str)
+
+    placemarks = ("""
+      <Placemark>
+        <name>""" + hospital_names + """</name>
+        <description>
                         <![CDATA[
-                        <b>Addresse:</b> {street}, {postal_code} {city}<br/>
-                        <b>Anzahl Geburten {year}:</b> {total_births}<br/>
-                        <b>Anzahl Kaiserschnitte {year}:</b> {csections}<br/>
-                        <b>Kaiserschnittrate:</b> {rate}%
+                        <b>Addresse:</b> """ + streets + ", " + postal_codes + " " + cities + f"""<br/>
+                        <b>Anzahl Geburten {year}:</b> """ + total_births + f"""<br/>
+                        <b>Anzahl Kaiserschnitte {year}:</b> """ + csections + """<br/>
+                        <b>Kaiserschnittrate:</b> """ + rate_texts + f"""%<br/>
+                        <b>{CONFIDENCE_LEVEL:.0%}-Konfidenzintervall:</b> """ + wilson_lows + " - " + wilson_highs + """<br/>
+                        <b>Vergleich zum Bundesdurchschnitt:</b> """ + funnel_labels + rankings + """
                         ]]>
-                        """
-                        
-                        kml_content += f'''
-      <Placemark>
-        <name>{hospital_name}</name>
-        <description>{description}</description>
-        <styleUrl>#icon-1899-{style_id}-nodesc</styleUrl>
+                        </description>
+        <styleUrl>#icon-1899-""")
+    placemark_ends = """-nodesc</styleUrl>
         <Point>
           <coordinates>
-            {lon},{lat},0
+            """ + coordinates + """,0
           </coordinates>
         </Point>
-      </Placemark>'''
-            except (ValueError, TypeError, KeyError) as e:
-                # Skip rows with invalid data
-                continue
-        
-        kml_content += '''
+      </Placemark>"""
+
+    category_index = df[POINT_CATEGORY].to_numpy()
+    return ["".join(placemarks[category_index == index] + style_id + placemark_ends[category_index == index])
+            for index, (_, style_id, _) in enumerate(CATEGORIES)]
+
+
+def folder_start(category_name):
+    return f'''
+    <Folder>
+      <name><![CDATA[{category_name}]]></name>'''
+
+
+FOLDER_END = '''
     </Folder>'''
-    
-    kml_content += '''
+KML_FOOTER = '''
   </Document>
 </kml>'''
-    
-    # Write KML file
+
+
+def render_kml(df, year):
+    """Render the KML document for a hospital table with its ranking columns, with one folder per rate category."""
+    parts = [kml_header(year)]
+    for (category_name, _, _), placemarks in zip(CATEGORIES, render_placemarks(df, year)):
+        parts += [folder_start(category_name), placemarks, FOLDER_END]
+    parts.append(KML_FOOTER)
+    return "".join(parts)
+
+
+# =========================
+# Web map exports
+# =========================
+# Both carry the rate category of every hospital, so that map clients only need to look up its color
+GEOJSON_SUFFIX = "]}"
+
+# Binary point format, little-endian: a header (magic, version, number of points, number of strings,
+# length of the JSON metadata), the JSON metadata padded to 4 bytes, the string table as number of strings + 1
+# uint32 offsets followed by the UTF-8 strings padded to 4 bytes, and one packed record per point.
+# Names and addresses are indices into the string table, categories are indices into the metadata categories.
+BINARY_MAGIC = b"CSRP"
+BINARY_VERSION = 1
+BINARY_HEADER = struct.Struct("<4sIIII")
+POINT_DTYPE = np.dtype([
+    ("latitude", "<f4"), ("longitude", "<f4"), ("births", "<u4"), ("csections", "<u4"),
+    ("name", "<u4"), ("address", "<u4"), ("year", "<u2"), ("rate", "u1"), ("category", "u1"),
+])
+
+
+def category_legend() -> List[dict]:
+    return [{"name": name, "color": f"#{color}", "min_rate": None if np.isinf(lower_bound) else lower_bound}
+            for name, color, lower_bound in CATEGORIES]
+
+
+def web_map_points(df, year) -> pd.DataFrame:
+    """The map points of a year in the layout of the web map exports."""
+    points = map_points(df, year)
+    streets, postal_codes, cities = (points[COLUMN_NAMES[key]].map(str)
+                                     for key in ("street_address", "postal_code", "city"))
+    return pd.DataFrame({
+        "name": points[COLUMN_NAMES["hospital_name"]].map(str),
+        "address": streets + ", " + postal_codes + " " + cities,
+        "year": year,
+        "births": pd.to_numeric(points[f"{COLUMN_NAMES['total_births']} {year}"]).astype(int),
+        "csections": pd.to_numeric(points[f"{COLUMN_NAMES['csections']} {year}"]).astype(int),
+        "rate": points[POINT_RATE].astype(int),
+        "category": points[POINT_CATEGORY].astype(int),
+        "latitude": points['Latitude'],
+        "longitude": points['Longitude'],
+    })
+
+
+def geojson_prefix() -> str:
+    return '{"type":"FeatureCollection","categories":' + json.dumps(category_legend(), separators=(",", ":")) + ',"features":['
+
+
+def render_geojson_features(points: pd.DataFrame) -> str:
+    """Comma-separated GeoJSON features of web map points."""
+    features = [
+        json.dumps({"type": "Feature", "geometry": {"type": "Point", "coordinates": [longitude, latitude]},
+                    "properties": {"name": name, "address": address, "year": int(year), "births": int(births),
+                                   "csections": int(csections), "rate": int(rate), "category": int(category)}},
+                   ensure_ascii=False, separators=(",", ":"))
+        for name, address, year, births, csections, rate, category, latitude, longitude
+        in points.itertuples(index=False, name=None)
+    ]
+    return ",".join(features)
+
+
+def render_geojson(df, year):
+    """Render a GeoJSON FeatureCollection of the hospitals of a table, with the category legend as foreign member."""
+    return geojson_prefix() + render_geojson_features(web_map_points(df, year)) + GEOJSON_SUFFIX
+
+
+def pad4(data: bytes, fill: bytes = b"\0") -> bytes:
+    return data + fill * (-len(data) % 4)
+
+
+def pack_points(points: pd.DataFrame) -> bytes:
+    """Pack web map points of one or more years into the binary point format."""
+    strings: Dict[str, int] = {}
+    name_index = np.array([strings.setdefault(name, len(strings)) for name in points["name"]], dtype=np.uint32)
+    address_index = np.array([strings.setdefault(address, len(strings)) for address in points["address"]],
+                             dtype=np.uint32)
+    records = np.zeros(len(points), dtype=POINT_DTYPE)
+    for field in ("latitude", "longitude", "births", "csections", "year", "rate", "category"):
+        records[field] = points[field].to_numpy()
+    records["name"], records["address"] = name_index, address_index
+
+    encoded = [string.encode("utf-8") for string in strings]
+    offsets = np.cumsum([0] + [len(string) for string in encoded], dtype=np.uint32)
+    metadata = pad4(json.dumps({"years": sorted(int(year) for year in points["year"].unique()),
+                                "categories": category_legend()}, separators=(",", ":")).encode("utf-8"), b" ")
+    return b"".join([
+        BINARY_HEADER.pack(BINARY_MAGIC, BINARY_VERSION, len(records), len(encoded), len(metadata)),
+        metadata,
+        offsets.astype("<u4").tobytes(),
+        pad4(b"".join(encoded)),
+        records.tobytes(),
+    ])
+
+
+def unpack_points(data: bytes) -> Tuple[dict, List[str], np.ndarray]:
+    """Read the binary point format back into (metadata, string table, point records)."""
+    magic, version, point_count, string_count, metadata_length = BINARY_HEADER.unpack_from(data)
+    if magic != BINARY_MAGIC or version != BINARY_VERSION:
+        raise ValueError(f"Not a version {BINARY_VERSION} point file")
+    position = BINARY_HEADER.size
+    metadata = json.loads(data[position:position + metadata_length])
+    position += metadata_length
+    offsets = np.frombuffer(data, dtype="<u4", count=string_count + 1, offset=position)
+    position += offsets.nbytes
+    strings = [data[position + start:position + end].decode("utf-8") for start, end in zip(offsets[:-1], offsets[1:])]
+    position += int(offsets[-1]) + (-int(offsets[-1]) % 4)
+    points = np.frombuffer(data, dtype=POINT_DTYPE, count=point_count, offset=position)
+    return metadata, strings, points
+
+
+def export_web_map(years: Iterable[int]) -> Tuple[str, str]:
+    """Write the map points of several years into one GeoJSON and one binary file, for a single fetch."""
+    points = pd.concat([web_map_points(read_kml_table(year), year) for year in years], ignore_index=True)
+    os.makedirs(os.path.dirname(WEB_MAP_GEOJSON) or ".", exist_ok=True)
+    with atomic_open(WEB_MAP_GEOJSON, 'w', encoding='utf-8') as f:
+        f.write(geojson_prefix() + render_geojson_features(points) + GEOJSON_SUFFIX)
+    with atomic_open(WEB_MAP_BINARY, 'wb') as f:
+        f.write(pack_points(points))
+    return WEB_MAP_GEOJSON, WEB_MAP_BINARY
+
+
+def create_geojson_from_csv(df, year):
+    """Create the GeoJSON file of a year, the counterpart of the KML file for web map clients."""
+    geojson_filename = os.path.join(OUTPUT_DIR, str(year), f"hospital_csection_rates.geojson")
+    try:
+        geojson_content = render_geojson(df, year)
+        with atomic_open(geojson_filename, 'w', encoding='utf-8') as f:
+            f.write(geojson_content)
+        print(f"GeoJSON file created: {geojson_filename}")
+        return geojson_filename
+    except Exception as e:
+        print(f"Error creating GeoJSON file: {e}")
+        return None
+
+
+def create_kml_from_csv(df, year):
+    """Create a KML file from CSV data with hospitals categorized by C-section rates.
+    The KML file can be uploaded to Google Maps to create a custom map."""
     kml_filename = os.path.join(OUTPUT_DIR, str(year), f"hospital_csection_rates.kml")
     try:
-        with open(kml_filename, 'w', encoding='utf-8') as f:
+        kml_content = render_kml(df, year)
+        with atomic_open(kml_filename, 'w', encoding='utf-8') as f:
             f.write(kml_content)
         print(f"KML file created: {kml_filename}")
         return kml_filename
@@ -272,6 +483,20 @@ def create_kml_from_csv(df, year):
         return None
 
 
+def restore_missing_text(df):
+    """Turn empty text fields read from hospital_statistics.csv back into None, so that the KML
+    is the same as the one written by process_hospital_data.py."""
+    for key in ("hospital_name", "city", "street_address", "postal_code"):
+        column = df[COLUMN_NAMES[key]].astype(object)
+        df[COLUMN_NAMES[key]] = column.where(column.notna(), None)
+    return df
+
+
+def read_kml_table(year):
+    """Read the hospital_statistics.csv of a year as input of the KML file."""
+    return restore_missing_text(read_statistics_csv(year))
+
+
 def main(year):
     csv_file = os.path.join(OUTPUT_DIR, str(year), f"hospital_statistics.csv")
 
@@ -280,20 +505,33 @@ def main(year):
         print("Please run process_hospital_data.py first or specify a valid CSV file")
         return
     
-    df = pd.read_csv(csv_file)
+    df = read_kml_table(year)
     os.makedirs(os.path.join(OUTPUT_DIR, str(year)), exist_ok=True)
+    try:
+        validate_table(df, year)
+    except ValidationError as e:
+        print(f"Map files of {year} not written: {e}")
+        return
 
-    kml_file = create_kml_from_csv(df, year, OUTPUT_DIR)
-    if kml_file:
+    write_rankings(df, year)
+    df = join_rankings(df, year)
+    kml_file = create_kml_from_csv(df, year)
+    geojson_file = create_geojson_from_csv(df, year)
+    if kml_file and geojson_file:
         print(f"Success! KML file created at: {kml_file}")
     else:
-        print("Failed to create KML file")
+        print("Failed to create the KML or GeoJSON file")
 
 
 if __name__ == "__main__":
-    parser = argparse.ArgumentParser(description="Create KML from hospital statistics CSV")
-    parser.add_argument("--year", type=int, default=DEFAULT_YEAR, help="Year to process")
+    parser = argparse.ArgumentParser(description="Create KML and GeoJSON from hospital statistics CSV")
+    parser.add_argument("--year", type=int, nargs="+", default=[DEFAULT_YEAR], help="Year(s) to process")
+    parser.add_argument("--web-map", action="store_true",
+                        help=f"Also combine the years into {WEB_MAP_GEOJSON} and {WEB_MAP_BINARY}")
     args = parser.parse_args()
-    
-    year = args.year
-    main(year)
+
+    for year in args.year:
+        main(year)
+    if args.web_map:
+        geojson_file, binary_file = export_web_map(args.year)
+        print(f"Web map files created: {geojson_file}, {binary_file}")
@@ -3,76 +3,112 @@ extract.py
 Module for extracting statistics and clinic data from XML files.
 """
 import xml.etree.ElementTree as ET
+import io
 import os
-from typing import Tuple, Optional
-from config import TARGET_TAG_STATISTIC, TARGET_VALUE, DATA_DIR, NOT_ENOUGH_BIRTHS_MARKER, XML_FILE_SUFFIX, DAS_FILE_SUFFIX
+from typing import Dict, Iterable, Tuple, Optional
+from config import TARGET_TAG_STATISTIC, TARGET_VALUE, INDICATORS, DATA_DIR, NOT_ENOUGH_BIRTHS_MARKER, XML_FILE_SUFFIX, DAS_FILE_SUFFIX
 import logging
 
+def get_relevant_nodes(tree_of_interest: ET.ElementTree, target_vals: Iterable[str], target_tag: str) -> Dict[str, list]:
+    """
+    Find all elements with a specific tag and one of the given values in a single traversal of the tree.
+    Returns the parents of the found elements per value.
+    """
+    target_vals = set(target_vals)
+    parent_lists = {target_val: [] for target_val in target_vals}
+    for parent in tree_of_interest.iter():
+        for elem in parent:
+            if elem.tag == target_tag:
+                text = (elem.text or "").strip()
+                if text in target_vals:
+                    parent_lists[text].append(parent)
+    return parent_lists
+
+
 def get_relevant_node(tree_of_interest: ET.ElementTree, target_val: str, target_tag: str) -> list:
     """
-    Find all elements with a specific tag and value, and return their parents and the elements themselves.
+    Find all elements with a specific tag and value, and return their parents.
     """
-    target_elem_list = []
-    parent_map = {child: parent for parent in tree_of_interest.iter() for child in parent}
-    for elem in tree_of_interest.iter():
-        if elem.tag == target_tag:
-            if (elem.text or "").strip() == target_val:
-                target_elem_list.append(elem)
-    parent_list = [parent_map.get(target_elem) for target_elem in target_elem_list]
-    return parent_list
-    
+    return get_relevant_nodes(tree_of_interest, [target_val], target_tag)[target_val]
 
-def get_hospital_statistic(IK: str, site_identifier: str, year: int) -> Tuple[Optional[str], Optional[str], Optional[str]]:
+
+def read_statistic(HospitalStatistics: list, IK: str, site_identifier: str, indicator: str) -> Tuple[Optional[str], Optional[str], Optional[str]]:
     """
-    Extract birth statistics for a hospital from its XML file.
-    Returns (total births, number of C-sections, C-section rate) or Datenschutz if protected.
+    Read (case count, observed events, rate) from the result elements of one indicator.
+    Returns NOT_ENOUGH_BIRTHS_MARKER three times if the values are protected.
+    """
+    if len(HospitalStatistics) != 1:
+        logging.error(f"There are multiple instances of HospitalStatistics for indicator {indicator} for the hospital "
+                        f"with IK {IK} and Standortnummer {site_identifier}")
+    for HospitalStatistic in HospitalStatistics:
+        CaseCount = HospitalStatistic.find('Fallzahl')
+        if CaseCount is None:
+            CaseCountNoData = HospitalStatistic.find('Fallzahl_Datenschutz')
+            if CaseCountNoData is not None:
+                logging.info(f"Not enough cases for indicator {indicator} in hospital with IK {IK} and Standortnummer {site_identifier} to report statistics.")
+                return NOT_ENOUGH_BIRTHS_MARKER, NOT_ENOUGH_BIRTHS_MARKER, NOT_ENOUGH_BIRTHS_MARKER
+            else:
+                logging.info(f"The xml file for the hospital with IK {IK} and Standortnummer {site_identifier} does not follow the expected structure.")
+                return None, None, None
+        OverallCount = CaseCount.findtext('Grundgesamtheit')
+        ObservedEvents = CaseCount.findtext('Beobachtete_Ereignisse')
+        try:
+            rate = int(round(100* int(ObservedEvents) / int(OverallCount)))
+        except (TypeError, ValueError, ZeroDivisionError) as e:
+            logging.error(f"Error calculating rate for hospital with IK {IK} and Standortnummer {site_identifier}. "
+                          f"ObservedEvents: {ObservedEvents}, OverallCount: {OverallCount}, Error: {e}")
+            rate = None
+        return OverallCount, ObservedEvents, rate
+
+
+def get_hospital_statistics(IK: str, site_identifier: str, year: int, indicators: Iterable[str] = INDICATORS,
+                            data: Optional[bytes] = None) -> Dict[str, Tuple[Optional[str], Optional[str], Optional[str]]]:
+    """
+    Extract the statistics of all given indicators (Ergebnis_IDs) for a hospital with a single parse of its XML file.
+    The file is read from the data directory unless its contents are passed as data.
+    Returns (case count, observed events, rate) per indicator, or Datenschutz if protected.
     Handles file and XML errors gracefully.
     """
+    indicators = list(indicators)
+    statistics = {indicator: (None, None, None) for indicator in indicators}
     path = os.path.join(DATA_DIR, f"xml_{year}", f"{IK}-{site_identifier}-{year}-{DAS_FILE_SUFFIX}")
     try:
-        quality_xml_tree = ET.parse(source=path)
+        quality_xml_tree = ET.parse(source=path if data is None else io.BytesIO(data))
         quality_xml_root = quality_xml_tree.getroot()
     except (FileNotFoundError, ET.ParseError) as e:
         logging.error(f"Error reading/parsing {path}: {e}")
-        return None, None, None
-    HospitalStatistics = get_relevant_node(tree_of_interest=quality_xml_root, target_val=TARGET_VALUE,
-                                                  target_tag=TARGET_TAG_STATISTIC)
-    if HospitalStatistics:
-        if len(HospitalStatistics) != 1:
-            logging.error(f"There are multiple instances of HospitalStatistics for the hospital "
-                            f"with IK {IK} and Standortnummer {site_identifier}")
-        for HospitalStatistic in HospitalStatistics:
-            CaseCount = HospitalStatistic.find('Fallzahl')
-            if CaseCount is None:
-                CaseCountNoData = HospitalStatistic.find('Fallzahl_Datenschutz')
-                if CaseCountNoData is not None:
-                    logging.info(f"Not enough births in hospital with IK {IK} and Standortnummer {site_identifier} to report statistics.")
-                    return NOT_ENOUGH_BIRTHS_MARKER, NOT_ENOUGH_BIRTHS_MARKER, NOT_ENOUGH_BIRTHS_MARKER
-                else:
-                    logging.info(f"The xml file for the hospital with IK {IK} and Standortnummer {site_identifier} does not follow the expected structure.")
-                    return None, None, None
-            OverallCount = CaseCount.findtext('Grundgesamtheit')
-            ObservedEvents = CaseCount.findtext('Beobachtete_Ereignisse')
-            try:
-                rate = int(round(100* int(ObservedEvents) / int(OverallCount)))
-            except (TypeError, ValueError, ZeroDivisionError) as e:
-                logging.error(f"Error calculating rate for hospital with IK {IK} and Standortnummer {site_identifier}. "
-                              f"ObservedEvents: {ObservedEvents}, OverallCount: {OverallCount}, Error: {e}")
-                rate = None
-            return OverallCount, ObservedEvents, rate
-    else:
-        logging.info(f"The hospital with IK {IK} and Standortnummer {site_identifier} does not have an obstetrics department.")
-        return None, None, None
+        return statistics
+    results = get_relevant_nodes(tree_of_interest=quality_xml_root, target_vals=indicators,
+                                 target_tag=TARGET_TAG_STATISTIC)
+    for indicator, HospitalStatistics in results.items():
+        if HospitalStatistics:
+            statistics[indicator] = read_statistic(HospitalStatistics, IK, site_identifier, indicator)
+        elif indicator == TARGET_VALUE:
+            logging.info(f"The hospital with IK {IK} and Standortnummer {site_identifier} does not have an obstetrics department.")
+        else:
+            logging.info(f"The hospital with IK {IK} and Standortnummer {site_identifier} has no results for indicator {indicator}.")
+    return statistics
+
+
+def get_hospital_statistic(IK: str, site_identifier: str, year: int) -> Tuple[Optional[str], Optional[str], Optional[str]]:
+    """
+    Extract birth statistics for a hospital from its XML file.
+    Returns (total births, number of C-sections, C-section rate) or Datenschutz if protected.
+    Handles file and XML errors gracefully.
+    """
+    return get_hospital_statistics(IK, site_identifier, year, [TARGET_VALUE])[TARGET_VALUE]
 
-def get_clinic_data(IK: str, site_identifier: str, year: int) -> Tuple[Optional[str], Optional[str], Optional[str], Optional[str]]:
+def get_clinic_data(IK: str, site_identifier: str, year: int,
+                    data: Optional[bytes] = None) -> Tuple[Optional[str], Optional[str], Optional[str], Optional[str]]:
     """
     Extract clinic contact data from its XML file.
+    The file is read from the data directory unless its contents are passed as data.
     Returns (name, town, street name, house number, zip code).
     Handles file and XML errors gracefully.
     """
     path = os.path.join(DATA_DIR, f"xml_{year}", f"{IK}-{site_identifier}-{year}-{XML_FILE_SUFFIX}")
     try:
-        hospital_xml_tree = ET.parse(source=path)
+        hospital_xml_tree = ET.parse(source=path if data is None else io.BytesIO(data))
         hospital_xml_root = hospital_xml_tree.getroot()
     except (FileNotFoundError, ET.ParseError) as e:
         logging.error(f"Error reading/parsing {path}: {e}")
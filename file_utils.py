@@ -0,0 +1,22 @@
+"""
+file_utils.py
+Helpers for writing output files.
+"""
+import os
+from contextlib import contextmanager
+
+
+@contextmanager
+def atomic_open(path: str, mode: str = "w", **kwargs):
+    """
+    Open a temporary file next to path and move it onto path once writing succeeded,
+    so that readers never see a half-written output file.
+    """
+    tmp_path = f"{path}.tmp"
+    try:
+        with open(tmp_path, mode, **kwargs) as f:
+            yield f
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
@@ -1,34 +1,199 @@
 from geopy.geocoders import Nominatim
+from geopy.exc import GeopyError
+import os
+import argparse
 import json
 import logging
+import re
+import sqlite3
 import time
+import unicodedata
+from typing import Dict, Iterable, Optional, Tuple
+from config import LOG_FORMAT, GEOCODE_RETRY_INTERVAL
+
+CACHE_FILE = 'coordinates_cache.sqlite'  # Imports coordinates_cache.json of earlier versions when first created
+
+# Spellings of "Straße" in the report files, matched in lowercase at the end of a word
+STREET_SPELLINGS = re.compile(r"(str\.|strasse|str)(?=\s|\d|-|$)")
+
+
+def normalize_text(text: Optional[str]) -> str:
+    """Unicode-normalize, lowercase and collapse whitespace."""
+    if text is None:
+        return ""
+    text = unicodedata.normalize("NFC", str(text)).lower()
+    return " ".join(text.split())
+
+
+def normalize_address(clinic_data: dict) -> str:
+    """
+    Canonical form of an address, so that spellings like "Str." / "Straße", extra whitespace or
+    changed casing of the same address share one cache entry.
+    """
+    street = STREET_SPELLINGS.sub("straße", normalize_text(clinic_data.get("street")))
+    street = re.sub(r"\s*-\s*", "-", street)
+    return "|".join([normalize_text(clinic_data.get("postalcode")), normalize_text(clinic_data.get("city")), street])
+
 
 def get_cache_key(clinic_data):
-    # transform the clinic_data dictionary into a string representation
-    clinic_data_str = json.dumps(clinic_data, sort_keys=True)
-    return clinic_data_str
+    return normalize_address(clinic_data)
 
-def get_coordinates_from_clinic_data(clinic_data, cache_file='coordinates_cache.json'):
-    # Load cache if exists
-    try:
-        with open(cache_file, 'r') as f:
-            cache = json.load(f)
-    except (FileNotFoundError, json.JSONDecodeError):
-        cache = {}
 
-    key = get_cache_key(clinic_data)
-    if key in cache:
-        return tuple(cache[key])
+class CoordinatesCache:
+    """
+    Geocoding results keyed by normalized address, kept in an SQLite database so that lookups read single
+    entries from disk instead of holding all addresses in memory.
+    Addresses that Nominatim could not find are stored with the time of the lookup, so they are
+    only queried again after GEOCODE_RETRY_INTERVAL. Changes are written by save().
+    A new cache imports the JSON cache file of earlier versions with the same name, if there is one.
+    """
+
+    def __init__(self, cache_file: str):
+        self.cache_file = cache_file
+        self.hits = 0
+        self.misses = 0
+        new_cache = not os.path.exists(cache_file)
+        # Opened by whichever pipeline stage geocodes first; the stages never geocode at the same time
+        self.connection = sqlite3.connect(cache_file, check_same_thread=False)
+        self.connection.execute("CREATE TABLE IF NOT EXISTS coordinates (address TEXT PRIMARY KEY, latitude REAL, "
+                                "longitude REAL, failed_at REAL)")
+        legacy_file = os.path.splitext(cache_file)[0] + ".json"
+        if new_cache and os.path.exists(legacy_file):
+            self.import_json(legacy_file)
+        self.connection.commit()
+
+    def import_json(self, legacy_file: str) -> None:
+        """Copy the entries and failures of a JSON cache file of earlier versions."""
+        try:
+            with open(legacy_file, 'r') as f:
+                stored = json.load(f)
+        except json.JSONDecodeError as e:
+            logging.warning(f"Geocoding cache {legacy_file} could not be read, starting with an empty cache: {e}")
+            return
+        for key, coords in stored.items():
+            if key.startswith("{"):  # Key of the raw clinic_data dictionary used by earlier versions
+                key = get_cache_key(json.loads(key))
+            if isinstance(coords, dict):
+                self.connection.execute("INSERT INTO coordinates (address, failed_at) VALUES (?, ?) ON CONFLICT "
+                                        "(address) DO UPDATE SET failed_at = excluded.failed_at WHERE failed_at IS NULL",
+                                        (key, coords["failed_at"]))
+            elif coords:
+                self.connection.execute("INSERT INTO coordinates (address, latitude, longitude) VALUES (?, ?, ?) "
+                                        "ON CONFLICT (address) DO UPDATE SET latitude = excluded.latitude, "
+                                        "longitude = excluded.longitude WHERE latitude IS NULL", (key, *coords))
+            # Failures cached as null by earlier versions have no time and are queried again
+        logging.info(f"Imported {len(stored)} addresses of {legacy_file} into the geocoding cache {self.cache_file}")
+
+    def _row(self, key: str) -> Optional[Tuple[Optional[float], Optional[float], Optional[float]]]:
+        return self.connection.execute("SELECT latitude, longitude, failed_at FROM coordinates WHERE address = ?",
+                                       (key,)).fetchone()
+
+    def __contains__(self, key: str) -> bool:
+        row = self._row(key)
+        if row is None:
+            return False
+        latitude, _, failed_at = row
+        return latitude is not None or time.time() - failed_at < GEOCODE_RETRY_INTERVAL
+
+    def get(self, key: str) -> Optional[Tuple[float, float]]:
+        row = self._row(key)
+        return None if row is None or row[0] is None else (row[0], row[1])
+
+    def set(self, key: str, coords: Optional[Tuple[float, float]]) -> None:
+        if coords is None:
+            self.connection.execute("INSERT INTO coordinates (address, failed_at) VALUES (?, ?) ON CONFLICT (address) "
+                                    "DO UPDATE SET failed_at = excluded.failed_at", (key, time.time()))
+        else:
+            self.connection.execute("INSERT OR REPLACE INTO coordinates VALUES (?, ?, ?, NULL)", (key, *coords))
+
+    def save(self) -> None:
+        """Commit the changes; an interrupted run never leaves a partly written cache."""
+        self.connection.commit()
+
+    def close(self) -> None:
+        self.connection.close()
 
+    def hit_rate(self) -> float:
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+
+_caches: Dict[str, CoordinatesCache] = {}
+
+
+def get_cache(cache_file: str = CACHE_FILE) -> CoordinatesCache:
+    if cache_file not in _caches:
+        _caches[cache_file] = CoordinatesCache(cache_file)
+    return _caches[cache_file]
+
+
+def query_nominatim(clinic_data) -> Optional[Tuple[float, float]]:
     geolocator = Nominatim(user_agent="csection_rate_analysis")
     location = geolocator.geocode(query=clinic_data, country_codes='de')
     time.sleep(2)  # maximum of 1 request per second according to Terms of Use
     if location:
-        coords = (location.latitude, location.longitude)
-        cache[key] = coords
-        with open(cache_file, 'w') as f:
-            json.dump(cache, f)
-        return coords
+        return (location.latitude, location.longitude)
     # log the cases where location is not found
     logging.warning(f"Location not found for: {clinic_data}")
-    return None
\ No newline at end of file
+    return None
+
+
+def geocode_addresses(addresses: Iterable[dict], cache_file=CACHE_FILE) -> Dict[str, Optional[Tuple[float, float]]]:
+    """
+    Resolve many addresses at once. Addresses are deduplicated by their normalized form first,
+    so every physical address is looked up at most once, and only cache misses reach Nominatim.
+    Returns the coordinates (or None) per normalized address. The cache file is written once per call.
+    """
+    cache = get_cache(cache_file)
+    unique_addresses = {}
+    for clinic_data in addresses:
+        unique_addresses.setdefault(get_cache_key(clinic_data), clinic_data)
+    hits_before, misses_before = cache.hits, cache.misses
+    coordinates = {}
+    try:
+        for key, clinic_data in unique_addresses.items():
+            if key in cache:
+                cache.hits += 1
+            else:
+                cache.misses += 1
+                try:
+                    cache.set(key, query_nominatim(clinic_data))
+                except GeopyError as e:  # Timeouts, rate limits: not cached, so the next run asks again
+                    logging.warning(f"Geocoding failed for {clinic_data}: {e}")
+            coordinates[key] = cache.get(key)
+    finally:
+        cache.save()
+    hits, misses = cache.hits - hits_before, cache.misses - misses_before
+    if unique_addresses:
+        logging.info(f"Geocoding: {len(unique_addresses)} unique addresses, {hits} cache hits "
+                     f"({hits / len(unique_addresses):.1%}), {misses} Nominatim lookups")
+    return coordinates
+
+
+def get_coordinates_from_clinic_data(clinic_data, cache_file=CACHE_FILE):
+    key = get_cache_key(clinic_data)
+    return geocode_addresses([clinic_data], cache_file)[key]
+
+
+def main(years) -> None:
+    """Resolve the addresses of all sites of the given years, so that later runs only hit the cache."""
+    from process_hospital_data import list_sites, extract_site, clinic_address
+    addresses = []
+    for year in years:
+        for IK, Standortnummer in list_sites(year) or []:
+            record = extract_site(IK, Standortnummer, year)
+            if record is not None:
+                addresses.append(clinic_address(record))
+    coordinates = geocode_addresses(addresses)
+    cache = get_cache()
+    print(f"{len(addresses)} hospitals with {len(coordinates)} unique addresses")
+    print(f"   {cache.hits} cache hits, {cache.misses} Nominatim lookups ({cache.hit_rate():.1%} hit rate)")
+    print(f"   {sum(coords is None for coords in coordinates.values())} addresses not found")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Geocode the hospital addresses of one or more years")
+    parser.add_argument("--year", type=int, nargs="+", required=True, help="Year(s) whose addresses to resolve")
+    args = parser.parse_args()
+    logging.basicConfig(format=LOG_FORMAT, level=logging.INFO)
+    main(args.year)
@@ -0,0 +1,138 @@
+"""
+outputs.py
+Output stage: renders every output file of a year from the final result table.
+Formats are registered in OUTPUT_FORMATS and rendered concurrently on a thread pool.
+"""
+import os
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, Iterable, NamedTuple, Optional
+import pandas as pd
+from config import OUTPUT_DIR, COLUMN_NAMES, OUTPUT_WRITE_BUFFER
+from file_utils import atomic_open
+from records import export_frame, ordered_indicators, indicator_columns, PRIVACY_FLAG
+from create_kml import render_kml, render_geojson
+from rankings import write_rankings, join_rankings
+from validation import validate_table, ValidationError
+
+
+class OutputFormat(NamedTuple):
+    """Renderer of one output file. It receives the compact table, its export layout and the year."""
+    render: Callable[[pd.DataFrame, pd.DataFrame, int], str]
+    encoding: Optional[str] = None  # None writes with the platform default encoding
+    newline: Optional[str] = None  # Passed to open(); "" writes line endings as rendered
+
+
+OUTPUT_FORMATS: Dict[str, OutputFormat] = {}
+
+
+def register_output(filename: str, encoding: Optional[str] = None, newline: Optional[str] = None):
+    """Decorator adding a renderer to OUTPUT_FORMATS."""
+    def register(render):
+        OUTPUT_FORMATS[filename] = OutputFormat(render, encoding, newline)
+        return render
+    return register
+
+
+def list_keys(year: int) -> list:
+    """Columns shown in the txt lists, in order."""
+    return [COLUMN_NAMES["hospital_name"], COLUMN_NAMES["city"], COLUMN_NAMES["street_address"],
+            COLUMN_NAMES["postal_code"],
+            *(column for indicator in ordered_indicators() for column in indicator_columns(indicator, year)),
+            COLUMN_NAMES["ik"], COLUMN_NAMES["location_number"]]
+
+
+def render_list(df: pd.DataFrame, year: int) -> str:
+    """Lines of "key: value" pairs joined by "  -  ", one line per hospital."""
+    if df.empty:
+        return ""
+    columns = [f"{key}: " + df[key].map(str).astype(object) for key in list_keys(year)]
+    lines = columns[0].str.cat(columns[1:], sep="  -  ")
+    return "\n".join(lines) + "\n"
+
+
+@register_output("hospital_statistics.csv", encoding="utf-8", newline="")
+def render_csv(table: pd.DataFrame, df: pd.DataFrame, year: int) -> str:
+    return df.to_csv()
+
+
+@register_output("full_list.txt")
+def render_full_list(table: pd.DataFrame, df: pd.DataFrame, year: int) -> str:
+    return render_list(df, year)
+
+
+@register_output("hospital_statistics.txt")
+def render_public_list(table: pd.DataFrame, df: pd.DataFrame, year: int) -> str:
+    return render_list(df[~table[PRIVACY_FLAG].to_numpy()], year)
+
+
+# Only written for results that pass the plausibility checks, see write_validated_outputs,
+# and after hospital_rankings.csv, see write_all_outputs
+MAP_FORMATS = ("hospital_csection_rates.kml", "hospital_csection_rates.geojson")
+
+
+@register_output("hospital_csection_rates.kml", encoding="utf-8")
+def render_kml_output(table: pd.DataFrame, df: pd.DataFrame, year: int) -> str:
+    return render_kml(join_rankings(df, year), year)
+
+
+@register_output("hospital_csection_rates.geojson", encoding="utf-8")
+def render_geojson_output(table: pd.DataFrame, df: pd.DataFrame, year: int) -> str:
+    return render_geojson(df, year)
+
+
+def write_output(filename: str, output_format: OutputFormat, table: pd.DataFrame, df: pd.DataFrame,
+                 year: int) -> Optional[str]:
+    """
+    Render one format and write it in a single buffered write, replacing the previous file atomically.
+    Returns the path, or None on error.
+    """
+    path = os.path.join(OUTPUT_DIR, str(year), filename)
+    try:
+        content = output_format.render(table, df, year)
+        with atomic_open(path, "w", encoding=output_format.encoding, newline=output_format.newline,
+                         buffering=OUTPUT_WRITE_BUFFER) as f:
+            f.write(content)
+    except Exception as e:
+        logging.error(f"Error writing {filename}: {e}")
+        return None
+    logging.info(f"Output written: {path}")
+    return path
+
+
+def write_all_outputs(table: pd.DataFrame, year: int, formats: Optional[Iterable[str]] = None) -> bool:
+    """
+    Render the given formats (default: all registered ones) of the compact result table concurrently.
+    Before map formats, the rankings they show are written to hospital_rankings.csv.
+    Returns False if any of them could not be written.
+    """
+    os.makedirs(os.path.join(OUTPUT_DIR, str(year)), exist_ok=True)
+    df = export_frame(table, year)
+    filenames = list(OUTPUT_FORMATS if formats is None else formats)
+    rankings_written = True
+    if any(filename in MAP_FORMATS for filename in filenames):
+        try:
+            write_rankings(df, year)
+        except Exception as e:  # The map formats would join outdated rankings
+            logging.error(f"Error writing the rankings of {year}, map files not written: {e}")
+            filenames = [filename for filename in filenames if filename not in MAP_FORMATS]
+            rankings_written = False
+    with ThreadPoolExecutor(max_workers=max(len(filenames), 1)) as executor:
+        paths = list(executor.map(lambda filename: write_output(filename, OUTPUT_FORMATS[filename], table, df, year),
+                                  filenames))
+    return rankings_written and all(path is not None for path in paths)
+
+
+def write_validated_outputs(table: pd.DataFrame, year: int, formats: Optional[Iterable[str]] = None) -> bool:
+    """
+    Like write_all_outputs, but the map formats are only written if the results of the year pass the
+    plausibility checks. Otherwise the other formats are written and ValidationError is raised.
+    """
+    filenames = list(OUTPUT_FORMATS if formats is None else formats)
+    if any(filename in MAP_FORMATS for filename in filenames):
+        try:
+            validate_table(export_frame(table, year), year)
+        except ValidationError:
+            write_all_outputs(table, year, [filename for filename in filenames if filename not in MAP_FORMATS])
+            raise
+    return write_all_outputs(table, year, filenames)
@@ -0,0 +1,302 @@
+"""
+panel.py
+Persistent cross-year panel of hospital sites.
+Every processed year is appended to one long table (one row per site and year). Sites are linked across
+years by (IK, Standortnummer), falling back to name or address matching for sites whose identifiers changed.
+"""
+import os
+import re
+import sqlite3
+import argparse
+import logging
+from typing import Callable, Dict, Iterable, Iterator, List, MutableMapping, Optional, Tuple
+import pandas as pd
+from config import OUTPUT_DIR, PANEL_FILE, COLUMN_NAMES
+from analysis import read_statistics_csv
+
+SITE_ID = "site_id"
+YEAR = "Jahr"
+RATE_RANK = "Rang"
+
+# Columns that carry the year in hospital_statistics.csv, stored without the year in the panel
+YEAR_COLUMNS = [COLUMN_NAMES["total_births"], COLUMN_NAMES["csections"], COLUMN_NAMES["csection_rate"]]
+PANEL_COLUMNS = [SITE_ID, YEAR, COLUMN_NAMES["ik"], COLUMN_NAMES["location_number"],
+                 COLUMN_NAMES["hospital_name"], COLUMN_NAMES["city"], COLUMN_NAMES["street_address"],
+                 COLUMN_NAMES["postal_code"], *YEAR_COLUMNS, "Latitude", "Longitude"]
+
+
+def normalize_text(text) -> str:
+    """Lowercase a name or street and drop everything but letters and digits, for fallback matching."""
+    if not isinstance(text, str):
+        return ""
+    text = text.lower().replace("straße", "str").replace("strasse", "str")
+    return re.sub(r"[^0-9a-zäöü]", "", text)
+
+
+def load_panel(panel_file: str = PANEL_FILE, chunksize: Optional[int] = None):
+    """
+    Load the panel, or an empty one if no year has been added yet.
+    With a chunksize, returns an iterator over chunks of that many rows instead (none if the file does not exist).
+    """
+    if not os.path.exists(panel_file):
+        return pd.DataFrame(columns=PANEL_COLUMNS) if chunksize is None else iter([])
+    return pd.read_csv(panel_file, chunksize=chunksize, dtype={
+        SITE_ID: str, COLUMN_NAMES["ik"]: str, COLUMN_NAMES["location_number"]: str, COLUMN_NAMES["postal_code"]: str
+    })
+
+
+def year_rows(df: pd.DataFrame, year: int) -> pd.DataFrame:
+    """The hospital_statistics table of a year with the year columns renamed to the panel columns and a Jahr column."""
+    rows = df.rename(columns={f"{column} {year}": column for column in YEAR_COLUMNS})
+    rows.insert(0, YEAR, year)
+    return rows
+
+
+class LinkageIndex:
+    """
+    Lookup of the site_id for a hospital, built once from the panel.
+    Sites are matched by (IK, Standortnummer) first, then by name and postal code, then by street and postal code.
+    The fallback keys point to the most recent year in which they were seen.
+    """
+
+    def __init__(self, panel: pd.DataFrame):
+        panel = panel.sort_values(YEAR, kind="stable")
+        self.by_identifier: Dict[Tuple[str, str], str] = dict(zip(
+            zip(panel[COLUMN_NAMES["ik"]], panel[COLUMN_NAMES["location_number"]]), panel[SITE_ID]))
+        self.by_name: Dict[Tuple[str, str], str] = {}
+        self.by_address: Dict[Tuple[str, str], str] = {}
+        for name, street, postal_code, site_id in zip(panel[COLUMN_NAMES["hospital_name"]],
+                                                      panel[COLUMN_NAMES["street_address"]],
+                                                      panel[COLUMN_NAMES["postal_code"]], panel[SITE_ID]):
+            self._add_fallback_keys(name, street, postal_code, site_id)
+
+    def _add_fallback_keys(self, name, street, postal_code, site_id: str) -> None:
+        if normalize_text(name):
+            self.by_name[(normalize_text(name), postal_code)] = site_id
+        if normalize_text(street):
+            self.by_address[(normalize_text(street), postal_code)] = site_id
+
+    def lookup(self, ik: str, location_number: str) -> Optional[str]:
+        """Return the site_id of the site with this IK and Standortnummer, or None."""
+        return self.by_identifier.get((ik, location_number))
+
+    def lookup_name(self, name: str, postal_code) -> Optional[str]:
+        return self.by_name.get((name, postal_code))
+
+    def lookup_address(self, street: str, postal_code) -> Optional[str]:
+        return self.by_address.get((street, postal_code))
+
+    def lookup_fallback(self, name, street, postal_code, used_ids) -> Optional[str]:
+        """Return the site_id of a site with the same name or address that is not in used_ids, or None."""
+        candidates = []
+        if normalize_text(name):
+            candidates.append(self.lookup_name(normalize_text(name), postal_code))
+        if normalize_text(street):
+            candidates.append(self.lookup_address(normalize_text(street), postal_code))
+        return next((site_id for site_id in candidates if site_id is not None and site_id not in used_ids), None)
+
+
+class StoredLinkageIndex(LinkageIndex):
+    """
+    LinkageIndex kept in an SQLite database instead of memory, filled with the panel chunk by chunk.
+    Used by the streaming mode, whose memory must not grow with the number of sites. The rows of the given
+    year are left out, like LinkageIndex(panel[panel[YEAR] != year]).
+    """
+
+    def __init__(self, connection: sqlite3.Connection, year: int):
+        self.connection = connection
+        self.year = year
+        for table, key in (("by_identifier", "ik, location_number"), ("by_name", "name, postal_code"),
+                           ("by_address", "street, postal_code")):
+            first, second = key.split(", ")
+            connection.execute(f"CREATE TABLE {table} ({first} TEXT, {second} TEXT, year INTEGER, site_id TEXT, "
+                               f"PRIMARY KEY ({key}))")
+
+    def add(self, panel: pd.DataFrame) -> None:
+        """Add a chunk of the panel."""
+        panel = panel[panel[YEAR] != self.year]
+        for ik, location_number, name, street, postal_code, year, site_id in zip(
+                panel[COLUMN_NAMES["ik"]], panel[COLUMN_NAMES["location_number"]],
+                panel[COLUMN_NAMES["hospital_name"]], panel[COLUMN_NAMES["street_address"]],
+                panel[COLUMN_NAMES["postal_code"]], panel[YEAR], panel[SITE_ID]):
+            postal_code = postal_code if isinstance(postal_code, str) else None
+            self._store("by_identifier", "ik, location_number", (ik, location_number), int(year), site_id)
+            if normalize_text(name):
+                self._store("by_name", "name, postal_code", (normalize_text(name), postal_code), int(year), site_id)
+            if normalize_text(street):
+                self._store("by_address", "street, postal_code", (normalize_text(street), postal_code),
+                            int(year), site_id)
+
+    def _store(self, table: str, key: str, values: Tuple, year: int, site_id: str) -> None:
+        # The most recent year wins, and within a year the last row, as in the sorted in-memory index
+        self.connection.execute(
+            f"INSERT INTO {table} VALUES (?, ?, ?, ?) ON CONFLICT ({key}) DO UPDATE SET "
+            f"year = excluded.year, site_id = excluded.site_id WHERE excluded.year >= {table}.year",
+            (*values, year, site_id))
+
+    def _get(self, query: str, values: Tuple) -> Optional[str]:
+        row = self.connection.execute(query, values).fetchone()
+        return None if row is None else row[0]
+
+    def lookup(self, ik: str, location_number: str) -> Optional[str]:
+        return self._get("SELECT site_id FROM by_identifier WHERE ik = ? AND location_number = ?",
+                         (ik, location_number))
+
+    def lookup_name(self, name: str, postal_code) -> Optional[str]:
+        return self._get("SELECT site_id FROM by_name WHERE name = ? AND postal_code = ?", (name, postal_code))
+
+    def lookup_address(self, street: str, postal_code) -> Optional[str]:
+        return self._get("SELECT site_id FROM by_address WHERE street = ? AND postal_code = ?", (street, postal_code))
+
+
+class StoredIds:
+    """A set of site ids, or a mapping of site ids to positions, kept in an SQLite table."""
+
+    def __init__(self, connection: sqlite3.Connection, table: str):
+        self.connection = connection
+        self.table = table
+        connection.execute(f"CREATE TABLE {table} (site_id TEXT PRIMARY KEY, position INTEGER)")
+
+    def update(self, site_ids: Iterable[str]) -> None:
+        self.connection.executemany(f"INSERT OR IGNORE INTO {self.table} (site_id) VALUES (?)",
+                                    ((site_id,) for site_id in site_ids))
+
+    def __contains__(self, site_id) -> bool:
+        row = self.connection.execute(f"SELECT 1 FROM {self.table} WHERE site_id = ?", (site_id,)).fetchone()
+        return row is not None
+
+    def __getitem__(self, site_id: str) -> int:
+        row = self.connection.execute(f"SELECT position FROM {self.table} WHERE site_id = ?", (site_id,)).fetchone()
+        if row is None:
+            raise KeyError(site_id)
+        return row[0]
+
+    def __setitem__(self, site_id: str, position: int) -> None:
+        self.connection.execute(f"INSERT OR REPLACE INTO {self.table} VALUES (?, ?)", (site_id, position))
+
+
+def new_site_id(ik: str, location_number: str, *taken: set) -> str:
+    """Site id for a new site, "IK-Standortnummer" with a counter appended if that id is already taken."""
+    site_id = f"{ik}-{location_number}"
+    suffix = 2
+    while any(site_id in ids for ids in taken):
+        site_id = f"{ik}-{location_number}-{suffix}"
+        suffix += 1
+    return site_id
+
+
+def assign_site_ids(index: LinkageIndex, sites: Callable[[], Iterable[Tuple]], known_ids,
+                    used_ids: MutableMapping[str, int], year: int) -> Iterator[str]:
+    """
+    Yield the site_id of every site of a year, in order. sites returns the (IK, Standortnummer, name, street,
+    postal code) of the sites and is called twice. All sites whose (IK, Standortnummer) is known keep their
+    site_id first; name and address matching only links the remaining sites to site_ids that are still free.
+    used_ids maps the site ids taken in the year to their position, so two sites of the same year are never
+    merged; known_ids are the site ids of the other years, which new sites must not take over.
+    """
+    for position, (ik, location_number, _, _, _) in enumerate(sites()):
+        site_id = index.lookup(ik, location_number)
+        if site_id is not None and site_id not in used_ids:
+            used_ids[site_id] = position
+
+    for position, (ik, location_number, name, street, postal_code) in enumerate(sites()):
+        site_id = index.lookup(ik, location_number)
+        if site_id is None or used_ids[site_id] != position:
+            site_id = index.lookup_fallback(name, street, postal_code, used_ids)
+            if site_id is None:
+                site_id = new_site_id(ik, location_number, known_ids, used_ids)
+            else:
+                logging.info(f"Linked hospital with IK {ik} and Standortnummer {location_number} in {year} "
+                             f"to site {site_id} by name/address")
+            used_ids[site_id] = position
+        yield site_id
+
+
+def link_year(panel: pd.DataFrame, df: pd.DataFrame, year: int) -> pd.DataFrame:
+    """Convert the hospital_statistics table of one year into panel rows, assigning every site its site_id."""
+    rows = year_rows(df, year)
+    sites = list(zip(rows[COLUMN_NAMES["ik"]], rows[COLUMN_NAMES["location_number"]],
+                     rows[COLUMN_NAMES["hospital_name"]], rows[COLUMN_NAMES["street_address"]],
+                     rows[COLUMN_NAMES["postal_code"]]))
+    site_ids = assign_site_ids(LinkageIndex(panel[panel[YEAR] != year]), lambda: sites, set(panel[SITE_ID]), {},
+                               year)
+    rows.insert(0, SITE_ID, list(site_ids))
+    return rows[PANEL_COLUMNS]
+
+
+def add_year(year: int, panel_file: str = PANEL_FILE) -> pd.DataFrame:
+    """
+    Add the processed results of a year to the panel.
+    A new year is appended to the panel file; a year that is already present is replaced.
+    """
+    panel = load_panel(panel_file)
+    rows = link_year(panel, read_statistics_csv(year), year)
+    if year in set(panel[YEAR]):
+        panel = pd.concat([panel[panel[YEAR] != year], rows], ignore_index=True)
+        panel.to_csv(panel_file, index=False)
+    else:
+        os.makedirs(os.path.dirname(panel_file) or ".", exist_ok=True)
+        rows.to_csv(panel_file, mode="a", header=panel.empty, index=False)
+        panel = pd.concat([panel, rows], ignore_index=True)
+    logging.info(f"Added {len(rows)} hospitals of {year} to the panel {panel_file}")
+    return panel
+
+
+def processed_years() -> List[int]:
+    """The years with a hospital_statistics.csv in the output directory."""
+    if not os.path.isdir(OUTPUT_DIR):
+        return []
+    return sorted(int(name) for name in os.listdir(OUTPUT_DIR)
+                  if name.isdigit() and os.path.isfile(os.path.join(OUTPUT_DIR, name, "hospital_statistics.csv")))
+
+
+def build_panel(years) -> pd.DataFrame:
+    """The panel of the given processed years, built in memory without touching the panel file."""
+    panel = pd.DataFrame(columns=PANEL_COLUMNS)
+    for year in sorted(years):
+        panel = pd.concat([panel, link_year(panel, read_statistics_csv(year), year)], ignore_index=True)
+    return panel
+
+
+def year_over_year(panel: pd.DataFrame, from_year: int, to_year: int) -> pd.DataFrame:
+    """
+    Rate deltas and rank changes for all sites present in both years, from one join on site_id.
+    Ranks are 1 for the highest C-section rate of a year; privacy-protected sites have no rank.
+    """
+    rate_column = COLUMN_NAMES["csection_rate"]
+    by_year = panel[panel[YEAR].isin([from_year, to_year])].copy()
+    by_year[rate_column] = pd.to_numeric(by_year[rate_column], errors="coerce")
+    by_year[RATE_RANK] = by_year.groupby(YEAR)[rate_column].rank(ascending=False, method="min")
+    by_year = by_year.set_index(SITE_ID)
+
+    before = by_year[by_year[YEAR] == from_year]
+    after = by_year[by_year[YEAR] == to_year]
+    joined = after.join(before[[rate_column, RATE_RANK]], how="inner", rsuffix=f" {from_year}")
+    joined = joined.rename(columns={rate_column: f"{rate_column} {to_year}", RATE_RANK: f"{RATE_RANK} {to_year}"})
+    joined[f"Differenz {rate_column}"] = joined[f"{rate_column} {to_year}"] - joined[f"{rate_column} {from_year}"]
+    joined[f"Differenz {RATE_RANK}"] = joined[f"{RATE_RANK} {from_year}"] - joined[f"{RATE_RANK} {to_year}"]
+    return joined[[COLUMN_NAMES["hospital_name"], COLUMN_NAMES["city"], COLUMN_NAMES["ik"],
+                   COLUMN_NAMES["location_number"], f"{rate_column} {from_year}", f"{rate_column} {to_year}",
+                   f"Differenz {rate_column}", f"{RATE_RANK} {from_year}", f"{RATE_RANK} {to_year}",
+                   f"Differenz {RATE_RANK}"]]
+
+
+def main(years, compare) -> None:
+    for year in years:
+        panel = add_year(year)
+        print(f"Added {year} to the panel: {panel[SITE_ID].nunique()} sites over {panel[YEAR].nunique()} years")
+    if compare:
+        from_year, to_year = compare
+        changes = year_over_year(load_panel(), from_year, to_year)
+        output_file = os.path.join(OUTPUT_DIR, f"year_over_year_{from_year}_{to_year}.csv")
+        changes.to_csv(output_file)
+        print(f"Year-over-year changes for {len(changes)} hospitals saved to: {output_file}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Maintain the cross-year hospital panel")
+    parser.add_argument("--year", type=int, nargs="*", default=[], help="Processed year(s) to add to the panel")
+    parser.add_argument("--compare", type=int, nargs=2, metavar=("FROM_YEAR", "TO_YEAR"),
+                        help="Write rate deltas and rank changes between two years")
+    args = parser.parse_args()
+    main(args.year, args.compare)
@@ -0,0 +1,304 @@
+"""
+pipeline.py
+Stage graph of the complete analysis. Every stage declares the files it reads and writes and the code it runs.
+A digest manifest in output/{year} records them, so that a re-run only executes the stages whose inputs or code
+changed. Stages whose inputs are ready run concurrently.
+"""
+import os
+import json
+import time
+import hashlib
+import inspect
+import logging
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from typing import Callable, Dict, List, NamedTuple, Optional, Sequence, Tuple
+import matplotlib
+import config
+import records
+import extract_from_xml
+import get_gps_coordinates
+import rate_statistics
+import create_kml
+import panel
+import validation
+import rankings
+import prefetch
+import checkpoint
+import sharding
+import process_hospital_data
+from config import DATA_DIR, OUTPUT_DIR, PANEL_ROWS_FILE, PIPELINE_MANIFEST, VALIDATION_FILE, RANKINGS_FILE
+from file_utils import atomic_open
+from outputs import (
+    list_keys, render_list, render_csv, render_full_list, render_public_list, write_output, write_all_outputs,
+    write_validated_outputs
+)
+from analysis import (
+    read_statistics_csv, load_data, generate_summary_statistics, create_visualizations, format_outlier_table,
+    format_regional_comparison, generate_analysis_report
+)
+
+# Stage results
+RAN = "ran"
+UP_TO_DATE = "up to date"
+FAILED = "failed"
+BLOCKED = "blocked"  # Not run because a stage it depends on failed
+
+Digest = Optional[str]
+
+
+class Stage(NamedTuple):
+    """
+    One step of the analysis. Paths may contain {year} and {previous_year}. Inputs and outputs are files or
+    directories; a file that is both (like a cache the stage updates) is recorded as the stage left it.
+    code lists the functions and modules (besides run) whose source the results depend on, settings the names
+    of the values in config.py they depend on.
+    """
+    name: str
+    run: Callable[[int], None]
+    inputs: Tuple[str, ...]
+    outputs: Tuple[str, ...]
+    code: Tuple[object, ...] = ()
+    settings: Tuple[str, ...] = ()
+
+
+# =========================
+# Digests
+# =========================
+def digest_file(path: str) -> str:
+    sha = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+def digest_directory(path: str) -> str:
+    """Digest of the names, sizes and modification times of the files in a directory.
+    The report directories hold thousands of files, so their contents are not read."""
+    sha = hashlib.sha256()
+    with os.scandir(path) as entries:
+        for entry in sorted(entries, key=lambda entry: entry.name):
+            if entry.is_file():
+                stat = entry.stat()
+                sha.update(f"{entry.name}\0{stat.st_size}\0{stat.st_mtime_ns}\n".encode())
+    return sha.hexdigest()
+
+
+def digest_path(path: str) -> Digest:
+    """Digest of a file or directory; None if it does not exist."""
+    if os.path.isdir(path):
+        return digest_directory(path)
+    if os.path.isfile(path):
+        return digest_file(path)
+    return None
+
+
+def digest_code(stage: Stage) -> str:
+    """Digest of the source code a stage runs and of the values of its settings."""
+    sha = hashlib.sha256()
+    for obj in (stage.run, *stage.code):
+        sha.update(inspect.getsource(obj).encode())
+    for name in stage.settings:
+        sha.update(f"{name}={getattr(config, name)!r}\n".encode())
+    return sha.hexdigest()
+
+
+def stage_paths(paths: Sequence[str], year: int) -> List[str]:
+    return [path.format(year=year, previous_year=year - 1) for path in paths]
+
+
+# =========================
+# Manifest
+# =========================
+def manifest_path(year: int) -> str:
+    return os.path.join(OUTPUT_DIR, str(year), PIPELINE_MANIFEST)
+
+
+def load_manifest(year: int) -> Dict[str, dict]:
+    try:
+        with open(manifest_path(year), encoding="utf-8") as f:
+            return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return {}
+
+
+def save_manifest(year: int, manifest: Dict[str, dict]) -> None:
+    with atomic_open(manifest_path(year), "w", encoding="utf-8") as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+
+
+def is_up_to_date(entry: Optional[dict], inputs: Dict[str, Digest], code: str) -> bool:
+    """A stage is up to date if its inputs and code are unchanged and its outputs are as it left them."""
+    if entry is None or entry["inputs"] != inputs or entry["code"] != code:
+        return False
+    return all(digest is not None and digest_path(path) == digest for path, digest in entry["outputs"].items())
+
+
+# =========================
+# Execution
+# =========================
+def stage_dependencies(stages: Sequence[Stage], year: int) -> Dict[str, set]:
+    """Stages that have to finish before a stage can start: the producers of its inputs, besides itself."""
+    producers = {path: stage.name for stage in stages for path in stage_paths(stage.outputs, year)}
+    return {stage.name: {producers[path] for path in stage_paths(stage.inputs, year)
+                         if path in producers and producers[path] != stage.name}
+            for stage in stages}
+
+
+def run_pipeline(year: int, stages: Sequence[Stage], force: bool = False) -> Dict[str, str]:
+    """
+    Run the stages of a year in dependency order, skipping stages that are up to date (unless force is set).
+    Returns the result per stage: RAN, UP_TO_DATE, FAILED or BLOCKED.
+    """
+    os.makedirs(os.path.join(OUTPUT_DIR, str(year)), exist_ok=True)
+    manifest = load_manifest(year)
+    dependencies = stage_dependencies(stages, year)
+    pending = {stage.name: stage for stage in stages}
+    results: Dict[str, str] = {}
+    running = {}
+
+    def start_ready_stages(executor):
+        progress = True
+        while progress:
+            progress = False
+            for name, stage in list(pending.items()):
+                if any(results.get(dependency) in (FAILED, BLOCKED) for dependency in dependencies[name]):
+                    results[name] = BLOCKED
+                elif all(dependency in results for dependency in dependencies[name]):
+                    inputs = {path: digest_path(path) for path in stage_paths(stage.inputs, year)}
+                    code = digest_code(stage)
+                    if not force and is_up_to_date(manifest.get(name), inputs, code):
+                        results[name] = UP_TO_DATE
+                        print(f"   {name}: up to date")
+                    else:
+                        running[executor.submit(run_stage, stage, year)] = (stage, inputs, code)
+                else:
+                    continue
+                del pending[name]
+                progress = True
+
+    with ThreadPoolExecutor(max_workers=max(len(stages), 1)) as executor:
+        start_ready_stages(executor)
+        while running:
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                stage, inputs, code = running.pop(future)
+                try:
+                    outputs = future.result()
+                except Exception as e:
+                    logging.error(f"Stage {stage.name} failed: {e}")
+                    print(f"   {stage.name}: failed ({e})")
+                    manifest.pop(stage.name, None)
+                    results[stage.name] = FAILED
+                else:
+                    inputs = {path: outputs.get(path, digest) for path, digest in inputs.items()}
+                    manifest[stage.name] = {"inputs": inputs, "code": code, "outputs": outputs}
+                    results[stage.name] = RAN
+                save_manifest(year, manifest)
+            start_ready_stages(executor)
+    if pending:
+        raise ValueError(f"Stages with circular dependencies: {sorted(pending)}")
+    return results
+
+
+def run_stage(stage: Stage, year: int) -> Dict[str, Digest]:
+    """Run one stage and return the digests of its outputs. Raises RuntimeError if an output is missing."""
+    start_time = time.time()
+    stage.run(year)
+    outputs = {path: digest_path(path) for path in stage_paths(stage.outputs, year)}
+    missing = [path for path, digest in outputs.items() if digest is None]
+    if missing:
+        raise RuntimeError(f"outputs not written: {', '.join(missing)}")
+    logging.info(f"Stage {stage.name} completed in {time.time() - start_time:.1f} seconds")
+    print(f"   {stage.name}: completed in {time.time() - start_time:.1f} seconds")
+    return outputs
+
+
+# =========================
+# Stages of the complete analysis
+# =========================
+YEAR_DIR = os.path.join(OUTPUT_DIR, "{year}")
+STATISTICS_CSV = os.path.join(YEAR_DIR, "hospital_statistics.csv")
+VALIDATION_RESULT = os.path.join(YEAR_DIR, VALIDATION_FILE)
+RANKINGS = os.path.join(YEAR_DIR, RANKINGS_FILE)
+PANEL_ROWS = os.path.join(YEAR_DIR, PANEL_ROWS_FILE)
+PREVIOUS_PANEL_ROWS = os.path.join(OUTPUT_DIR, "{previous_year}", PANEL_ROWS_FILE)
+GEOCODING_CACHE = get_gps_coordinates.CACHE_FILE
+EXTRACTED_FILES = ("hospital_statistics.csv", "full_list.txt", "hospital_statistics.txt")
+VISUALIZATIONS = ("csection_rate_distribution.png", "size_vs_rate.png", "funnel_plot.png")
+
+# Settings of config.py the stages depend on; paths are covered by the inputs and outputs
+TABLE_SETTINGS = ("COLUMN_NAMES", "NOT_ENOUGH_BIRTHS_MARKER")  # Layout of the hospital table
+EXTRACTION_SETTINGS = ("TARGET_TAG_STATISTIC", "TARGET_VALUE", "INDICATORS", "DAS_FILE_SUFFIX", "XML_FILE_SUFFIX",
+                       "GEOCODE_RETRY_INTERVAL")
+STATISTICS_SETTINGS = ("CONFIDENCE_LEVEL", "BOOTSTRAP_RESAMPLES", "BOOTSTRAP_SEED", "FUNNEL_LEVELS")
+RANKING_SETTINGS = ("KNN_NEIGHBORS", "STATES")
+
+
+def analysis_stages(resume: bool = False) -> List[Stage]:
+    """The stages of run_complete_analysis.py. With resume, the extraction continues from its checkpoint journal."""
+    def extract(year: int) -> None:
+        if not process_hospital_data.main(year, resume=resume, formats=EXTRACTED_FILES):
+            raise RuntimeError(f"Data extraction of {year} failed")
+
+    return [
+        # Geocodes through the cache file, which it reads and updates
+        Stage("extract", extract,
+              inputs=(os.path.join(DATA_DIR, "xml_{year}"), GEOCODING_CACHE),
+              outputs=(*(os.path.join(YEAR_DIR, filename) for filename in EXTRACTED_FILES), GEOCODING_CACHE),
+              code=(process_hospital_data, extract_from_xml, records, prefetch, checkpoint, sharding,
+                    get_gps_coordinates, list_keys, render_list, render_csv, render_full_list, render_public_list,
+                    write_output, write_all_outputs, write_validated_outputs),
+              settings=TABLE_SETTINGS + EXTRACTION_SETTINGS),
+        # The shared panel file changes with every year, so the stage records the rows of its own year
+        Stage("panel", update_panel, inputs=(STATISTICS_CSV,), outputs=(PANEL_ROWS,),
+              code=(panel, read_statistics_csv), settings=TABLE_SETTINGS),
+        # Checks the year against the panel, comparing rates to the previous year; the later stages only
+        # start if it finds no errors
+        Stage("validation", validation.validate_year, inputs=(PANEL_ROWS, PREVIOUS_PANEL_ROWS),
+              outputs=(VALIDATION_RESULT,), code=(validation, panel),
+              settings=TABLE_SETTINGS + ("GERMANY_BOUNDS", "YOY_JUMP_THRESHOLD")),
+        # Percentiles and nearest wards, computed once and read by the maps and the report
+        Stage("rankings", rankings.write_year_rankings, inputs=(STATISTICS_CSV, VALIDATION_RESULT),
+              outputs=(RANKINGS,), code=(rankings, read_statistics_csv), settings=TABLE_SETTINGS + RANKING_SETTINGS),
+        Stage("maps", write_maps, inputs=(STATISTICS_CSV, RANKINGS),
+              outputs=(os.path.join(YEAR_DIR, "hospital_csection_rates.kml"),
+                       os.path.join(YEAR_DIR, "hospital_csection_rates.geojson")),
+              code=(create_kml, rate_statistics, rankings.join_rankings, rankings.read_rankings_csv,
+                    read_statistics_csv),
+              settings=TABLE_SETTINGS + STATISTICS_SETTINGS + RANKING_SETTINGS),
+        Stage("visualizations", draw_visualizations, inputs=(STATISTICS_CSV, VALIDATION_RESULT),
+              outputs=tuple(os.path.join(YEAR_DIR, "visualizations", filename) for filename in VISUALIZATIONS),
+              code=(rate_statistics, read_statistics_csv, load_data, create_visualizations),
+              settings=TABLE_SETTINGS + STATISTICS_SETTINGS),
+        Stage("report", write_report, inputs=(STATISTICS_CSV, RANKINGS),
+              outputs=(os.path.join(YEAR_DIR, "analysis_report.md"),),
+              code=(rate_statistics, rankings.join_rankings, rankings.read_rankings_csv, read_statistics_csv, load_data,
+                    generate_summary_statistics, format_outlier_table, format_regional_comparison,
+                    generate_analysis_report),
+              settings=TABLE_SETTINGS + STATISTICS_SETTINGS + RANKING_SETTINGS + ("NEIGHBOR_OUTLIERS",)),
+    ]
+
+
+def update_panel(year: int) -> None:
+    cross_year_panel = panel.add_year(year)
+    rows = cross_year_panel[cross_year_panel[panel.YEAR] == year]
+    with atomic_open(PANEL_ROWS.format(year=year), "w", encoding="utf-8", newline="") as f:
+        f.write(rows.to_csv(index=False))
+    print(f"   Cross-year panel updated: {cross_year_panel[panel.SITE_ID].nunique()} sites over "
+          f"{cross_year_panel[panel.YEAR].nunique()} years")
+
+
+def write_maps(year: int) -> None:
+    df = rankings.join_rankings(create_kml.read_kml_table(year), year)
+    if create_kml.create_kml_from_csv(df, year) is None or create_kml.create_geojson_from_csv(df, year) is None:
+        raise RuntimeError(f"Map files of {year} could not be written")
+
+
+def draw_visualizations(year: int) -> None:
+    matplotlib.use("Agg")  # The plots are drawn on a worker thread
+    create_visualizations(load_data(year), year)
+
+
+def write_report(year: int) -> None:
+    generate_analysis_report(rankings.join_rankings(load_data(year), year), year)
@@ -0,0 +1,134 @@
+"""
+prefetch.py
+Read-ahead of the report files: the raw bytes of the das.xml and xml.xml files of upcoming sites are
+loaded on a thread pool while the current site is being parsed, which hides the latency of slow
+(e.g. network-mounted) data directories.
+"""
+import os
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Iterable, Iterator, NamedTuple, Optional, Tuple
+from config import DATA_DIR, DAS_FILE_SUFFIX, XML_FILE_SUFFIX, PREFETCH_DEPTH, PREFETCH_MEMORY_CAP, PREFETCH_WORKERS
+
+SiteKey = Tuple[str, str]  # (IK, Standortnummer)
+
+
+class ReportFiles(NamedTuple):
+    """Contents of the report files of a site; None if a file does not exist, and xml if das does not exist."""
+    das: Optional[bytes]
+    xml: Optional[bytes]
+
+    def size(self) -> int:
+        return len(self.das or b"") + len(self.xml or b"")
+
+
+def report_paths(IK: str, Standortnummer: str, year: int) -> Tuple[str, str]:
+    directory = os.path.join(DATA_DIR, f"xml_{year}")
+    return (os.path.join(directory, f"{IK}-{Standortnummer}-{year}-{DAS_FILE_SUFFIX}"),
+            os.path.join(directory, f"{IK}-{Standortnummer}-{year}-{XML_FILE_SUFFIX}"))
+
+
+def report_size(path: str) -> Optional[int]:
+    """Size of a report file in bytes, or None if it does not exist. Other errors are left to the read."""
+    try:
+        return os.path.getsize(path)
+    except FileNotFoundError:
+        return None
+    except OSError:
+        return 0
+
+
+def read_bytes(path: str) -> Tuple[Optional[bytes], float]:
+    """
+    Contents of a file (None if it no longer exists) and the seconds the read took.
+    Other errors are raised, and reach the caller when the files of the site are handed out.
+    """
+    start_time = time.perf_counter()
+    try:
+        with open(path, "rb") as f:
+            data = f.read()
+    except FileNotFoundError:
+        data = None
+    return data, time.perf_counter() - start_time
+
+
+class ReportPrefetcher:
+    """
+    Iterates over (site, ReportFiles) in the order of the given sites, keeping up to depth sites read ahead.
+    The size of every file is reserved when its read is started and released when the site is handed out;
+    no further reads are started while memory_cap bytes or more are reserved.
+    Records the time spent reading every file and the time the caller had to wait for it; with
+    record_files=False only the totals are kept, so that memory does not grow with the number of files.
+    """
+
+    def __init__(self, year: int, sites: Iterable[SiteKey], depth: int = PREFETCH_DEPTH,
+                 memory_cap: int = PREFETCH_MEMORY_CAP, workers: int = PREFETCH_WORKERS, record_files: bool = True):
+        self.year = year
+        self.sites = sites
+        self.depth = max(depth, 1)
+        self.memory_cap = memory_cap
+        self.workers = workers
+        self.record_files = record_files
+        self.reserved_bytes = 0
+        self.read_times: Dict[str, float] = {}
+        self.wait_times: Dict[str, float] = {}
+        self.files = 0
+        self.total_read_time = 0.0
+        self.total_wait_time = 0.0
+
+    def __iter__(self) -> Iterator[Tuple[SiteKey, ReportFiles]]:
+        sites = iter(self.sites)
+        pending = deque()  # (site, paths, futures, reserved bytes) in the order of the sites
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            while True:
+                while len(pending) < self.depth and self.reserved_bytes < self.memory_cap:
+                    site = next(sites, None)
+                    if site is None:
+                        break
+                    pending.append(self.submit(executor, site))
+                if not pending:
+                    return
+                site, paths, futures, size = pending.popleft()
+                self.reserved_bytes -= size
+                contents = [self.result(path, future) for path, future in zip(paths, futures)]
+                yield site, ReportFiles(*contents, *[None] * (len(paths) - len(contents)))
+
+    def submit(self, executor: ThreadPoolExecutor, site: SiteKey) -> tuple:
+        """
+        Start reading the files of a site and reserve their sizes. Like the extraction, which only looks at the
+        xml.xml file of sites with a das.xml file, the xml.xml file is not read if there is no das.xml file.
+        """
+        paths = report_paths(*site, self.year)
+        futures = []
+        size = 0
+        for path in paths:
+            file_size = report_size(path)
+            if file_size is None:
+                break
+            futures.append(executor.submit(read_bytes, path))
+            size += file_size
+        self.reserved_bytes += size
+        return site, paths, futures, size
+
+    def result(self, path: str, future) -> Optional[bytes]:
+        start_time = time.perf_counter()
+        data, read_time = future.result()
+        wait_time = time.perf_counter() - start_time
+        self.files += 1
+        self.total_read_time += read_time
+        self.total_wait_time += wait_time
+        if self.record_files:
+            self.read_times[path] = read_time
+            self.wait_times[path] = wait_time
+        return data
+
+    def hidden_fraction(self) -> float:
+        """Share of the read time the caller did not have to wait for."""
+        if not self.total_read_time:
+            return 0.0
+        return max(1 - self.total_wait_time / self.total_read_time, 0.0)
+
+    def summary(self) -> str:
+        return (f"Read-ahead: {self.files} files, {self.total_read_time:.1f} s reading, "
+                f"{self.total_wait_time:.1f} s waiting ({self.hidden_fraction():.1%} of the read time hidden)")
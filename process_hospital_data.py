@@ -1,15 +1,20 @@
 import os
 import pandas as pd
-from collections import defaultdict
 import argparse
 import logging
-from extract_from_xml import get_hospital_statistic, get_clinic_data
+from typing import Iterable, List, Optional, Tuple
+from extract_from_xml import get_hospital_statistics, get_clinic_data
 from config import (
-    DEFAULT_YEAR, DATA_DIR, OUTPUT_DIR, COLUMN_NAMES, 
-    DAS_FILE_SUFFIX, XML_FILE_SUFFIX, PROGRESS_INTERVAL, NOT_ENOUGH_BIRTHS_MARKER, LOG_FORMAT
+    DEFAULT_YEAR, DATA_DIR, OUTPUT_DIR, TARGET_VALUE,
+    DAS_FILE_SUFFIX, XML_FILE_SUFFIX, PROGRESS_INTERVAL, LOG_FORMAT, CHECKPOINT_FILE, PREFETCH_DEPTH, VALIDATION_FILE
 )
-from get_gps_coordinates import get_coordinates_from_clinic_data
-from create_kml import create_kml_from_csv
+from checkpoint import CheckpointJournal
+from records import HospitalRecord, HospitalTableBuilder, PRIVACY_FLAG
+from outputs import write_validated_outputs
+from validation import ValidationError
+from sharding import parse_shard, shard_of, write_partial, read_partials
+from get_gps_coordinates import geocode_addresses, get_cache_key, get_cache
+from prefetch import ReportFiles, ReportPrefetcher
 
 def setup_logger(logfile):
     """Setup logging configuration"""
@@ -21,122 +26,209 @@ def setup_logger(logfile):
     )
 
 
-# =========================
-# Argument Parsing
-# =========================
-
-def main(year:int) -> None:
-    # =========================
-    # Paths & Data Structures
-    # =========================
+def list_sites(year: int) -> Optional[List[Tuple[str, str]]]:
+    """
+    Collect (IK, Standortnummer) of all hospital sites of a year from the filenames.
+    The files are sorted, so that every machine processes the sites in the same order.
+    Returns None if the data directory cannot be read.
+    """
     mypath = os.path.join(DATA_DIR, f"xml_{year}")
-    os.makedirs(os.path.join(OUTPUT_DIR, str(year)), exist_ok=True)
-    
-
     try:
-        all_files = [f for f in os.listdir(mypath) if os.path.isfile(os.path.join(mypath, f))]
+        all_files = sorted(f for f in os.listdir(mypath) if os.path.isfile(os.path.join(mypath, f)))
     except FileNotFoundError:
         logging.error(f"Data directory for year {year} not found: {mypath}")
-        return
+        return None
     except Exception as e:
         logging.error(f"Error reading files from {mypath}: {e}")
-        return
-    result_dict = defaultdict(list)
-    IK_list = []
-    Standortnummer_list = []
+        return None
+    return [(file.split("-")[0], file.split("-")[1]) for file in all_files if file.endswith(DAS_FILE_SUFFIX)]
+
+
+def extract_site(IK: str, Standortnummer: str, year: int, files: Optional[ReportFiles] = None) -> Optional[HospitalRecord]:
+    """Extract the statistics and contact data of one hospital site, without coordinates.
+    The report files are read from the data directory unless their prefetched contents are given.
+    Returns None if the site has no statistics to report."""
+    if files is None:  # Read both files from the data directory
+        das = xml = None
+        xml_path = os.path.join(DATA_DIR, f"xml_{year}", f"{IK}-{Standortnummer}-{year}-{XML_FILE_SUFFIX}")
+        has_xml = os.path.isfile(xml_path)
+    else:
+        das, xml = files
+        has_xml = xml is not None
+    statistics = get_hospital_statistics(IK, Standortnummer, year, data=das)
+    if statistics[TARGET_VALUE][0] is None:  # No statistics to report
+        return None
+    if not has_xml:
+        logging.warning(f"No corresponding file ending in {XML_FILE_SUFFIX} found for hospital "
+                        f"with IK {IK} and Standortnummer {Standortnummer}")
+        return None
+    clinic_data = get_clinic_data(IK, Standortnummer, year, data=xml)
+    return HospitalRecord.from_extraction(IK, Standortnummer, statistics, clinic_data, None)
+
+
+def clinic_address(record: HospitalRecord) -> dict:
+    return {
+        "city": record.city,
+        "street": record.street,
+        "postalcode": record.postal_code
+    }
+
+
+def geocode_records(records: List[HospitalRecord]) -> None:
+    """Add coordinates to the records, looking up every distinct address only once."""
+    coordinates = geocode_addresses(clinic_address(record) for record in records)
+    for record in records:
+        coords = coordinates[get_cache_key(clinic_address(record))]
+        record.latitude, record.longitude = coords if coords else (None, None)
+
+
+def process_site(IK: str, Standortnummer: str, year: int) -> Optional[HospitalRecord]:
+    """Extract and geocode one hospital site. Returns None if the site has no statistics to report."""
+    record = extract_site(IK, Standortnummer, year)
+    if record is not None:
+        geocode_records([record])
+    return record
+
+
+def write_results(table: pd.DataFrame, year: int, formats: Optional[Iterable[str]] = None) -> bool:
+    """Write the outputs of a year; the map files only if the results pass the plausibility checks.
+    Returns False if an output could not be written or the map files were held back."""
+    try:
+        return write_validated_outputs(table, year, formats)
+    except ValidationError as e:
+        logging.error(f"Map files of {year} not written: {e}")
+        print(f"Map files of {year} not written: {e}")
+        print(f"   Violations saved to: {os.path.join(OUTPUT_DIR, str(year), VALIDATION_FILE)}")
+        return False
+
+
+def report_completion(table: pd.DataFrame, year: int) -> None:
+    """Log final statistics"""
+    total_processed = len(table)
+    privacy_protected = int(table[PRIVACY_FLAG].sum())
+    logging.info(f"Processing completed: {total_processed} hospitals total, {privacy_protected} hospitals of those with not enough births to report statistics")
+    print(f"Processing completed successfully!")
+    print(f"   {total_processed} hospitals processed")
+    print(f"   {privacy_protected} hospitals with not enough births to report statistics")
+    print(f"   Output saved to: {OUTPUT_DIR}/{year}")
+
+
+def main(year:int, resume: bool = False, shard: Optional[Tuple[int, int]] = None,
+         formats: Optional[Iterable[str]] = None, prefetch_depth: int = PREFETCH_DEPTH) -> bool:
+    """
+    Process all hospital sites of a year and write the outputs (default: all registered formats).
+    With shard=(i, n), only the i-th of n shards is processed and written as partial result for merge().
+    The report files of the next prefetch_depth sites are read ahead while a site is parsed (0 disables it).
+    Returns False if the data could not be read or an output could not be written.
+    """
+    # =========================
+    # Paths & Data Structures
+    # =========================
+    os.makedirs(os.path.join(OUTPUT_DIR, str(year)), exist_ok=True)
+    sites = list_sites(year)
+    if sites is None:
+        return False
+    total_sites = len(sites)
+    checkpoint_file = CHECKPOINT_FILE
+    if shard is not None:
+        shard_index, shard_count = shard
+        checkpoint_file = f"{shard_index}-of-{shard_count}-{CHECKPOINT_FILE}"
+    positions = []
 
     ###############################
     # Main Data Extraction Process
     ###############################
-    # Collect IK and Standortnummer from filenames
-    for file in all_files:
-        if file.endswith(DAS_FILE_SUFFIX):
-            IK_list.append(file.split("-")[0])
-            Standortnummer_list.append(file.split("-")[1])
-
-    # Process each hospital
-    for idx, (IK, Standortnummer) in enumerate(zip(IK_list, Standortnummer_list)):
-        if idx % PROGRESS_INTERVAL == 0:
-            print(f"Working on Hospital {idx + 1} of {len(IK_list)}")
-        total_births, num_csections, rate = get_hospital_statistic(IK, Standortnummer, year)
-        if total_births is not None:  # Enough births occured to report statistics 
-            xml_path = os.path.join(DATA_DIR, f"xml_{year}", f"{IK}-{Standortnummer}-{year}-{XML_FILE_SUFFIX}")
-            if os.path.isfile(xml_path):
-                name_hospital, town, street, zip_code = get_clinic_data(IK, Standortnummer, year)
-                coordinates = get_coordinates_from_clinic_data({
-                    "city": town,
-                    "street": street,
-                    "postalcode": zip_code
-                })
-                result_dict[COLUMN_NAMES["hospital_name"]].append(name_hospital)
-                result_dict[COLUMN_NAMES["city"]].append(town)
-                result_dict[COLUMN_NAMES["street_address"]].append(street)
-                result_dict[COLUMN_NAMES["postal_code"]].append(zip_code)
-                result_dict[f"{COLUMN_NAMES['total_births']} {year}"].append(total_births)
-                result_dict[f"{COLUMN_NAMES['csections']} {year}"].append(num_csections)
-                result_dict[f"{COLUMN_NAMES['csection_rate']} {year}"].append(rate)
-                result_dict[COLUMN_NAMES["ik"]].append(IK)
-                result_dict[COLUMN_NAMES["location_number"]].append(Standortnummer)
-                result_dict["Latitude"].append(coordinates[0])
-                result_dict["Longitude"].append(coordinates[1])
-            else:
-                logging.warning(f"No corresponding file ending in {XML_FILE_SUFFIX} found for hospital "
-                                f"with IK {IK} and Standortnummer {Standortnummer}")
+    # Extract each hospital, skipping those completed by an interrupted earlier run
+    journal = CheckpointJournal(os.path.join(OUTPUT_DIR, str(year), checkpoint_file), resume=resume)
+    if shard is not None:
+        sites = [(idx, site) for idx, site in enumerate(sites) if shard_of(*site, shard_count) == shard_index]
+    else:
+        sites = list(enumerate(sites))
+    # The sites still to extract are fixed before the loop, which adds to the journal;
+    # their report files are read ahead in the same order
+    pending = [(idx, site) for idx, site in sites if site not in journal]
+    pending_positions = {idx for idx, _ in pending}
+    prefetcher = None
+    if prefetch_depth > 0:
+        prefetcher = ReportPrefetcher(year, [site for _, site in pending], depth=prefetch_depth)
+        prefetched = iter(prefetcher)
+    for idx, (IK, Standortnummer) in sites:
+        if idx not in pending_positions:
+            record = journal[(IK, Standortnummer)]
+        else:
+            if idx % PROGRESS_INTERVAL == 0:
+                print(f"Working on Hospital {idx + 1} of {total_sites}")
+            files = None
+            if prefetcher:
+                _, files = next(prefetched)
+            record = extract_site(IK, Standortnummer, year, files)
+            journal.write(IK, Standortnummer, record)
+        if record is not None:
+            positions.append((idx, record))
+    if prefetcher:
+        logging.info(prefetcher.summary())
+        print(prefetcher.summary())
+
+    # Geocode all distinct addresses at once; results are cached, so a resumed run does not repeat lookups
+    records = [record for _, record in positions]
+    geocode_records(records)
+    cache = get_cache()
+    print(f"Geocoding: {cache.hits} cache hits, {cache.misses} Nominatim lookups ({cache.hit_rate():.1%} hit rate)")
 
     ###############################
     # Output Results
     ###############################
-    try:
-        df = pd.DataFrame.from_dict(result_dict)
-        df.to_csv(os.path.join(OUTPUT_DIR, str(year), f"hospital_statistics.csv"))
-        
-        # Create KML file
-        create_kml_from_csv(df, year)
-        
-    except Exception as e:
-        logging.error(f"Error writing CSV file: {e}")
-        return
+    if shard is not None:
+        path = write_partial(year, shard_index, shard_count, positions)
+        journal.remove()
+        print(f"Shard {shard_index} of {shard_count} completed: {len(positions)} hospitals saved to {path}")
+        return True
 
-    keys = [COLUMN_NAMES["hospital_name"], COLUMN_NAMES["city"], COLUMN_NAMES["street_address"], 
-            COLUMN_NAMES["postal_code"], f"{COLUMN_NAMES['total_births']} {year}",
-            f"{COLUMN_NAMES['csections']} {year}", f"{COLUMN_NAMES['csection_rate']} {year}", 
-            COLUMN_NAMES["ik"], COLUMN_NAMES["location_number"]]
+    builder = HospitalTableBuilder(capacity=len(records), year=year)
+    for record in records:
+        builder.append(record)
+    table = builder.to_frame()
+    if not write_results(table, year, formats):
+        return False
+    journal.remove()
+    report_completion(table, year)
+    return True
 
-    num_hospitals = len(result_dict[keys[0]])
-    try:
-        with open(os.path.join(OUTPUT_DIR, str(year), f"full_list.txt"), "w") as f:
-            for hospital_num in range(num_hospitals):
-                line = "  -  ".join([f"{key}: {result_dict[key][hospital_num]}" for key in keys])
-                f.write(line + "\n")
-    except Exception as e:
-        logging.error(f"Error writing full_list file: {e}")
-        return
 
+def merge(year: int) -> None:
+    """Combine the partial results of all shards of a year into the same outputs as a single-node run."""
     try:
-        with open(os.path.join(OUTPUT_DIR, str(year), f"hospital_statistics.txt"), "w") as f:
-            for hospital_num in range(num_hospitals):
-                if not result_dict[f"{COLUMN_NAMES['csection_rate']} {year}"][hospital_num] == NOT_ENOUGH_BIRTHS_MARKER:
-                    line = "  -  ".join([f"{key}: {result_dict[key][hospital_num]}" for key in keys])
-                    f.write(line + "\n")
-    except Exception as e:
-        logging.error(f"Error writing hospital_statistics file: {e}")
+        records = read_partials(year)
+    except (FileNotFoundError, ValueError) as e:
+        logging.error(f"Cannot merge the partial results of {year}: {e}")
+        print(f"Cannot merge the partial results of {year}: {e}")
         return
-    
-    # Log final statistics
-    total_processed = len(result_dict[COLUMN_NAMES["hospital_name"]])
-    privacy_protected = sum(1 for rate in result_dict[f"{COLUMN_NAMES['csection_rate']} {year}"] 
-                           if rate == NOT_ENOUGH_BIRTHS_MARKER)
-    logging.info(f"Processing completed: {total_processed} hospitals total, {privacy_protected} hospitals of those with not enough births to report statistics")
-    print(f"Processing completed successfully!")
-    print(f"   {total_processed} hospitals processed")
-    print(f"   {privacy_protected} hospitals with not enough births to report statistics")
-    print(f"   Output saved to: {OUTPUT_DIR}/{year}")
+    builder = HospitalTableBuilder(capacity=len(records), year=year)
+    for record in records:
+        builder.append(record)
+    table = builder.to_frame()
+    if write_results(table, year):
+        report_completion(table, year)
+
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Process C-section rates by year.")
     parser.add_argument("--year", type=int, default=DEFAULT_YEAR, help="Year to process")
+    parser.add_argument("--resume", action="store_true",
+                        help="Continue an interrupted run from its checkpoint journal")
+    parser.add_argument("--shard", type=parse_shard, metavar="i/n",
+                        help="Only process the i-th of n shards (1 <= i <= n) and write a partial result")
+    parser.add_argument("--merge", action="store_true",
+                        help="Combine the partial results of all shards into the final outputs")
+    parser.add_argument("--prefetch-depth", type=int, default=PREFETCH_DEPTH,
+                        help="Number of sites whose report files are read ahead (0 disables the read-ahead)")
     args = parser.parse_args()
     year = args.year
     os.makedirs(f'output/{year}', exist_ok=True)
-    setup_logger(f'output/{year}/process_hospital_data.log')
-    main(year)
+    if args.merge:
+        setup_logger(f'output/{year}/merge_hospital_data.log')
+        merge(year)
+    else:
+        suffix = f"_shard_{args.shard[0]}_of_{args.shard[1]}" if args.shard else ""
+        setup_logger(f'output/{year}/process_hospital_data{suffix}.log')
+        main(year, resume=args.resume, shard=args.shard, prefetch_depth=args.prefetch_depth)
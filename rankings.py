@@ -0,0 +1,333 @@
+"""
+rankings.py
+Percentile ranks and nearest-ward comparisons of the hospitals of a year, computed once and stored in
+output/{year}/hospital_rankings.csv, so that the KML balloons and the report read them instead of comparing
+every hospital to all others on their own.
+The hospital table is read in chunks, twice: the first pass counts the rates and spools the hospitals with
+coordinates to a temporary file, the second ranks every chunk against those counts and that file. Memory does
+not grow with the number of hospitals, and batch and streaming runs store the same rankings.
+"""
+import os
+import math
+import argparse
+import logging
+import tempfile
+from collections import Counter, defaultdict
+from typing import BinaryIO, Callable, Iterable, Iterator, Optional, Tuple
+import numpy as np
+import pandas as pd
+from config import (
+    DEFAULT_YEAR, OUTPUT_DIR, COLUMN_NAMES, NOT_ENOUGH_BIRTHS_MARKER, KNN_NEIGHBORS, RANKINGS_FILE, STATES,
+    STREAM_CHUNK_SIZE
+)
+from file_utils import atomic_open
+
+# Columns of the rankings table
+STATE = "Bundesland"
+NATIONAL_PERCENTILE = "Perzentil national"  # Share of the hospitals with the same or a lower rate, in percent
+STATE_PERCENTILE = "Perzentil Bundesland"
+NEIGHBOR_SITES = "Nächste Geburtskliniken"  # IK-Standortnummer of the nearest wards, separated by ";"
+NEIGHBOR_RATES = "Kaiserschnitt % Nachbarn"
+NEIGHBOR_DISTANCES = "Entfernung Nachbarn km"
+NEIGHBOR_MEAN = "Kaiserschnitt % Nachbarn Mittel"
+RANKING_COLUMNS = [STATE, NATIONAL_PERCENTILE, STATE_PERCENTILE, NEIGHBOR_SITES, NEIGHBOR_RATES,
+                   NEIGHBOR_DISTANCES, NEIGHBOR_MEAN]
+NEIGHBOR_LIST_COLUMNS = [NEIGHBOR_SITES, NEIGHBOR_RATES, NEIGHBOR_DISTANCES]
+LIST_SEPARATOR = ";"
+
+EARTH_RADIUS_KM = 6371.0
+DISTANCE_BLOCK = 2**18  # Entries of the distance matrix held in memory at once
+# Hospitals with statistics and coordinates, as spooled for the nearest-ward search
+POINT_DTYPE = np.dtype([("site", "S32"), ("rate", "<f8"), ("latitude", "<f8"), ("longitude", "<f8")])
+
+Chunks = Callable[[], Iterable[pd.DataFrame]]  # The hospital table of a year in chunks, the same on every call
+
+
+def rankings_path(year: int) -> str:
+    return os.path.join(OUTPUT_DIR, str(year), RANKINGS_FILE)
+
+
+def ranking_keys() -> list:
+    return [COLUMN_NAMES["ik"], COLUMN_NAMES["location_number"]]
+
+
+def hospital_rates(df: pd.DataFrame, year: int) -> pd.Series:
+    """Numeric rate in percent of the hospitals that report statistics, NaN for all others."""
+    rate_column = f"{COLUMN_NAMES['csection_rate']} {year}"
+    births = pd.to_numeric(df[f"{COLUMN_NAMES['total_births']} {year}"], errors="coerce")
+    csections = pd.to_numeric(df[f"{COLUMN_NAMES['csections']} {year}"], errors="coerce")
+    rates = pd.to_numeric(df[rate_column].where(df[rate_column] != NOT_ENOUGH_BIRTHS_MARKER), errors="coerce")
+    return rates.where(births.notna() & csections.notna() & (births > 0))
+
+
+def hospital_states(df: pd.DataFrame) -> pd.Series:
+    """Federal state of every hospital, from digits 3 and 4 of its IK; NaN if they name no state."""
+    return df[COLUMN_NAMES["ik"]].astype(str).str[2:4].map(STATES)
+
+
+def hospital_points(df: pd.DataFrame, year: int) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    The hospitals of a table that have statistics and coordinates, as POINT_DTYPE records,
+    and the mask selecting them.
+    """
+    rates = hospital_rates(df, year)
+    latitudes = pd.to_numeric(df["Latitude"], errors="coerce") if "Latitude" in df.columns else rates * np.nan
+    longitudes = pd.to_numeric(df["Longitude"], errors="coerce") if "Longitude" in df.columns else rates * np.nan
+    located = (rates.notna() & latitudes.notna() & longitudes.notna() & (latitudes != 0) & (longitudes != 0)).to_numpy()
+    sites = (df[COLUMN_NAMES["ik"]].astype(str) + "-" + df[COLUMN_NAMES["location_number"]].astype(str))[located]
+    sites = sites.str.encode("utf-8")
+    if (sites.str.len() > POINT_DTYPE["site"].itemsize).any():
+        raise ValueError(f"IK and Standortnummer longer than {POINT_DTYPE['site'].itemsize} bytes")
+    points = np.empty(int(located.sum()), dtype=POINT_DTYPE)
+    points["site"] = sites.to_numpy(dtype=object)
+    points["rate"] = rates[located].to_numpy(dtype=float)
+    points["latitude"] = latitudes[located].to_numpy(dtype=float)
+    points["longitude"] = longitudes[located].to_numpy(dtype=float)
+    return points, located
+
+
+class RateCounts:
+    """Number of hospitals per rate, from which percentiles are read without keeping every rate."""
+
+    def __init__(self):
+        self.counts = Counter()
+
+    def add(self, rates: np.ndarray) -> None:
+        self.counts.update(rates[~np.isnan(rates)].tolist())
+
+    def percentiles(self, rates: np.ndarray) -> np.ndarray:
+        """Share of the counted rates that are the same or lower, in percent rounded up; NaN for NaN rates."""
+        percentiles = np.full(len(rates), np.nan)
+        valid = ~np.isnan(rates)
+        if self.counts and valid.any():
+            values = np.array(sorted(self.counts))
+            at_most = np.cumsum([self.counts[value] for value in values])
+            positions = np.searchsorted(values, rates[valid], side="right") - 1
+            percentiles[valid] = np.ceil(at_most[positions] / at_most[-1] * 100)
+        return percentiles
+
+
+# =========================
+# Nearest wards
+# =========================
+def haversines(latitudes: np.ndarray, longitudes: np.ndarray, point_latitudes: np.ndarray,
+               point_longitudes: np.ndarray) -> np.ndarray:
+    """
+    Haversine of the central angle from every point of the first arrays (rows) to every point of the second.
+    It grows with the distance, so the nearest points are found without converting all of them to km.
+    """
+    phi, lam = np.radians(latitudes)[:, None], np.radians(longitudes)[:, None]
+    point_phi, point_lam = np.radians(point_latitudes)[None, :], np.radians(point_longitudes)[None, :]
+    return (np.sin((phi - point_phi) / 2) ** 2
+            + np.cos(phi) * np.cos(point_phi) * np.sin((lam - point_lam) / 2) ** 2)
+
+
+def haversine_km(haversine: np.ndarray) -> np.ndarray:
+    """Great-circle distance in km of a haversine."""
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(np.clip(haversine, 0, 1)))
+
+
+def smallest(distances: np.ndarray, sites: np.ndarray, k: int) -> np.ndarray:
+    """Column indices of the k smallest distances of every row; ties at the k-th distance go to the lower site."""
+    candidates = np.argpartition(distances, k - 1, axis=1)[:, :k]
+    kth = np.take_along_axis(distances, candidates, axis=1).max(axis=1)
+    tied = np.flatnonzero((distances <= kth[:, None]).sum(axis=1) > k)
+    if len(tied):  # Rows with more than k distances up to the k-th are sorted in full, all at once
+        candidates[tied] = np.lexsort((np.broadcast_to(sites, (len(tied), len(sites))), distances[tied]), axis=1)[:, :k]
+    return candidates
+
+
+def nearest_in_blocks(queries: np.ndarray, positions: np.ndarray, blocks: Iterable[np.ndarray], k: int):
+    """
+    The k nearest points of the query points among all points, given in consecutive blocks,
+    keeping only the best k of every query point between two blocks. Returns them with their haversines.
+    """
+    best = np.zeros((len(queries), k), dtype=POINT_DTYPE)
+    best_haversines = np.full((len(queries), k), np.inf)
+    offset = 0
+    for block in blocks:
+        block_haversines = haversines(queries["latitude"], queries["longitude"], block["latitude"], block["longitude"])
+        own = (positions >= offset) & (positions < offset + len(block))
+        block_haversines[np.flatnonzero(own), positions[own] - offset] = np.inf  # Not its own neighbor
+        offset += len(block)
+        candidates = smallest(block_haversines, block["site"], min(k, len(block)))
+        merged = np.concatenate([best, block[candidates]], axis=1)
+        merged_haversines = np.concatenate([best_haversines, np.take_along_axis(block_haversines, candidates, axis=1)],
+                                           axis=1)
+        order = np.lexsort((merged["site"], merged_haversines), axis=1)[:, :k]
+        best = np.take_along_axis(merged, order, axis=1)
+        best_haversines = np.take_along_axis(merged_haversines, order, axis=1)
+    return best, best_haversines
+
+
+def nearest_points(queries: np.ndarray, positions: np.ndarray, read_points: Callable[[int], Iterator[np.ndarray]],
+                   k: int) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    The k nearest other points of every query point and their great-circle distances in km, nearest first.
+    Points at the same distance are ordered by site, so the result does not depend on the order of the points.
+    queries are POINT_DTYPE records at the given positions among all points; read_points(size) returns all
+    points in blocks of that size. Distances are computed for blocks of query points and points with at most
+    DISTANCE_BLOCK entries, so memory stays the same however many points there are.
+    """
+    row_block = max(math.isqrt(DISTANCE_BLOCK), 1)
+    column_block = max(DISTANCE_BLOCK // row_block, 1)
+    neighbors = np.empty((len(queries), k), dtype=POINT_DTYPE)
+    distances = np.empty((len(queries), k))
+    for start in range(0, len(queries), row_block):
+        rows = slice(start, start + row_block)
+        neighbors[rows], distances[rows] = nearest_in_blocks(queries[rows], positions[rows],
+                                                             read_points(column_block), k)
+    return neighbors, haversine_km(distances)
+
+
+def nearest_neighbors(latitudes: np.ndarray, longitudes: np.ndarray, k: int):
+    """
+    Indices and great-circle distances in km of the k nearest other points of every point, nearest first
+    and equally distant points by index.
+    """
+    n = len(latitudes)
+    k = min(k, n - 1)
+    if k <= 0:
+        return np.empty((n, 0), dtype=int), np.empty((n, 0))
+    points = np.zeros(n, dtype=POINT_DTYPE)
+    points["site"] = [str(index).zfill(len(str(n))).encode() for index in range(n)]
+    points["latitude"], points["longitude"] = latitudes, longitudes
+    neighbors, distances = nearest_points(points, np.arange(n), lambda size: (
+        points[start:start + size] for start in range(0, n, size)), k)
+    return neighbors["site"].astype(int), distances
+
+
+def read_spool(spool: BinaryIO, size: int) -> Iterator[np.ndarray]:
+    """The points spooled to a file, in blocks of size points."""
+    spool.seek(0)
+    while True:
+        block = np.frombuffer(spool.read(size * POINT_DTYPE.itemsize), dtype=POINT_DTYPE)
+        if not len(block):
+            return
+        yield block
+
+
+# =========================
+# Rankings
+# =========================
+def join_values(values: np.ndarray, fmt: str) -> list:
+    return [LIST_SEPARATOR.join(fmt.format(value) for value in row) for row in values]
+
+
+def iter_rankings(chunks: Chunks, year: int, k: int = KNN_NEIGHBORS) -> Iterator[Tuple[pd.DataFrame, pd.DataFrame]]:
+    """
+    Rankings of all hospitals of a year, as (chunk, rankings of the chunk indexed like it) for every chunk of
+    the hospital table. Hospitals without statistics get no percentiles, those without coordinates no neighbors.
+    Neighbors are the k nearest other hospitals with statistics and coordinates.
+    """
+    national = RateCounts()
+    by_state = defaultdict(RateCounts)
+    with tempfile.TemporaryFile() as spool:
+        point_count = 0
+        for df in chunks():
+            rates, states = hospital_rates(df, year).to_numpy(dtype=float), hospital_states(df).to_numpy(dtype=object)
+            national.add(rates)
+            for state in pd.unique(states[pd.notna(states)]):
+                by_state[state].add(rates[states == state])
+            points, _ = hospital_points(df, year)
+            spool.write(points.tobytes())
+            point_count += len(points)
+        k = min(k, point_count - 1)
+
+        position = 0
+        for df in chunks():
+            rates, states = hospital_rates(df, year).to_numpy(dtype=float), hospital_states(df)
+            state_percentiles = np.full(len(df), np.nan)
+            for state in pd.unique(states[states.notna()]):
+                in_state = (states == state).to_numpy()
+                state_percentiles[in_state] = by_state[state].percentiles(rates[in_state])
+            rankings = pd.DataFrame({STATE: states}, index=df.index)
+            rankings[NATIONAL_PERCENTILE] = pd.array(national.percentiles(rates), dtype="Int64")
+            rankings[STATE_PERCENTILE] = pd.array(state_percentiles, dtype="Int64")
+            for column in NEIGHBOR_LIST_COLUMNS:
+                rankings[column] = pd.Series(None, index=df.index, dtype=object)
+            rankings[NEIGHBOR_MEAN] = np.nan
+
+            points, located = hospital_points(df, year)
+            positions = np.arange(position, position + len(points))
+            position += len(points)
+            if k > 0 and len(points):
+                neighbors, distances = nearest_points(points, positions, lambda size: read_spool(spool, size), k)
+                rankings.loc[located, NEIGHBOR_SITES] = [LIST_SEPARATOR.join(site.decode("utf-8") for site in row)
+                                                         for row in neighbors["site"]]
+                rankings.loc[located, NEIGHBOR_RATES] = join_values(neighbors["rate"], "{:.0f}")
+                rankings.loc[located, NEIGHBOR_DISTANCES] = join_values(distances, "{:.1f}")
+                rankings.loc[located, NEIGHBOR_MEAN] = neighbors["rate"].mean(axis=1).round(1)
+            yield df, rankings
+
+
+def compute_rankings(df: pd.DataFrame, year: int, k: int = KNN_NEIGHBORS) -> pd.DataFrame:
+    """Rankings of all hospitals of a year held in memory, indexed like df. See iter_rankings."""
+    (_, rankings), = iter_rankings(lambda: [df], year, k)
+    return rankings
+
+
+def add_rankings(df: pd.DataFrame, year: int) -> pd.DataFrame:
+    """Copy of the hospital table with the ranking columns, computed unless the table already has them."""
+    if all(column in df.columns for column in RANKING_COLUMNS):
+        return df
+    return df.join(compute_rankings(df, year))
+
+
+def read_rankings_csv(year: int, chunksize: Optional[int] = None):
+    """Read hospital_rankings.csv of a year. With chunksize, returns an iterator over frames of that many rows."""
+    return pd.read_csv(rankings_path(year), chunksize=chunksize,
+                       dtype={column: str for column in ranking_keys() + NEIGHBOR_LIST_COLUMNS})
+
+
+def join_rankings(df: pd.DataFrame, year: int, rankings: Optional[pd.DataFrame] = None) -> pd.DataFrame:
+    """
+    Copy of the hospital table with the ranking columns of hospital_rankings.csv of the year,
+    or of the given rows of it.
+    """
+    if rankings is None:
+        rankings = read_rankings_csv(year)
+    rankings = rankings.copy()
+    rankings[[NATIONAL_PERCENTILE, STATE_PERCENTILE]] = rankings[[NATIONAL_PERCENTILE, STATE_PERCENTILE]].astype("Int64")
+    for column in NEIGHBOR_LIST_COLUMNS:
+        rankings[column] = rankings[column].astype(object).where(rankings[column].notna(), None)
+    df = df.drop(columns=[column for column in RANKING_COLUMNS if column in df.columns])
+    return df.join(rankings.set_index(ranking_keys()), on=ranking_keys())
+
+
+def write_ranking_chunks(chunks: Chunks, year: int) -> str:
+    """Compute the rankings of a hospital table given in chunks and write them to output/{year}/hospital_rankings.csv."""
+    path = rankings_path(year)
+    count = 0
+    with atomic_open(path, "w", encoding="utf-8", newline="") as f:
+        for df, rankings in iter_rankings(chunks, year):
+            f.write(pd.concat([df[ranking_keys()], rankings], axis=1).to_csv(index=False, header=count == 0))
+            count += len(df)
+        if count == 0:
+            f.write(pd.DataFrame(columns=ranking_keys() + RANKING_COLUMNS).to_csv(index=False))
+    logging.info(f"Rankings of {count} hospitals written to {path}")
+    return path
+
+
+def write_rankings(df: pd.DataFrame, year: int) -> str:
+    """Compute the rankings of a hospital table and write them to output/{year}/hospital_rankings.csv."""
+    return write_ranking_chunks(lambda: [df], year)
+
+
+def write_year_rankings(year: int, chunk_size: int = STREAM_CHUNK_SIZE) -> str:
+    """Rank the hospitals of hospital_statistics.csv of a year, reading it chunk_size rows at a time."""
+    from analysis import read_statistics_csv  # analysis uses the rankings for its report
+    return write_ranking_chunks(lambda: read_statistics_csv(year, chunksize=chunk_size), year)
+
+
+def main(year: int) -> str:
+    path = write_year_rankings(year)
+    print(f"Rankings saved to: {path}")
+    return path
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Precompute percentile ranks and nearest maternity wards")
+    parser.add_argument("--year", type=int, default=DEFAULT_YEAR, help="Year to process")
+    args = parser.parse_args()
+    main(args.year)
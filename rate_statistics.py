@@ -0,0 +1,144 @@
+"""
+rate_statistics.py
+Batched interval estimates and funnel-plot control limits for hospital C-section rates.
+All functions operate on whole NumPy arrays, one entry per hospital.
+"""
+from statistics import NormalDist
+from typing import Optional, Tuple
+import numpy as np
+import pandas as pd
+from config import (
+    COLUMN_NAMES, CONFIDENCE_LEVEL, BOOTSTRAP_RESAMPLES, BOOTSTRAP_SEED, FUNNEL_LEVELS
+)
+
+# Column names of the statistics added by add_rate_statistics
+WILSON_LOW = "wilson_low"
+WILSON_HIGH = "wilson_high"
+FUNNEL_POSITION = "funnel_position"
+BOOTSTRAP_LOW = "bootstrap_low"
+BOOTSTRAP_HIGH = "bootstrap_high"
+
+
+def level_label(level: float) -> str:
+    """A control level in German notation, e.g. "99,8%"."""
+    return f"{level * 100:g}%".replace(".", ",")
+
+
+# Funnel positions, ordered from far below to far above the national rate, built from the configured levels
+FUNNEL_LABELS = {
+    **{-position: f"unter der {level_label(level)}-Kontrollgrenze"
+       for position, level in reversed(list(enumerate(FUNNEL_LEVELS, start=1)))},
+    0: "innerhalb der Kontrollgrenzen",
+    **{position: f"über der {level_label(level)}-Kontrollgrenze" for position, level in enumerate(FUNNEL_LEVELS, start=1)},
+}
+
+
+def z_value(level: float) -> float:
+    """Two-sided standard normal quantile for the given confidence level."""
+    return NormalDist().inv_cdf(0.5 + level / 2)
+
+
+def wilson_intervals(events: np.ndarray, totals: np.ndarray,
+                     level: float = CONFIDENCE_LEVEL) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Wilson score intervals for the proportions events / totals.
+    Returns (lower, upper) as arrays of proportions.
+    """
+    events = np.asarray(events, dtype=float)
+    totals = np.asarray(totals, dtype=float)
+    z = z_value(level)
+    p_hat = events / totals
+    denominator = 1 + z ** 2 / totals
+    center = (p_hat + z ** 2 / (2 * totals)) / denominator
+    half_width = z / denominator * np.sqrt(p_hat * (1 - p_hat) / totals + z ** 2 / (4 * totals ** 2))
+    return np.clip(center - half_width, 0, 1), np.clip(center + half_width, 0, 1)
+
+
+def bootstrap_intervals(events: np.ndarray, totals: np.ndarray, level: float = CONFIDENCE_LEVEL,
+                        n_resamples: int = BOOTSTRAP_RESAMPLES,
+                        seed: int = BOOTSTRAP_SEED) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Percentile bootstrap intervals for the proportions events / totals.
+    Resampling the births of a hospital with replacement is equivalent to drawing the number of
+    C-sections from Binomial(total, observed rate), so all resamples of all hospitals are drawn
+    as one (n_resamples x hospitals) matrix.
+    """
+    events = np.asarray(events, dtype=np.int64)
+    totals = np.asarray(totals, dtype=np.int64)
+    rng = np.random.default_rng(seed)
+    resampled = rng.binomial(totals, events / totals, size=(n_resamples, len(totals))) / totals
+    lower, upper = np.quantile(resampled, [(1 - level) / 2, (1 + level) / 2], axis=0)
+    return lower, upper
+
+
+def funnel_limits(totals: np.ndarray, national_rate: float,
+                  levels: Tuple[float, ...] = FUNNEL_LEVELS) -> np.ndarray:
+    """
+    Control limits around the national rate for hospitals of the given sizes.
+    Returns an array of shape (len(levels), 2, hospitals) holding the lower and upper limit per level.
+    """
+    totals = np.asarray(totals, dtype=float)
+    z = np.array([z_value(level) for level in levels])[:, None]
+    spread = z * np.sqrt(national_rate * (1 - national_rate) / totals)[None, :]
+    return np.clip(np.stack([national_rate - spread, national_rate + spread], axis=1), 0, 1)
+
+
+def funnel_positions(events: np.ndarray, totals: np.ndarray, national_rate: float,
+                     levels: Tuple[float, ...] = FUNNEL_LEVELS) -> np.ndarray:
+    """
+    Number of control limits (see FUNNEL_LABELS) a hospital lies above (positive) or below (negative).
+    """
+    rates = np.asarray(events, dtype=float) / np.asarray(totals, dtype=float)
+    limits = funnel_limits(totals, national_rate, levels)
+    above = (rates[None, :] > limits[:, 1, :]).sum(axis=0)
+    below = (rates[None, :] < limits[:, 0, :]).sum(axis=0)
+    return above - below
+
+
+def get_counts(df: pd.DataFrame, year: int) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Numeric births and C-section counts of a hospital table.
+    Returns (births, csections, valid), where valid masks out privacy-protected and malformed rows.
+    """
+    births = pd.to_numeric(df[f"{COLUMN_NAMES['total_births']} {year}"], errors='coerce').to_numpy(dtype=float)
+    csections = pd.to_numeric(df[f"{COLUMN_NAMES['csections']} {year}"], errors='coerce').to_numpy(dtype=float)
+    valid = ~np.isnan(births) & ~np.isnan(csections) & (births > 0)
+    return births, csections, valid
+
+
+def national_rate(df: pd.DataFrame, year: int) -> float:
+    """Pooled C-section rate over all hospitals that report statistics."""
+    births, csections, valid = get_counts(df, year)
+    return csections[valid].sum() / births[valid].sum()
+
+
+def add_rate_statistics(df: pd.DataFrame, year: int, bootstrap: bool = False,
+                        pooled_rate: Optional[float] = None) -> pd.DataFrame:
+    """
+    Return a copy of the hospital table with Wilson intervals and funnel positions added.
+    Bootstrap intervals are only computed on request, as they are the expensive part.
+    The funnel positions compare to pooled_rate, by default the national rate of the table itself;
+    pass it for tables holding only part of the hospitals of a year.
+    Rows without statistics get NaN.
+    """
+    births, csections, valid = get_counts(df, year)
+    df = df.copy()
+    df[WILSON_LOW] = np.nan
+    df[WILSON_HIGH] = np.nan
+    df[FUNNEL_POSITION] = np.nan
+    if not valid.any():
+        return df
+
+    low, high = wilson_intervals(csections[valid], births[valid])
+    df.loc[valid, WILSON_LOW] = low
+    df.loc[valid, WILSON_HIGH] = high
+    if pooled_rate is None:
+        pooled_rate = csections[valid].sum() / births[valid].sum()
+    df.loc[valid, FUNNEL_POSITION] = funnel_positions(csections[valid], births[valid], pooled_rate)
+    if bootstrap:
+        df[BOOTSTRAP_LOW] = np.nan
+        df[BOOTSTRAP_HIGH] = np.nan
+        low, high = bootstrap_intervals(csections[valid], births[valid])
+        df.loc[valid, BOOTSTRAP_LOW] = low
+        df.loc[valid, BOOTSTRAP_HIGH] = high
+    return df
@@ -0,0 +1,210 @@
+"""
+records.py
+Typed record of one hospital site and a columnar builder that gathers the records of a year
+into a compact DataFrame.
+"""
+import logging
+from typing import Iterable, List, Optional, Tuple
+import numpy as np
+import pandas as pd
+from config import COLUMN_NAMES, NOT_ENOUGH_BIRTHS_MARKER, TARGET_VALUE, INDICATORS
+
+PRIVACY_FLAG = "privacy_protected"  # Column of the compact table marking privacy-protected statistics
+
+
+def parse_count(value, ik: str, site_identifier: str) -> Optional[int]:
+    """Convert a count from the xml files to int, or None if it is missing or malformed."""
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        logging.warning(f"Invalid count [[{value}]] for hospital with IK {ik} and Standortnummer {site_identifier}")
+        return None
+
+
+def parse_statistic(statistic: Tuple, ik: str, site_identifier: str) -> Tuple[Optional[int], Optional[int], Optional[int], bool]:
+    """Convert (case count, observed events, rate) from the xml files to (total, events, rate, privacy_protected)."""
+    total, events, rate = statistic
+    if total == NOT_ENOUGH_BIRTHS_MARKER:
+        return None, None, None, True
+    if total is None:
+        return None, None, None, False
+    return parse_count(total, ik, site_identifier), parse_count(events, ik, site_identifier), rate, False
+
+
+class HospitalRecord:
+    """
+    Extraction result of one hospital site.
+    The births and C-sections indicator (TARGET_VALUE) has its own fields, further indicators of
+    config.INDICATORS are kept in indicators as {Ergebnis_ID: (total, events, rate, privacy_protected)}.
+    """
+    __slots__ = ("ik", "location_number", "name", "city", "street", "postal_code",
+                 "total_births", "csections", "rate", "privacy_protected", "latitude", "longitude", "indicators")
+
+    def __init__(self, ik: str, location_number: str, name: Optional[str], city: Optional[str],
+                 street: Optional[str], postal_code: Optional[str], total_births: Optional[int],
+                 csections: Optional[int], rate: Optional[int], privacy_protected: bool,
+                 latitude: Optional[float], longitude: Optional[float], indicators: Optional[dict] = None):
+        self.ik = ik
+        self.location_number = location_number
+        self.name = name
+        self.city = city
+        self.street = street
+        self.postal_code = postal_code
+        self.total_births = total_births
+        self.csections = csections
+        self.rate = rate
+        self.privacy_protected = privacy_protected
+        self.latitude = latitude
+        self.longitude = longitude
+        self.indicators = indicators or {}
+
+    @classmethod
+    def from_extraction(cls, ik: str, location_number: str, statistics: dict, clinic_data: Tuple,
+                        coordinates: Optional[Tuple[float, float]]) -> "HospitalRecord":
+        """
+        Build a record from the return values of get_hospital_statistics, get_clinic_data
+        and get_coordinates_from_clinic_data.
+        """
+        name, city, street, postal_code = clinic_data
+        latitude, longitude = coordinates if coordinates else (None, None)
+        total_births, csections, rate, privacy_protected = parse_statistic(statistics[TARGET_VALUE], ik, location_number)
+        indicators = {indicator: parse_statistic(statistic, ik, location_number)
+                      for indicator, statistic in statistics.items() if indicator != TARGET_VALUE}
+        return cls(ik, location_number, name, city, street, postal_code, total_births, csections, rate,
+                   privacy_protected, latitude, longitude, indicators)
+
+    def to_dict(self) -> dict:
+        return {field: getattr(self, field) for field in self.__slots__}
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "HospitalRecord":
+        data = dict(data)
+        data["indicators"] = {indicator: tuple(statistic) for indicator, statistic in (data.get("indicators") or {}).items()}
+        return cls(**data)
+
+    def __repr__(self) -> str:
+        return f"HospitalRecord(ik={self.ik!r}, location_number={self.location_number!r}, name={self.name!r})"
+
+
+def ordered_indicators(indicators: Iterable[str] = INDICATORS) -> List[str]:
+    """TARGET_VALUE first, then the further indicators in configuration order."""
+    return [TARGET_VALUE] + [indicator for indicator in indicators if indicator != TARGET_VALUE]
+
+
+def indicator_columns(indicator: str, year: int) -> List[str]:
+    """Output columns of the case count, observed events and rate of an indicator."""
+    columns = INDICATORS[indicator]
+    return [f"{columns['total']} {year}", f"{columns['events']} {year}", f"{columns['rate']} {year}"]
+
+
+def privacy_column(indicator: str) -> str:
+    """Column of the compact table marking privacy-protected statistics of an indicator."""
+    return PRIVACY_FLAG if indicator == TARGET_VALUE else f"{PRIVACY_FLAG} {indicator}"
+
+
+def record_statistic(record: HospitalRecord, indicator: str) -> Tuple[Optional[int], Optional[int], Optional[int], bool]:
+    """(total, events, rate, privacy_protected) of one indicator of a record."""
+    if indicator == TARGET_VALUE:
+        return record.total_births, record.csections, record.rate, record.privacy_protected
+    return record.indicators.get(indicator, (None, None, None, False))
+
+
+class HospitalTableBuilder:
+    """
+    Gathers HospitalRecords into preallocated columns.
+    Counts and rates are stored as int32 with a missing-value mask, privacy protection as a bool flag,
+    with one such column group per indicator.
+    """
+
+    def __init__(self, capacity: int, year: int, indicators: Iterable[str] = INDICATORS):
+        self.year = year
+        self.size = 0
+        self.indicators = ordered_indicators(indicators)
+        self.text = {field: np.empty(capacity, dtype=object)
+                     for field in ("name", "city", "street", "postal_code", "ik", "location_number")}
+        self.counts = {(indicator, field): np.zeros(capacity, dtype=np.int32)
+                       for indicator in self.indicators for field in range(3)}
+        self.missing = {key: np.ones(capacity, dtype=bool) for key in self.counts}
+        self.privacy_protected = {indicator: np.zeros(capacity, dtype=bool) for indicator in self.indicators}
+        self.coordinates = {field: np.full(capacity, np.nan) for field in ("latitude", "longitude")}
+
+    def __len__(self) -> int:
+        return self.size
+
+    def append(self, record: HospitalRecord) -> None:
+        if self.size == len(self.coordinates["latitude"]):
+            self._grow()
+        i = self.size
+        for field, column in self.text.items():
+            column[i] = getattr(record, field)
+        for indicator in self.indicators:
+            statistic = record_statistic(record, indicator)
+            for field in range(3):
+                if statistic[field] is not None:
+                    self.counts[(indicator, field)][i] = statistic[field]
+                    self.missing[(indicator, field)][i] = False
+            self.privacy_protected[indicator][i] = statistic[3]
+        for field, column in self.coordinates.items():
+            value = getattr(record, field)
+            if value is not None:
+                column[i] = value
+        self.size += 1
+
+    def _grow(self) -> None:
+        """Double the capacity, for callers that cannot tell the number of records in advance."""
+        capacity = max(2 * len(self.coordinates["latitude"]), 1)
+        def grown(column, fill):
+            new_column = np.full(capacity, fill, dtype=column.dtype)
+            new_column[:len(column)] = column
+            return new_column
+        self.text = {field: grown(column, None) for field, column in self.text.items()}
+        self.counts = {key: grown(column, 0) for key, column in self.counts.items()}
+        self.missing = {key: grown(column, True) for key, column in self.missing.items()}
+        self.privacy_protected = {key: grown(column, False) for key, column in self.privacy_protected.items()}
+        self.coordinates = {field: grown(column, np.nan) for field, column in self.coordinates.items()}
+
+    def to_frame(self) -> pd.DataFrame:
+        """
+        The compact table, in the column order of hospital_statistics.csv plus the privacy flags.
+        Counts and rates are nullable Int32, the city is categorical.
+        """
+        n, year = self.size, self.year
+        def text(field):
+            return pd.Series(self.text[field][:n], dtype=object)
+        columns = {
+            COLUMN_NAMES["hospital_name"]: text("name"),
+            COLUMN_NAMES["city"]: pd.Categorical(self.text["city"][:n]),
+            COLUMN_NAMES["street_address"]: text("street"),
+            COLUMN_NAMES["postal_code"]: text("postal_code"),
+        }
+        for indicator in self.indicators:
+            for field, column in enumerate(indicator_columns(indicator, year)):
+                columns[column] = pd.arrays.IntegerArray(self.counts[(indicator, field)][:n],
+                                                         self.missing[(indicator, field)][:n])
+        columns.update({
+            COLUMN_NAMES["ik"]: text("ik"),
+            COLUMN_NAMES["location_number"]: text("location_number"),
+            "Latitude": self.coordinates["latitude"][:n],
+            "Longitude": self.coordinates["longitude"][:n],
+        })
+        for indicator in self.indicators:
+            columns[privacy_column(indicator)] = self.privacy_protected[indicator][:n]
+        return pd.DataFrame(columns)
+
+
+def export_frame(df: pd.DataFrame, year: int) -> pd.DataFrame:
+    """
+    Convert the compact table to the layout of the output files:
+    privacy-protected counts and rates become NOT_ENOUGH_BIRTHS_MARKER and the privacy flags are dropped.
+    """
+    indicators = [indicator for indicator in INDICATORS if privacy_column(indicator) in df.columns]
+    export = df.drop(columns=[privacy_column(indicator) for indicator in indicators])
+    for indicator in indicators:
+        privacy_protected = df[privacy_column(indicator)].to_numpy()
+        for column in indicator_columns(indicator, year):
+            values = df[column].astype(object).where(df[column].notna(), None).to_numpy(dtype=object, copy=True)
+            values[privacy_protected] = NOT_ENOUGH_BIRTHS_MARKER
+            export[column] = pd.Series(values, index=df.index, dtype=object)
+    city = export[COLUMN_NAMES["city"]].to_numpy(dtype=object)
+    export[COLUMN_NAMES["city"]] = pd.Series(np.where(pd.isna(city), None, city), index=df.index, dtype=object)
+    return export
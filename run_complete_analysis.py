@@ -7,8 +7,9 @@ import argparse
 from pathlib import Path
 import time
 import logging
-from config import DEFAULT_YEAR, LOG_FORMAT
-from analysis import load_data, create_visualizations, generate_analysis_report, generate_summary_statistics
+from config import DEFAULT_YEAR, LOG_FORMAT, WATCH_INTERVAL
+from analysis import load_data, generate_summary_statistics
+from pipeline import run_pipeline, analysis_stages, RAN, FAILED, BLOCKED
 
 
 def setup_logger(logfile):
@@ -20,31 +21,21 @@ def setup_logger(logfile):
         level=logging.INFO
     )
 
-def main(year: int):
+def main(year: int, resume: bool = False, force: bool = False):
     start_time = time.time()
-    
-    # Import here to avoid circular imports
-    from process_hospital_data import main as process_hospital_data
 
     print(f"Starting complete C-section rate analysis for {year}")
     print("=" * 60)
-    
-    # Step 1: Data Extraction and Processing
-    print("Step 1: Data Extraction and Processing")
-    process_hospital_data(year=year)
-    
-    
-    # Step 2: Statistical Analysis and Visualizations
-    print("\nStep 2: Statistical Analysis and Visualizations")
-    df = load_data(year)
-    viz_path = create_visualizations(df, year)
-    report_path = generate_analysis_report(df, year)
-    
-    print(f"Analysis completed - {len(df)} hospitals analyzed")
-    print(f"   Visualizations: {viz_path}")
-    print(f"   Report: {report_path}")
-    
-    
+
+    # Extraction, panel, plausibility checks, maps, visualizations and report; only stages whose inputs changed are run
+    print("Running analysis stages")
+    results = run_pipeline(year, analysis_stages(resume=resume), force=force)
+    failed = [name for name, result in results.items() if result in (FAILED, BLOCKED)]
+    if failed:
+        print(f"Analysis incomplete - stages not completed: {', '.join(failed)}")
+        return 1
+    print(f"Stages run: {', '.join(name for name, result in results.items() if result == RAN) or 'none'}")
+
     # Summary
     elapsed_time = time.time() - start_time
     print("\n" + "=" * 60)
@@ -71,9 +62,21 @@ if __name__ == "__main__":
     parser.add_argument("--year", type=int, default=DEFAULT_YEAR, help="Year to analyze")
     parser.add_argument("--include-analysis", action="store_true", default=True, 
                        help="Include statistical analysis and visualizations")
+    parser.add_argument("--resume", action="store_true",
+                        help="Continue an interrupted data extraction from its checkpoint journal")
+    parser.add_argument("--force", action="store_true",
+                        help="Run all stages, even those whose inputs did not change since the last run")
+    parser.add_argument("--watch", action="store_true",
+                        help="Keep running and refresh the outputs when report files are added, changed or removed")
+    parser.add_argument("--interval", type=float, default=WATCH_INTERVAL,
+                        help="Seconds between two scans of the data directory in watch mode")
     args = parser.parse_args()
     
     year = args.year
     os.makedirs(f'output/{year}', exist_ok=True)
     setup_logger(f'output/{year}/complete_analysis.log')
-    main(year)
+    if args.watch:
+        from watch import watch
+        watch(year, interval=args.interval)
+    else:
+        main(year, resume=args.resume, force=args.force)
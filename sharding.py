@@ -0,0 +1,74 @@
+"""
+sharding.py
+Deterministic split of the hospital sites of a year across several machines, and the merge of their partial results.
+"""
+import os
+import re
+import json
+import zlib
+import argparse
+from typing import List, Tuple
+from config import OUTPUT_DIR, SHARD_DIR
+from file_utils import atomic_open
+from records import HospitalRecord
+
+PARTIAL_FILE_PATTERN = re.compile(r"shard-(\d+)-of-(\d+)\.jsonl")
+
+
+def parse_shard(spec: str) -> Tuple[int, int]:
+    """Parse a shard specification "i/n" (1 <= i <= n), for use as argparse type."""
+    try:
+        index, count = (int(part) for part in spec.split("/"))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"Shard must be given as i/n, got {spec}")
+    if not 1 <= index <= count:
+        raise argparse.ArgumentTypeError(f"Shard index must be between 1 and {count}, got {index}")
+    return index, count
+
+
+def shard_of(ik: str, site_identifier: str, count: int) -> int:
+    """The shard (1 to count) a hospital site belongs to; stable across machines and Python versions."""
+    return zlib.crc32(f"{ik}-{site_identifier}".encode()) % count + 1
+
+
+def partial_path(year: int, index: int, count: int) -> str:
+    return os.path.join(OUTPUT_DIR, str(year), SHARD_DIR, f"shard-{index}-of-{count}.jsonl")
+
+
+def write_partial(year: int, index: int, count: int, records: List[Tuple[int, HospitalRecord]]) -> str:
+    """
+    Write the records of a shard together with their position in the site list of the year.
+    The file only appears once it is complete, so the merge never reads a partial of a crashed shard.
+    """
+    path = partial_path(year, index, count)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with atomic_open(path, "w", encoding="utf-8") as f:
+        for position, record in records:
+            f.write(json.dumps({"position": position, "record": record.to_dict()}, ensure_ascii=False) + "\n")
+    return path
+
+
+def read_partials(year: int) -> List[HospitalRecord]:
+    """
+    Read the partial results of all shards of a year, in the order of a single-node run.
+    Raises FileNotFoundError if a shard is missing and ValueError if partials of different splits are mixed.
+    """
+    shard_dir = os.path.join(OUTPUT_DIR, str(year), SHARD_DIR)
+    found = [PARTIAL_FILE_PATTERN.fullmatch(file) for file in os.listdir(shard_dir)]
+    shards = {(int(match.group(1)), int(match.group(2))) for match in found if match}
+    counts = {count for _, count in shards}
+    if len(counts) != 1:
+        raise ValueError(f"Expected the partial results of exactly one split in {shard_dir}, found {sorted(shards)}")
+    count = counts.pop()
+    missing = [index for index in range(1, count + 1) if (index, count) not in shards]
+    if missing:
+        raise FileNotFoundError(f"Partial results of shard(s) {missing} of {count} not found in {shard_dir}")
+
+    positioned = []
+    for index in range(1, count + 1):
+        with open(partial_path(year, index, count), encoding="utf-8") as f:
+            for line in f:
+                entry = json.loads(line)
+                positioned.append((entry["position"], HospitalRecord.from_dict(entry["record"])))
+    positioned.sort(key=lambda entry: entry[0])
+    return [record for _, record in positioned]
@@ -0,0 +1,237 @@
+"""
+streaming.py
+Streaming mode of the data extraction. The report files of a year flow through a chain of generators
+(scan, filter, extract and clean, geocode) into incremental writers, so that only one chunk of hospitals
+is held in memory at a time, however many report files there are.
+Hospitals are written in directory order instead of sorted by filename, as sorting needs the whole listing.
+The plausibility checks before the map files collect the chunks as they are written in a temporary SQLite
+database, which finds duplicates and links the sites to the panel on disk.
+"""
+import os
+import shutil
+import logging
+import argparse
+import tempfile
+from contextlib import ExitStack, closing
+from typing import Callable, Iterable, Iterator, List, NamedTuple, Optional, Tuple
+import pandas as pd
+from config import (
+    DEFAULT_YEAR, DATA_DIR, OUTPUT_DIR, DAS_FILE_SUFFIX, PROGRESS_INTERVAL, STREAM_CHUNK_SIZE, OUTPUT_WRITE_BUFFER,
+    LOG_FORMAT
+)
+from file_utils import atomic_open
+from records import HospitalRecord, HospitalTableBuilder, export_frame, PRIVACY_FLAG
+from outputs import OUTPUT_FORMATS
+from rate_statistics import get_counts
+from create_kml import (
+    CATEGORIES, kml_header, render_placemarks, restore_missing_text, folder_start, FOLDER_END, KML_FOOTER,
+    web_map_points, geojson_prefix, render_geojson_features, GEOJSON_SUFFIX
+)
+from analysis import read_statistics_csv
+from rankings import write_year_rankings, read_rankings_csv, join_rankings
+from process_hospital_data import extract_site, geocode_records
+from prefetch import ReportPrefetcher
+from validation import StreamValidation, ValidationError
+
+Geocoder = Callable[[List[HospitalRecord]], None]  # Sets latitude and longitude of the given records
+
+STREAMED_LISTS = ("hospital_statistics.csv", "full_list.txt", "hospital_statistics.txt")
+KML_FILE = "hospital_csection_rates.kml"
+GEOJSON_FILE = "hospital_csection_rates.geojson"
+
+
+class StreamTotals(NamedTuple):
+    hospitals: int
+    privacy_protected: int
+    births: float  # Sums over the hospitals that report statistics
+    csections: float
+
+    def pooled_rate(self) -> Optional[float]:
+        return self.csections / self.births if self.births else None
+
+
+# =========================
+# Generator stages
+# =========================
+def scan_report_files(year: int) -> Iterator[str]:
+    """Names of the files in the data directory of a year, in directory order."""
+    with os.scandir(os.path.join(DATA_DIR, f"xml_{year}")) as entries:
+        for entry in entries:
+            if entry.is_file():
+                yield entry.name
+
+
+def filter_sites(filenames: Iterable[str]) -> Iterator[Tuple[str, str]]:
+    """(IK, Standortnummer) of every site with a das.xml file."""
+    for filename in filenames:
+        if filename.endswith(DAS_FILE_SUFFIX):
+            IK, Standortnummer = filename.split("-")[:2]
+            yield IK, Standortnummer
+
+
+def extract_records(sites: Iterable[Tuple[str, str]], year: int) -> Iterator[HospitalRecord]:
+    """Extracted and cleaned records of the sites, with their report files read ahead;
+    sites without statistics are dropped."""
+    prefetcher = ReportPrefetcher(year, sites, record_files=False)
+    for idx, ((IK, Standortnummer), files) in enumerate(prefetcher):
+        if idx % PROGRESS_INTERVAL == 0:
+            print(f"Working on Hospital {idx + 1}")
+        record = extract_site(IK, Standortnummer, year, files)
+        if record is not None:
+            yield record
+    logging.info(prefetcher.summary())
+
+
+def chunked(records: Iterable[HospitalRecord], size: int) -> Iterator[List[HospitalRecord]]:
+    chunk = []
+    for record in records:
+        chunk.append(record)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def geocode_chunks(chunks: Iterable[List[HospitalRecord]], geocode: Geocoder = geocode_records) -> Iterator[List[HospitalRecord]]:
+    """Geocode chunk by chunk; distinct addresses within a chunk are looked up once."""
+    for chunk in chunks:
+        geocode(chunk)
+        yield chunk
+
+
+def build_tables(chunks: Iterable[List[HospitalRecord]], year: int) -> Iterator[pd.DataFrame]:
+    """Compact table of every chunk, indexed by the position of its hospitals in the whole year."""
+    start = 0
+    for chunk in chunks:
+        builder = HospitalTableBuilder(capacity=len(chunk), year=year)
+        for record in chunk:
+            builder.append(record)
+        table = builder.to_frame()
+        table.index = pd.RangeIndex(start, start + len(table))
+        start += len(table)
+        yield table
+
+
+# =========================
+# Incremental writers
+# =========================
+def write_lists(tables: Iterable[pd.DataFrame], year: int,
+                validation: Optional[StreamValidation] = None) -> StreamTotals:
+    """
+    Append each chunk table to hospital_statistics.csv and the txt lists, which replace the previous files
+    once complete, and to the plausibility checks if given. Returns the totals needed for the map files.
+    """
+    hospitals = privacy_protected = 0
+    births = csections = 0.0
+    with ExitStack() as stack:
+        files = {}
+        for filename in STREAMED_LISTS:
+            output_format = OUTPUT_FORMATS[filename]
+            files[filename] = stack.enter_context(atomic_open(
+                os.path.join(OUTPUT_DIR, str(year), filename), "w", encoding=output_format.encoding,
+                newline=output_format.newline, buffering=OUTPUT_WRITE_BUFFER))
+
+        def write(table):
+            df = export_frame(table, year)
+            if validation is not None:
+                validation.add(df)
+            for filename, f in files.items():
+                if filename == "hospital_statistics.csv":
+                    f.write(df.to_csv(header=hospitals == 0))
+                else:
+                    f.write(OUTPUT_FORMATS[filename].render(table, df, year))
+
+        for table in tables:
+            write(table)
+            hospitals += len(table)
+            privacy_protected += int(table[PRIVACY_FLAG].sum())
+            table_births, table_csections, valid = get_counts(table, year)
+            births += table_births[valid].sum()
+            csections += table_csections[valid].sum()
+        if hospitals == 0:  # The header of the CSV file
+            write(HospitalTableBuilder(capacity=0, year=year).to_frame())
+    return StreamTotals(hospitals, privacy_protected, births, csections)
+
+
+def write_maps(year: int, pooled_rate: Optional[float], chunk_size: int = STREAM_CHUNK_SIZE) -> None:
+    """
+    Render the KML and GeoJSON files from hospital_statistics.csv chunk by chunk, each chunk joined with its rows
+    of hospital_rankings.csv, which lists the hospitals in the same order. The folders of the KML document are
+    ordered by rate category, so placemarks are spooled to one temporary file per category first.
+    """
+    year_dir = os.path.join(OUTPUT_DIR, str(year))
+    with ExitStack() as stack:
+        spools = [stack.enter_context(tempfile.TemporaryFile("w+", encoding="utf-8")) for _ in CATEGORIES]
+        geojson = stack.enter_context(atomic_open(os.path.join(year_dir, GEOJSON_FILE), "w", encoding="utf-8",
+                                                  buffering=OUTPUT_WRITE_BUFFER))
+        geojson.write(geojson_prefix())
+        separator = ""
+        for df, rankings in zip(read_statistics_csv(year, chunksize=chunk_size),
+                                read_rankings_csv(year, chunksize=chunk_size)):
+            df = join_rankings(restore_missing_text(df), year, rankings)
+            for spool, placemarks in zip(spools, render_placemarks(df, year, pooled_rate)):
+                spool.write(placemarks)
+            features = render_geojson_features(web_map_points(df, year))
+            if features:
+                geojson.write(separator + features)
+                separator = ","
+        geojson.write(GEOJSON_SUFFIX)
+        with atomic_open(os.path.join(year_dir, KML_FILE), "w", encoding="utf-8", buffering=OUTPUT_WRITE_BUFFER) as f:
+            f.write(kml_header(year))
+            for (category_name, _, _), spool in zip(CATEGORIES, spools):
+                f.write(folder_start(category_name))
+                spool.seek(0)
+                shutil.copyfileobj(spool, f)
+                f.write(FOLDER_END)
+            f.write(KML_FOOTER)
+
+
+def main(year: int, geocode: Geocoder = geocode_records, chunk_size: int = STREAM_CHUNK_SIZE) -> bool:
+    """
+    Process all hospital sites of a year in streaming mode and write the output files of process_hospital_data.py,
+    with the same rows and rankings but the hospitals in directory order instead of sorted by filename;
+    the map files only if the results pass the plausibility checks.
+    Returns False if the data or the outputs could not be read or written, or the map files were held back.
+    """
+    data_dir = os.path.join(DATA_DIR, f"xml_{year}")
+    if not os.path.isdir(data_dir):
+        logging.error(f"Data directory for year {year} not found: {data_dir}")
+        return False
+    os.makedirs(os.path.join(OUTPUT_DIR, str(year)), exist_ok=True)
+
+    records = extract_records(filter_sites(scan_report_files(year)), year)
+    tables = build_tables(geocode_chunks(chunked(records, chunk_size), geocode), year)
+    try:
+        with closing(StreamValidation(year, chunk_size=chunk_size)) as validation:
+            totals = write_lists(tables, year, validation)
+            validation.finish()
+        write_year_rankings(year, chunk_size)
+        write_maps(year, totals.pooled_rate(), chunk_size)
+    except OSError as e:
+        logging.error(f"Error writing the outputs of {year}: {e}")
+        return False
+    except ValidationError as e:
+        logging.error(f"Map files of {year} not written: {e}")
+        print(f"Map files of {year} not written: {e}")
+        return False
+
+    logging.info(f"Processing completed: {totals.hospitals} hospitals total, {totals.privacy_protected} hospitals of "
+                 f"those with not enough births to report statistics")
+    print(f"Processing completed successfully!")
+    print(f"   {totals.hospitals} hospitals processed")
+    print(f"   {totals.privacy_protected} hospitals with not enough births to report statistics")
+    print(f"   Output saved to: {OUTPUT_DIR}/{year}")
+    return True
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Process C-section rates of a year with bounded memory.")
+    parser.add_argument("--year", type=int, default=DEFAULT_YEAR, help="Year to process")
+    parser.add_argument("--chunk-size", type=int, default=STREAM_CHUNK_SIZE,
+                        help="Number of hospitals held in memory at once")
+    args = parser.parse_args()
+    os.makedirs(f'output/{args.year}', exist_ok=True)
+    logging.basicConfig(filename=f'output/{args.year}/streaming.log', filemode='w', format=LOG_FORMAT,
+                        level=logging.INFO)
+    main(args.year, chunk_size=args.chunk_size)
@@ -0,0 +1,33 @@
+"""
+Tests for the checkpoint journal of completed hospitals.
+"""
+import pytest
+
+from checkpoint import CheckpointJournal
+
+
+class TestCheckpointJournal:
+    """Resuming keeps every complete entry and drops the one a crash cut off."""
+
+    @pytest.mark.parametrize("cut", [
+        b'{"ik": "3", "location_number": "77", "re',
+        b'{"ik": "3", "location_number": "77", "record": null}',  # Complete JSON without its newline
+    ])
+    def test_incomplete_last_line(self, tmp_path, cut):
+        path = str(tmp_path / "journal.jsonl")
+        journal = CheckpointJournal(path)
+        journal.write("1", "77", None)
+        journal.write("2", "77", None)
+        journal.close()
+        with open(path, "ab") as f:
+            f.write(cut)
+
+        journal = CheckpointJournal(path, resume=True)
+        assert set(journal.completed) == {("1", "77"), ("2", "77")}
+        journal.write("3", "77", None)
+        journal.close()
+        assert set(CheckpointJournal(path, resume=True).completed) == {("1", "77"), ("2", "77"), ("3", "77")}
+
+
+if __name__ == "__main__":
+    pytest.main([__file__, "-v"])
@@ -0,0 +1,69 @@
+"""
+Tests for the web map exports of create_kml.py.
+"""
+import json
+import pytest
+import pandas as pd
+
+from config import COLUMN_NAMES, NOT_ENOUGH_BIRTHS_MARKER
+from create_kml import render_geojson, web_map_points, pack_points, unpack_points, CATEGORIES
+
+YEAR = 2023
+
+
+@pytest.fixture
+def hospitals():
+    return pd.DataFrame({
+        COLUMN_NAMES["hospital_name"]: ["Klinikum Nord", "Klinikum Süd", "Geburtshaus", "Ohne Adresse"],
+        COLUMN_NAMES["city"]: ["Kiel", "München", "Kiel", "Berlin"],
+        COLUMN_NAMES["street_address"]: ["Weg 1", "Straße 2", "Weg 3", "Allee 4"],
+        COLUMN_NAMES["postal_code"]: ["24103", "80331", "24103", "10115"],
+        f"{COLUMN_NAMES['total_births']} {YEAR}": [1000, 500, NOT_ENOUGH_BIRTHS_MARKER, 800],
+        f"{COLUMN_NAMES['csections']} {YEAR}": [150, 250, NOT_ENOUGH_BIRTHS_MARKER, 240],
+        f"{COLUMN_NAMES['csection_rate']} {YEAR}": [15, 50, NOT_ENOUGH_BIRTHS_MARKER, 30],
+        "Latitude": [54.32, 48.14, 54.33, None],
+        "Longitude": [10.12, 11.58, 10.13, None],
+    })
+
+
+class TestGeoJSON:
+    """Only hospitals with statistics and coordinates become features, with their rate category."""
+
+    def test_features(self, hospitals):
+        collection = json.loads(render_geojson(hospitals, YEAR))
+        assert collection["type"] == "FeatureCollection"
+        assert len(collection["categories"]) == len(CATEGORIES)
+        properties = [feature["properties"] for feature in collection["features"]]
+        assert [p["name"] for p in properties] == ["Klinikum Nord", "Klinikum Süd"]
+        assert [p["category"] for p in properties] == [0, 3]
+        assert collection["features"][0]["geometry"]["coordinates"] == [10.12, 54.32]
+
+    def test_empty_table(self, hospitals):
+        collection = json.loads(render_geojson(hospitals.iloc[:0], YEAR))
+        assert collection["features"] == []
+
+
+class TestBinaryPoints:
+    """The binary point format reads back to the packed points."""
+
+    def test_round_trip(self, hospitals):
+        previous_year = hospitals.rename(columns=lambda column: column.replace(str(YEAR), str(YEAR - 1)))
+        points = pd.concat([web_map_points(hospitals, YEAR), web_map_points(previous_year, YEAR - 1)],
+                           ignore_index=True)
+        metadata, strings, records = unpack_points(pack_points(points))
+        assert metadata["years"] == [YEAR - 1, YEAR]
+        assert len(records) == 4
+        assert len(strings) == 4  # Names and addresses are shared by both years
+        assert [strings[index] for index in records["name"]] == list(points["name"])
+        assert [strings[index] for index in records["address"]][1] == "Straße 2, 80331 München"
+        assert list(records["rate"]) == [15, 50, 15, 50]
+        assert list(records["category"]) == [0, 3, 0, 3]
+        assert records["latitude"][0] == pytest.approx(54.32, abs=1e-5)
+
+    def test_rejects_other_files(self):
+        with pytest.raises(ValueError):
+            unpack_points(b"<?xml version" + bytes(20))
+
+
+if __name__ == "__main__":
+    pytest.main([__file__, "-v"])
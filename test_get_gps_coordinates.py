@@ -0,0 +1,85 @@
+"""
+Tests for the canonical address keys and the persistence of the geocoding cache.
+"""
+import json
+import pytest
+from geopy.exc import GeocoderTimedOut
+
+import get_gps_coordinates
+from config import GEOCODE_RETRY_INTERVAL
+from get_gps_coordinates import normalize_address, geocode_addresses, CoordinatesCache
+
+
+class TestAddressNormalization:
+    """Spelling variants of the same address must share one cache key."""
+
+    def test_street_spellings(self):
+        variants = [
+            {"city": "Flensburg", "street": "Knuthstr. 1", "postalcode": "24939"},
+            {"city": "flensburg", "street": "Knuthstraße  1", "postalcode": "24939"},
+            {"city": " Flensburg ", "street": "KNUTHSTRASSE 1", "postalcode": "24939 "},
+        ]
+        assert len({normalize_address(address) for address in variants}) == 1
+
+    def test_different_addresses(self):
+        first = {"city": "Flensburg", "street": "Knuthstr. 1", "postalcode": "24939"}
+        second = {"city": "Flensburg", "street": "Knuthstr. 11", "postalcode": "24939"}
+        assert normalize_address(first) != normalize_address(second)
+
+    def test_words_starting_with_str(self):
+        address = {"city": "Kiel", "street": "Strandweg 3", "postalcode": "24106"}
+        assert normalize_address(address) == "24106|kiel|strandweg 3"
+
+
+class TestCoordinatesCache:
+    """Lookups are written once per batch; failures are retried."""
+
+    ADDRESSES = [{"city": "Kiel", "street": "Weg 1", "postalcode": "24103"},
+                 {"city": "Kiel", "street": "Weg 2", "postalcode": "24103"},
+                 {"city": "Kiel", "street": "Weg 3", "postalcode": "24103"}]
+
+    def test_batch(self, tmp_path, monkeypatch):
+        cache_file = str(tmp_path / "cache.sqlite")
+        answers = {"Weg 1": (54.3, 10.1), "Weg 2": None}
+
+        def query(clinic_data):
+            if clinic_data["street"] not in answers:
+                raise GeocoderTimedOut("timeout")
+            return answers[clinic_data["street"]]
+
+        monkeypatch.setattr(get_gps_coordinates, "query_nominatim", query)
+        coordinates = geocode_addresses(self.ADDRESSES, cache_file)
+        assert list(coordinates.values()) == [(54.3, 10.1), None, None]
+
+        cache = CoordinatesCache(cache_file)
+        keys = [normalize_address(address) for address in self.ADDRESSES]
+        assert cache.get(keys[0]) == (54.3, 10.1)
+        assert keys[1] in cache  # Not found: not queried again for a while
+        assert keys[2] not in cache  # Timed out: queried again in the next run
+
+    def test_failures_expire(self, tmp_path, monkeypatch):
+        (tmp_path / "cache.json").write_text(json.dumps({"a": {"failed_at": 1000.0}, "b": None}))
+        monkeypatch.setattr(get_gps_coordinates.time, "time", lambda: 1000.0 + GEOCODE_RETRY_INTERVAL - 1)
+        cache = CoordinatesCache(str(tmp_path / "cache.sqlite"))  # Imports the JSON cache of earlier versions
+        assert "a" in cache
+        assert "b" not in cache  # Cached as null by earlier versions
+        monkeypatch.setattr(get_gps_coordinates.time, "time", lambda: 1000.0 + GEOCODE_RETRY_INTERVAL)
+        assert "a" not in cache
+
+    def test_import_json(self, tmp_path):
+        (tmp_path / "cache.json").write_text(json.dumps({
+            "24103|kiel|weg 1": [54.3, 10.1],
+            json.dumps({"city": "Kiel", "street": "Weg 2", "postalcode": "24103"}): [54.4, 10.2],  # Raw key
+        }))
+        cache = CoordinatesCache(str(tmp_path / "cache.sqlite"))
+        assert cache.get("24103|kiel|weg 1") == (54.3, 10.1)
+        assert cache.get("24103|kiel|weg 2") == (54.4, 10.2)
+        cache.set("24103|kiel|weg 3", (54.5, 10.3))
+        cache.save()
+        cache.close()
+        (tmp_path / "cache.json").write_text("{}")  # Only imported into a new cache
+        assert CoordinatesCache(str(tmp_path / "cache.sqlite")).get("24103|kiel|weg 3") == (54.5, 10.3)
+
+
+if __name__ == "__main__":
+    pytest.main([__file__, "-v"])
@@ -0,0 +1,89 @@
+"""
+Tests for the cross-year panel: site linkage and the year-over-year join.
+"""
+import pytest
+import pandas as pd
+
+from config import COLUMN_NAMES, NOT_ENOUGH_BIRTHS_MARKER
+from panel import link_year, year_over_year, PANEL_COLUMNS, YEAR_COLUMNS, SITE_ID, YEAR
+
+
+def panel_rows(*rows):
+    """Panel with the given (year, IK, births, C-sections, rate, latitude, longitude) rows."""
+    panel = pd.DataFrame([{
+        SITE_ID: f"{ik}-1", YEAR: year, COLUMN_NAMES["ik"]: ik, COLUMN_NAMES["location_number"]: "1",
+        COLUMN_NAMES["hospital_name"]: f"Klinik {ik}", COLUMN_NAMES["city"]: "Kiel",
+        COLUMN_NAMES["street_address"]: f"Weg {ik}", COLUMN_NAMES["postal_code"]: "24103",
+        COLUMN_NAMES["total_births"]: births, COLUMN_NAMES["csections"]: csections,
+        COLUMN_NAMES["csection_rate"]: rate, "Latitude": latitude, "Longitude": longitude,
+    } for year, ik, births, csections, rate, latitude, longitude in rows])
+    return panel[PANEL_COLUMNS]
+
+
+def statistics_table(panel: pd.DataFrame, year: int) -> pd.DataFrame:
+    """The panel rows of a year as the hospital_statistics table of that year."""
+    rows = panel[panel[YEAR] == year].drop(columns=[SITE_ID, YEAR])
+    return rows.rename(columns={column: f"{column} {year}" for column in YEAR_COLUMNS}).reset_index(drop=True)
+
+
+class TestPanelLinkage:
+    """Sites are linked across years without ever sharing a site_id within a year."""
+
+    def test_identifier_match_wins_over_earlier_fallback(self):
+        panel = panel_rows((2022, "1", "1000", "300", "30", 54.3, 10.1))
+        rows = statistics_table(panel_rows((2023, "2", "1000", "300", "30", 54.3, 10.1),
+                                           (2023, "1", "1000", "300", "30", 54.3, 10.1)), 2023)
+        rows[COLUMN_NAMES["hospital_name"]] = ["Klinik 1", "Klinik Neu"]  # IK 2 takes over the name of site 1-1
+        assert list(link_year(panel, rows, 2023)[SITE_ID]) == ["2-1", "1-1"]
+
+    def test_fallback_by_name(self):
+        panel = panel_rows((2022, "1", "1000", "300", "30", 54.3, 10.1))
+        rows = statistics_table(panel_rows((2023, "9", "1000", "300", "30", 54.3, 10.1)), 2023)
+        rows[COLUMN_NAMES["hospital_name"]] = "Klinik 1"  # New IK, same hospital
+        assert list(link_year(panel, rows, 2023)[SITE_ID]) == ["1-1"]
+
+    def test_fallback_takes_only_free_ids(self):
+        panel = panel_rows((2022, "1", "1000", "300", "30", 54.3, 10.1))
+        rows = statistics_table(panel_rows((2023, "2", "1000", "300", "30", 54.3, 10.1),
+                                           (2023, "3", "1000", "300", "30", 54.3, 10.1)), 2023)
+        rows[COLUMN_NAMES["hospital_name"]] = "Klinik 1"  # Both claim the name of site 1-1
+        assert list(link_year(panel, rows, 2023)[SITE_ID]) == ["1-1", "3-1"]
+
+    def test_new_id_does_not_take_over_known_id(self):
+        panel = panel_rows((2022, "1", "1000", "300", "30", 54.3, 10.1))
+        panel[COLUMN_NAMES["hospital_name"]] = "Alte Klinik"
+        panel[COLUMN_NAMES["street_address"]] = "Alter Weg"
+        panel[SITE_ID] = "2-1"  # Linked by name in an earlier year
+        rows = statistics_table(panel_rows((2023, "2", "1000", "300", "30", 54.3, 10.1)), 2023)
+        assert list(link_year(panel, rows, 2023)[SITE_ID]) == ["2-1-2"]
+
+
+class TestYearOverYear:
+    """Rate deltas and rank changes of the sites present in both years."""
+
+    def test_deltas_and_ranks(self):
+        panel = panel_rows(
+            (2022, "1", "1000", "300", "30", 54.3, 10.1),
+            (2022, "2", "1000", "200", "20", 54.3, 10.1),
+            (2022, "4", NOT_ENOUGH_BIRTHS_MARKER, NOT_ENOUGH_BIRTHS_MARKER, NOT_ENOUGH_BIRTHS_MARKER, 54.3, 10.1),
+            (2023, "1", "1000", "250", "25", 54.3, 10.1),
+            (2023, "2", "1000", "400", "40", 54.3, 10.1),
+            (2023, "3", "1000", "350", "35", 54.3, 10.1),  # Only in 2023
+            (2023, "4", NOT_ENOUGH_BIRTHS_MARKER, NOT_ENOUGH_BIRTHS_MARKER, NOT_ENOUGH_BIRTHS_MARKER, 54.3, 10.1),
+        )
+        changes = year_over_year(panel, 2022, 2023)
+        rate = COLUMN_NAMES["csection_rate"]
+        assert list(changes.index) == ["1-1", "2-1", "4-1"]
+        assert list(changes[f"Differenz {rate}"][:2]) == [-5, 20]
+        assert list(changes["Rang 2022"][:2]) == [1, 2]
+        assert list(changes["Rang 2023"][:2]) == [3, 1]
+        assert list(changes["Differenz Rang"][:2]) == [-2, 1]
+        assert changes.loc["4-1", ["Rang 2022", "Rang 2023"]].isna().all()  # Privacy-protected sites have no rank
+
+    def test_no_common_sites(self):
+        panel = panel_rows((2022, "1", "1000", "300", "30", 54.3, 10.1), (2023, "2", "1000", "300", "30", 54.3, 10.1))
+        assert year_over_year(panel, 2022, 2023).empty
+
+
+if __name__ == "__main__":
+    pytest.main([__file__, "-v"])
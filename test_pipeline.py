@@ -0,0 +1,105 @@
+"""
+Tests for the memoized stage graph of the complete analysis.
+"""
+import os
+import pytest
+
+import config
+from pipeline import Stage, run_pipeline, RAN, UP_TO_DATE, FAILED, BLOCKED
+
+calls = []
+
+
+def copy_source(year):
+    calls.append("copy")
+    with open(f"output/{year}/copy.txt", "w") as f:
+        f.write(open(f"source-{year}.txt").read())
+
+
+def count_characters(year):
+    calls.append("count")
+    with open(f"output/{year}/count.txt", "w") as f:
+        f.write(str(len(open(f"output/{year}/copy.txt").read())))
+
+
+def write_nothing(year):
+    calls.append("nothing")
+
+
+def append_to_cache(year):
+    calls.append("cache")
+    with open("cache.txt", "a") as f:
+        f.write(str(year))
+    copy_source(year)
+
+
+STAGES = [
+    Stage("copy", copy_source, inputs=("source-{year}.txt",), outputs=("output/{year}/copy.txt",)),
+    Stage("count", count_characters, inputs=("output/{year}/copy.txt",), outputs=("output/{year}/count.txt",)),
+]
+
+
+@pytest.fixture
+def workdir(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    calls.clear()
+    (tmp_path / "source-2023.txt").write_text("abc")
+    return tmp_path
+
+
+class TestPipeline:
+    """Stages only run if their inputs changed since the last run."""
+
+    def test_second_run_is_up_to_date(self, workdir):
+        assert run_pipeline(2023, STAGES) == {"copy": RAN, "count": RAN}
+        assert run_pipeline(2023, STAGES) == {"copy": UP_TO_DATE, "count": UP_TO_DATE}
+        assert calls == ["copy", "count"]
+
+    def test_changed_input_reruns_dependent_stages(self, workdir):
+        run_pipeline(2023, STAGES)
+        (workdir / "source-2023.txt").write_text("abcd")
+        assert run_pipeline(2023, STAGES) == {"copy": RAN, "count": RAN}
+        assert (workdir / "output" / "2023" / "count.txt").read_text() == "4"
+
+    def test_unchanged_intermediate_output_stops_rerun(self, workdir):
+        run_pipeline(2023, STAGES)
+        os.utime(workdir / "source-2023.txt", (0, 0))
+        assert run_pipeline(2023, STAGES) == {"copy": UP_TO_DATE, "count": UP_TO_DATE}
+        (workdir / "output" / "2023" / "count.txt").unlink()
+        assert run_pipeline(2023, STAGES) == {"copy": UP_TO_DATE, "count": RAN}
+
+    def test_missing_output_fails_and_blocks_dependents(self, workdir):
+        stages = [
+            Stage("nothing", write_nothing, inputs=("source-{year}.txt",), outputs=("output/{year}/copy.txt",)),
+            STAGES[1],
+        ]
+        assert run_pipeline(2023, stages) == {"nothing": FAILED, "count": BLOCKED}
+        assert run_pipeline(2023, stages)["nothing"] == FAILED
+
+    def test_previous_year_input(self, workdir):
+        stages = [Stage("copy", copy_source, inputs=("source-{year}.txt", "source-{previous_year}.txt"),
+                        outputs=("output/{year}/copy.txt",))]
+        assert run_pipeline(2023, stages) == {"copy": RAN}
+        (workdir / "source-2022.txt").write_text("xyz")
+        assert run_pipeline(2023, stages) == {"copy": RAN}
+        assert run_pipeline(2023, stages) == {"copy": UP_TO_DATE}
+
+    def test_changed_setting_reruns_only_stages_that_declare_it(self, workdir, monkeypatch):
+        stages = [STAGES[0]._replace(settings=("KNN_NEIGHBORS",)), STAGES[1]._replace(settings=("STATES",))]
+        run_pipeline(2023, stages)
+        monkeypatch.setattr(config, "YOY_JUMP_THRESHOLD", config.YOY_JUMP_THRESHOLD + 1)
+        assert run_pipeline(2023, stages) == {"copy": UP_TO_DATE, "count": UP_TO_DATE}
+        monkeypatch.setattr(config, "KNN_NEIGHBORS", config.KNN_NEIGHBORS + 1)
+        assert run_pipeline(2023, stages) == {"copy": RAN, "count": UP_TO_DATE}
+
+    def test_input_the_stage_updates_itself(self, workdir):
+        stages = [Stage("cache", append_to_cache, inputs=("source-{year}.txt", "cache.txt"),
+                        outputs=("output/{year}/copy.txt", "cache.txt")), STAGES[1]]
+        assert run_pipeline(2023, stages) == {"cache": RAN, "count": RAN}
+        assert run_pipeline(2023, stages) == {"cache": UP_TO_DATE, "count": UP_TO_DATE}
+        (workdir / "cache.txt").write_text("")
+        assert run_pipeline(2023, stages) == {"cache": RAN, "count": UP_TO_DATE}
+
+
+if __name__ == "__main__":
+    pytest.main([__file__, "-v"])
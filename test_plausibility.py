@@ -2,10 +2,14 @@
 Plausibility Analysis for the results obtained.
 """
 import pytest
+import pandas as pd
 
 
 from analysis import load_data
-from config import DEFAULT_YEAR
+from config import DEFAULT_YEAR, COLUMN_NAMES, NOT_ENOUGH_BIRTHS_MARKER
+from panel import build_panel, load_panel, processed_years, SITE_ID
+from validation import validate, validate_table, StreamValidation, ValidationError, CHECK, SEVERITY, ERROR
+from test_panel import panel_rows, statistics_table
 
 
 class TestDataQuality:
@@ -34,5 +38,95 @@ class TestDataQuality:
             pytest.skip("Data file not available for testing")
 
 
+class TestValidation:
+    """The plausibility checks over all processed years."""
+
+    def test_processed_years(self):
+        years = processed_years()
+        if not years:
+            pytest.skip("Data file not available for testing")
+        violations = validate(build_panel(years))
+        assert not (violations[SEVERITY] == ERROR).any(), violations[violations[SEVERITY] == ERROR]
+
+    def test_violations(self):
+        panel = panel_rows(
+            (2022, "1", "1000", "300", "30", 54.3, 10.1),
+            (2023, "1", "1000", "500", "50", 54.3, 10.1),  # Jump of 20 percentage points
+            (2023, "2", "100", "150", "150", 54.3, 10.1),  # More C-sections than births
+            (2023, "3", "1000", "300", "40", 54.3, 10.1),  # Rate does not match
+            (2023, "4", "1000", "300", "30", 40.4, -3.7),  # Madrid
+            (2023, "5", "1000", "300", "30", None, None),
+            (2023, "6", NOT_ENOUGH_BIRTHS_MARKER, NOT_ENOUGH_BIRTHS_MARKER, NOT_ENOUGH_BIRTHS_MARKER, 54.3, 10.1),
+            (2023, "6", "1000", "300", "30", 54.3, 10.1),  # Same site twice
+        )
+        violations = validate(panel)
+        found = set(zip(violations[CHECK], violations[COLUMN_NAMES["ik"]]))
+        assert found == {("year_over_year_jump", "1"), ("impossible_count", "2"),
+                         ("rate_mismatch", "3"), ("outside_germany", "4"), ("missing_coordinates", "5"),
+                         ("duplicate_site", "6")}
+
+    def test_consistent_panel(self):
+        panel = panel_rows((2022, "1", "1000", "300", "30", 54.3, 10.1), (2023, "1", "1000", "333", "33", 54.3, 10.1))
+        assert validate(panel).empty
+
+    def test_validate_table(self, tmp_path, monkeypatch):
+        monkeypatch.setattr("validation.OUTPUT_DIR", str(tmp_path))
+        monkeypatch.setattr("validation.load_panel", lambda: panel_rows(
+            (2022, "1", "1000", "300", "30", 54.3, 10.1),
+            (2023, "1", "100", "150", "150", 54.3, 10.1),  # Stale row of the year, replaced by the table
+        ))
+        table = statistics_table(panel_rows((2023, "1", "1000", "333", "33", 54.3, 10.1)), 2023)
+        assert validate_table(table, 2023).empty
+        table[f"{COLUMN_NAMES['csections']} 2023"] = "1500"
+        with pytest.raises(ValidationError):
+            validate_table(table, 2023)
+        assert (tmp_path / "2023" / "validation_violations.csv").exists()
+
+
+class TestStreamValidation:
+    """The chunked checks of the streaming mode find the same violations as validate_table."""
+
+    def test_same_violations(self, tmp_path, monkeypatch):
+        monkeypatch.setattr("validation.OUTPUT_DIR", str(tmp_path))
+        panel_file = str(tmp_path / "panel.csv")
+        panel_rows(
+            (2022, "1", "1000", "300", "30", 54.3, 10.1),
+            (2022, "2", "1000", "200", "20", 54.3, 10.1),
+            (2022, "5", "1000", "100", "10", 54.3, 10.1),
+            (2023, "1", "100", "150", "150", 54.3, 10.1),  # Stale row of the year, replaced by the table
+            (2024, "1", "1000", "900", "90", 54.3, 10.1),  # Later year, not the previous year of 2023
+        ).to_csv(panel_file, index=False)
+        panel = panel_rows(
+            (2023, "2", "1000", "200", "20", 54.3, 10.1),
+            (2023, "1", "1000", "600", "60", 54.3, 10.1),  # Jump from 2022
+            (2023, "9", "1000", "500", "50", 54.3, 10.1),  # Linked to site 5-1 by name, jump from 2022
+            (2023, "7", "1000", "300", "30", 54.3, 10.1),
+            (2023, "7", "100", "150", "150", 54.3, 10.1),  # Duplicate site with impossible counts
+            (2023, "3", "1000", "300", "40", None, 10.1),  # Rate mismatch, missing coordinates
+            (2023, "4", "1000", "300", "30", 40.0, 10.1),  # Outside of Germany
+            (2023, "6", NOT_ENOUGH_BIRTHS_MARKER, NOT_ENOUGH_BIRTHS_MARKER, NOT_ENOUGH_BIRTHS_MARKER, 54.3, 10.1),
+        )
+        panel.loc[0, COLUMN_NAMES["hospital_name"]] = "Klinik 1"
+        panel.loc[2, COLUMN_NAMES["hospital_name"]] = "Klinik 5"
+        panel.loc[[5, 6], [COLUMN_NAMES["hospital_name"], COLUMN_NAMES["street_address"]]] = ["Klinik", "Weg"]
+        table = statistics_table(panel, 2023)
+
+        monkeypatch.setattr("validation.load_panel",
+                            lambda path=panel_file, chunksize=None: load_panel(path, chunksize))
+        with pytest.raises(ValidationError) as batch:
+            validate_table(table, 2023)
+        validation = StreamValidation(2023, panel_file, chunk_size=3)
+        for start in range(0, len(table), 3):
+            validation.add(table[start:start + 3])
+        with pytest.raises(ValidationError) as stream:
+            validation.finish()
+
+        assert set(batch.value.violations[CHECK]) == {
+            "year_over_year_jump", "duplicate_site", "impossible_count", "rate_mismatch", "missing_coordinates",
+            "outside_germany", "duplicate_address"}
+        assert "5-1" in set(batch.value.violations[SITE_ID])
+        pd.testing.assert_frame_equal(stream.value.violations, batch.value.violations, check_dtype=False)
+
+
 if __name__ == "__main__":
     pytest.main([__file__, "-v"])
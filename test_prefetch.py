@@ -0,0 +1,85 @@
+"""
+Tests for the read-ahead of report files.
+"""
+import time
+import pytest
+
+import prefetch
+from prefetch import ReportPrefetcher
+
+YEAR = 2023
+SITES = [(f"26{i:07d}", f"77{i:07d}") for i in range(20)]
+
+
+@pytest.fixture
+def data_dir(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    directory = tmp_path / "data" / f"xml_{YEAR}"
+    directory.mkdir(parents=True)
+    for i, (ik, site) in enumerate(SITES):
+        (directory / f"{ik}-{site}-{YEAR}-das.xml").write_bytes(b"<Root>das %d</Root>" % i)
+        if i != 3:  # One site without xml.xml
+            (directory / f"{ik}-{site}-{YEAR}-xml.xml").write_bytes(b"<Root>xml %d</Root>" % i)
+    return directory
+
+
+class TestReportPrefetcher:
+    """Files are handed out in site order, whatever order the reads finish in."""
+
+    @pytest.mark.parametrize("depth, memory_cap", [(1, 1 << 20), (8, 1 << 20), (8, 1)])
+    def test_order_and_contents(self, data_dir, depth, memory_cap):
+        prefetcher = ReportPrefetcher(YEAR, iter(SITES), depth=depth, memory_cap=memory_cap)
+        results = list(prefetcher)
+        assert [site for site, _ in results] == SITES
+        assert results[5][1].das == b"<Root>das 5</Root>"
+        assert results[5][1].xml == b"<Root>xml 5</Root>"
+        assert results[3][1].xml is None
+
+    def test_wait_times(self, data_dir):
+        prefetcher = ReportPrefetcher(YEAR, SITES)
+        list(prefetcher)
+        assert prefetcher.files == 2 * len(SITES) - 1  # The missing xml.xml file is not read
+        assert len(prefetcher.wait_times) == len(prefetcher.read_times) == 2 * len(SITES) - 1
+        assert 0 <= prefetcher.hidden_fraction() <= 1
+
+    def test_totals_only(self, data_dir):
+        prefetcher = ReportPrefetcher(YEAR, SITES, record_files=False)
+        list(prefetcher)
+        assert prefetcher.files == 2 * len(SITES) - 1
+        assert prefetcher.wait_times == {}
+
+
+class TestReadAhead:
+    """What is read ahead, and what reaches the caller."""
+
+    def test_no_das_file(self, data_dir):
+        (data_dir / f"{SITES[0][0]}-{SITES[0][1]}-{YEAR}-das.xml").unlink()
+        prefetcher = ReportPrefetcher(YEAR, SITES[:2])
+        results = list(prefetcher)
+        assert results[0][1] == (None, None)
+        assert prefetcher.files == 2  # Only the files of the second site
+
+    def test_reads_in_flight_count_against_cap(self, data_dir, monkeypatch):
+        started = []
+
+        def slow_read(path):
+            started.append(path)
+            time.sleep(0.05)
+            return b"", 0.05
+
+        monkeypatch.setattr(prefetch, "read_bytes", slow_read)
+        results = iter(ReportPrefetcher(YEAR, SITES, depth=8, memory_cap=1))
+        next(results)
+        assert len(started) == 2  # Not a single read started for the next sites
+
+    def test_read_error(self, data_dir):
+        (data_dir / f"{SITES[1][0]}-{SITES[1][1]}-{YEAR}-xml.xml").unlink()
+        (data_dir / f"{SITES[1][0]}-{SITES[1][1]}-{YEAR}-xml.xml").mkdir()
+        results = iter(ReportPrefetcher(YEAR, SITES))
+        assert next(results)[1].xml == b"<Root>xml 0</Root>"
+        with pytest.raises(IsADirectoryError):
+            next(results)
+
+
+if __name__ == "__main__":
+    pytest.main([__file__, "-v"])
@@ -0,0 +1,104 @@
+"""
+Tests for the percentile ranks and nearest-ward comparisons.
+"""
+import pytest
+import numpy as np
+import pandas as pd
+
+from config import COLUMN_NAMES, NOT_ENOUGH_BIRTHS_MARKER
+from create_kml import render_kml
+from rankings import (
+    compute_rankings, nearest_neighbors, write_ranking_chunks, join_rankings, STATE, NATIONAL_PERCENTILE, STATE_PERCENTILE, NEIGHBOR_SITES,
+    NEIGHBOR_RATES, NEIGHBOR_DISTANCES, NEIGHBOR_MEAN, NEIGHBOR_LIST_COLUMNS
+)
+
+YEAR = 2023
+
+
+@pytest.fixture
+def hospitals():
+    return pd.DataFrame({
+        COLUMN_NAMES["hospital_name"]: ["Kiel A", "Kiel B", "Kiel C", "München", "Geburtshaus"],
+        COLUMN_NAMES["city"]: ["Kiel", "Kiel", "Kiel", "München", "Kiel"],
+        COLUMN_NAMES["street_address"]: ["Weg 1", "Weg 2", "Weg 3", "Straße 4", "Weg 5"],
+        COLUMN_NAMES["postal_code"]: ["24103", "24103", "24105", "80331", "24103"],
+        f"{COLUMN_NAMES['total_births']} {YEAR}": [1000, 500, 400, 800, NOT_ENOUGH_BIRTHS_MARKER],
+        f"{COLUMN_NAMES['csections']} {YEAR}": [200, 150, 160, 320, NOT_ENOUGH_BIRTHS_MARKER],
+        f"{COLUMN_NAMES['csection_rate']} {YEAR}": [20, 30, 40, 40, NOT_ENOUGH_BIRTHS_MARKER],
+        COLUMN_NAMES["ik"]: ["260100001", "260100002", "260100003", "260900004", "260100005"],
+        COLUMN_NAMES["location_number"]: ["770000001", "770000002", "770000003", "770000004", "770000005"],
+        "Latitude": [54.30, 54.31, 54.40, 48.14, 54.30],
+        "Longitude": [10.10, 10.10, 10.10, 11.58, 10.11],
+    })
+
+
+class TestNearestNeighbors:
+    """Neighbors are the nearest other points, nearest first, in every block of the distance matrix."""
+
+    def test_matches_full_sort(self, monkeypatch):
+        monkeypatch.setattr("rankings.DISTANCE_BLOCK", 350)  # Blocks of 7 rows
+        rng = np.random.default_rng(0)
+        latitudes, longitudes = rng.uniform(47.5, 55, 50), rng.uniform(6, 15, 50)
+        indices, distances = nearest_neighbors(latitudes, longitudes, 3)
+        assert indices.shape == distances.shape == (50, 3)
+        assert not (indices == np.arange(50)[:, None]).any()
+        assert (np.diff(distances, axis=1) >= 0).all()
+        _, all_distances = nearest_neighbors(latitudes, longitudes, 49)
+        assert np.allclose(distances, all_distances[:, :3])
+
+    def test_split_columns(self, monkeypatch):
+        monkeypatch.setattr("rankings.DISTANCE_BLOCK", 64)  # Blocks of 8 by 8 entries
+        rng = np.random.default_rng(1)
+        latitudes, longitudes = rng.uniform(47.5, 55, 50), rng.uniform(6, 15, 50)
+        _, distances = nearest_neighbors(latitudes, longitudes, 3)
+        _, all_distances = nearest_neighbors(latitudes, longitudes, 49)
+        assert np.allclose(distances, all_distances[:, :3])
+
+    def test_single_point(self):
+        indices, distances = nearest_neighbors(np.array([54.3]), np.array([10.1]), 3)
+        assert indices.shape == (1, 0)
+
+
+class TestRankings:
+    """Percentiles rank the hospitals with statistics, nationally and within their state."""
+
+    def test_percentiles(self, hospitals):
+        rankings = compute_rankings(hospitals, YEAR)
+        assert list(rankings[STATE]) == ["Schleswig-Holstein"] * 3 + ["Bayern", "Schleswig-Holstein"]
+        assert list(rankings[NATIONAL_PERCENTILE][:4]) == [25, 50, 100, 100]
+        assert list(rankings[STATE_PERCENTILE][:4]) == [34, 67, 100, 100]
+        assert pd.isna(rankings[NATIONAL_PERCENTILE][4])
+
+    def test_neighbors(self, hospitals):
+        rankings = compute_rankings(hospitals, YEAR, k=2)
+        assert rankings[NEIGHBOR_SITES][0] == "260100002-770000002;260100003-770000003"
+        assert rankings[NEIGHBOR_RATES][0] == "30;40"
+        assert rankings[NEIGHBOR_DISTANCES][0].split(";")[0] == "1.1"
+        assert rankings[NEIGHBOR_MEAN][0] == 35
+        assert pd.isna(rankings[NEIGHBOR_SITES][4])  # Without statistics, neither ranked nor a neighbor
+
+    def test_order_independent(self, hospitals, monkeypatch):
+        monkeypatch.setattr("rankings.DISTANCE_BLOCK", 4)
+        hospitals["Latitude"], hospitals["Longitude"] = 54.3, 10.1  # All neighbors at the same distance
+        rankings = compute_rankings(hospitals, YEAR, k=2)
+        reversed_rankings = compute_rankings(hospitals.iloc[::-1], YEAR, k=2).loc[hospitals.index]
+        assert rankings[NEIGHBOR_SITES][3] == "260100001-770000001;260100002-770000002"
+        pd.testing.assert_frame_equal(rankings, reversed_rankings)
+
+    def test_chunks(self, hospitals, tmp_path, monkeypatch):
+        monkeypatch.setattr("rankings.OUTPUT_DIR", str(tmp_path))
+        (tmp_path / str(YEAR)).mkdir()
+        write_ranking_chunks(lambda: [hospitals.iloc[:2], hospitals.iloc[2:]], YEAR)
+        missing_lists = {column: "" for column in NEIGHBOR_LIST_COLUMNS}  # None in the file, NaN in memory
+        joined = join_rankings(hospitals, YEAR).fillna(missing_lists)
+        expected = hospitals.join(compute_rankings(hospitals, YEAR)).fillna(missing_lists)
+        pd.testing.assert_frame_equal(joined, expected, check_dtype=False)
+
+    def test_kml_balloons(self, hospitals):
+        kml = render_kml(hospitals.join(compute_rankings(hospitals, YEAR)), YEAR)
+        assert "<b>Perzentil:</b> 25 national, 34 in Schleswig-Holstein" in kml
+        assert kml.count("<b>Nächste Geburtskliniken:</b>") == 4
+
+
+if __name__ == "__main__":
+    pytest.main([__file__, "-v"])
@@ -0,0 +1,42 @@
+"""
+Tests for the batched interval estimates and funnel-plot limits.
+"""
+import numpy as np
+import pytest
+
+from config import FUNNEL_LEVELS
+from rate_statistics import wilson_intervals, bootstrap_intervals, funnel_positions, level_label, FUNNEL_LABELS
+
+
+class TestRateStatistics:
+    """Test the vectorized statistics against known values."""
+
+    def test_wilson_intervals(self):
+        """Wilson interval of 30/100 at 95% is approximately [21.9%, 39.6%]."""
+        low, high = wilson_intervals(np.array([30, 0]), np.array([100, 10]))
+        assert low[0] == pytest.approx(0.2189, abs=1e-4)
+        assert high[0] == pytest.approx(0.3958, abs=1e-4)
+        assert low[1] == pytest.approx(0)
+
+    def test_bootstrap_intervals_contain_rate(self):
+        """Bootstrap intervals are reproducible and contain the observed rate."""
+        events, totals = np.array([30, 300, 5]), np.array([100, 1000, 6])
+        low, high = bootstrap_intervals(events, totals, n_resamples=2000)
+        again_low, again_high = bootstrap_intervals(events, totals, n_resamples=2000)
+        assert (low <= events / totals).all() and (events / totals <= high).all()
+        assert (low == again_low).all() and (high == again_high).all()
+
+    def test_funnel_positions(self):
+        """Large deviations from the national rate fall outside the control limits."""
+        positions = funnel_positions(np.array([300, 380, 200, 35]), np.array([1000, 1000, 1000, 100]), 0.3)
+        assert positions.tolist() == [0, 2, -2, 0]
+
+    def test_funnel_labels_follow_levels(self):
+        assert level_label(0.95) == "95%"
+        assert level_label(0.998) == "99,8%"
+        assert sorted(FUNNEL_LABELS) == list(range(-len(FUNNEL_LEVELS), len(FUNNEL_LEVELS) + 1))
+        assert FUNNEL_LABELS[len(FUNNEL_LEVELS)] == f"über der {level_label(FUNNEL_LEVELS[-1])}-Kontrollgrenze"
+
+
+if __name__ == "__main__":
+    pytest.main([__file__, "-v"])
@@ -0,0 +1,299 @@
+"""
+validation.py
+Plausibility checks of the processed results of all years, as column operations over the cross-year panel.
+Violations are collected in a machine-readable table; errors stop the analysis before maps and plots are made.
+"""
+import os
+import sqlite3
+import argparse
+import logging
+from itertools import islice
+from typing import List, Optional
+import numpy as np
+import pandas as pd
+from config import (
+    OUTPUT_DIR, PANEL_FILE, COLUMN_NAMES, NOT_ENOUGH_BIRTHS_MARKER, VALIDATION_FILE, GERMANY_BOUNDS,
+    YOY_JUMP_THRESHOLD, STREAM_CHUNK_SIZE
+)
+from file_utils import atomic_open
+from panel import (
+    load_panel, build_panel, link_year, year_rows, assign_site_ids, processed_years, StoredLinkageIndex, StoredIds,
+    PANEL_COLUMNS, SITE_ID, YEAR
+)
+
+# Severities: errors fail the run, warnings are only reported
+ERROR = "error"
+WARNING = "warning"
+
+CHECK = "check"
+SEVERITY = "severity"
+VALUE = "value"
+DETAIL = "detail"
+VIOLATION_COLUMNS = [CHECK, SEVERITY, YEAR, SITE_ID, COLUMN_NAMES["ik"], COLUMN_NAMES["location_number"],
+                     COLUMN_NAMES["hospital_name"], VALUE, DETAIL]
+
+
+class ValidationError(Exception):
+    """Raised if the results contain errors. The violations table is attached."""
+
+    def __init__(self, violations: pd.DataFrame):
+        self.violations = violations
+        errors = violations[violations[SEVERITY] == ERROR]
+        counts = ", ".join(f"{count} {check}" for check, count in errors[CHECK].value_counts().items())
+        super().__init__(f"{len(errors)} plausibility errors: {counts}")
+
+
+def violations_of(panel: pd.DataFrame, mask, check: str, severity: str, values, detail: str) -> pd.DataFrame:
+    """Violation rows for the panel rows selected by mask."""
+    mask = np.asarray(mask, dtype=bool)
+    rows = panel.loc[mask, [YEAR, SITE_ID, COLUMN_NAMES["ik"], COLUMN_NAMES["location_number"],
+                            COLUMN_NAMES["hospital_name"]]].copy()
+    rows.insert(0, CHECK, check)
+    rows.insert(1, SEVERITY, severity)
+    rows[VALUE] = pd.Series(values, index=panel.index)[mask].astype(str)
+    rows[DETAIL] = detail
+    return rows[VIOLATION_COLUMNS]
+
+
+def check_rows(panel: pd.DataFrame, duplicate_sites, duplicate_addresses, previous_years,
+               previous_rates) -> List[pd.DataFrame]:
+    """
+    Violations of the panel rows, given which rows share their identifiers or their name and address with
+    another row of their year, and the year and rate of the previous processed year of their site.
+    Every row is checked on its own, so the rows can be checked all at once or in chunks.
+    """
+    births_column, csections_column, rate_column = (
+        COLUMN_NAMES["total_births"], COLUMN_NAMES["csections"], COLUMN_NAMES["csection_rate"])
+    protected = panel[rate_column].astype(str) == NOT_ENOUGH_BIRTHS_MARKER
+    births = pd.to_numeric(panel[births_column], errors="coerce")
+    csections = pd.to_numeric(panel[csections_column], errors="coerce")
+    rates = pd.to_numeric(panel[rate_column], errors="coerce").astype(float)
+    latitudes = pd.to_numeric(panel["Latitude"], errors="coerce")
+    longitudes = pd.to_numeric(panel["Longitude"], errors="coerce")
+    counts = panel[births_column].astype(str) + " / " + panel[csections_column].astype(str)
+    reported = ~protected & births.notna() & csections.notna()
+
+    violations = [
+        violations_of(panel, ~protected & (births.isna() | csections.isna() | rates.isna()), "missing_count", ERROR,
+                      panel[births_column].astype(str) + " / " + panel[csections_column].astype(str) + " / "
+                      + panel[rate_column].astype(str), "Births, C-sections or rate missing or not a number"),
+        violations_of(panel, reported & ((births <= 0) | (csections < 0) | (csections > births)), "impossible_count",
+                      ERROR, counts, "Births must be positive and C-sections between 0 and the births"),
+    ]
+
+    exact_rates = 100 * csections / births.where(births > 0)
+    mismatch = reported & rates.notna() & exact_rates.notna() & ((exact_rates - rates).abs() > 0.5 + 1e-9)
+    violations.append(violations_of(panel, mismatch, "rate_mismatch", ERROR,
+                                    rates.astype(str) + " / " + exact_rates.round(2).astype(str),
+                                    "Rate does not match the counts after rounding"))
+
+    duplicate_sites = np.asarray(duplicate_sites, dtype=bool)
+    violations.append(violations_of(panel, duplicate_sites, "duplicate_site", ERROR,
+                                    panel[COLUMN_NAMES["ik"]] + "-" + panel[COLUMN_NAMES["location_number"]],
+                                    "IK and Standortnummer occur more than once in a year"))
+    same_address = np.asarray(duplicate_addresses, dtype=bool) & ~duplicate_sites
+    violations.append(violations_of(panel, same_address & panel[COLUMN_NAMES["hospital_name"]].notna(),
+                                    "duplicate_address", WARNING, panel[COLUMN_NAMES["street_address"]],
+                                    "Several sites of a year share name and address"))
+
+    missing_coordinates = latitudes.isna() | longitudes.isna() | (latitudes == 0) | (longitudes == 0)
+    violations.append(violations_of(panel, missing_coordinates, "missing_coordinates", WARNING,
+                                    latitudes.astype(str) + "," + longitudes.astype(str),
+                                    "Hospital is not shown on the map"))
+    lat_min, lat_max, lon_min, lon_max = GERMANY_BOUNDS
+    outside = ~missing_coordinates & ~(latitudes.between(lat_min, lat_max) & longitudes.between(lon_min, lon_max))
+    violations.append(violations_of(panel, outside, "outside_germany", ERROR,
+                                    latitudes.astype(str) + "," + longitudes.astype(str),
+                                    "Coordinates outside of Germany"))
+
+    previous_years = pd.Series(pd.to_numeric(previous_years, errors="coerce"), index=panel.index)
+    previous_rates = pd.Series(pd.to_numeric(previous_rates, errors="coerce"), index=panel.index)
+    jumps = rates - previous_rates
+    change = (previous_years.astype("Int64").astype(str) + ": " + previous_rates.astype("Int64").astype(str)
+              + " -> " + rates.astype("Int64").astype(str))
+    violations.append(violations_of(panel, jumps.abs() > YOY_JUMP_THRESHOLD, "year_over_year_jump", WARNING, change,
+                                    f"Rate changed by more than {YOY_JUMP_THRESHOLD} percentage points"))
+    return violations
+
+
+def sort_violations(violations: List[pd.DataFrame]) -> pd.DataFrame:
+    return pd.concat(violations, ignore_index=True).sort_values([YEAR, SITE_ID, CHECK], kind="stable",
+                                                                 ignore_index=True)
+
+
+def validate(panel: pd.DataFrame) -> pd.DataFrame:
+    """
+    Check all rows of the panel at once. Returns one row per violation:
+    impossible counts, rates that do not match the counts, duplicate sites,
+    missing or out-of-Germany coordinates and large year-over-year rate jumps.
+    """
+    panel = panel.reset_index(drop=True)
+    identifiers = [YEAR, COLUMN_NAMES["ik"], COLUMN_NAMES["location_number"]]
+    address = [YEAR, COLUMN_NAMES["hospital_name"], COLUMN_NAMES["street_address"], COLUMN_NAMES["postal_code"]]
+
+    # Compare every site to its previous processed year
+    order = panel.sort_values([SITE_ID, YEAR], kind="stable").index
+    sorted_sites = panel.loc[order, SITE_ID]
+    rates = pd.to_numeric(panel[COLUMN_NAMES["csection_rate"]], errors="coerce")
+    previous_rates = rates.loc[order].groupby(sorted_sites).shift(1).reindex(panel.index)
+    previous_years = panel.loc[order, YEAR].groupby(sorted_sites).shift(1).reindex(panel.index)
+
+    return sort_violations(check_rows(panel, panel.duplicated(identifiers, keep=False),
+                                      panel.duplicated(address, keep=False), previous_years, previous_rates))
+
+
+def write_violations(violations: pd.DataFrame, path: str) -> str:
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    with atomic_open(path, "w", encoding="utf-8", newline="") as f:
+        f.write(violations.to_csv(index=False))
+    return path
+
+
+def report_year(violations: pd.DataFrame, year: int) -> pd.DataFrame:
+    """Write the violations of a year to output/{year}. Raises ValidationError if there are errors."""
+    path = write_violations(violations, os.path.join(OUTPUT_DIR, str(year), VALIDATION_FILE))
+    logging.info(f"Plausibility checks of {year}: {len(violations)} violations written to {path}")
+    if (violations[SEVERITY] == ERROR).any():
+        raise ValidationError(violations)
+    return violations
+
+
+def check_year(panel: pd.DataFrame, year: int) -> pd.DataFrame:
+    """
+    Validate all years of the panel together and write the violations concerning the given year
+    to output/{year}. Raises ValidationError if there are errors in that year.
+    """
+    violations = validate(panel)
+    return report_year(violations[violations[YEAR] == year].reset_index(drop=True), year)
+
+
+def validate_year(year: int) -> pd.DataFrame:
+    """Check a year of the panel file, see check_year."""
+    return check_year(load_panel(), year)
+
+
+def validate_table(df: pd.DataFrame, year: int) -> pd.DataFrame:
+    """
+    Check the hospital_statistics table of a year that is not (or not in this version) in the panel file yet,
+    e.g. before its map files are written, against the other years of the panel. See check_year.
+    """
+    panel = load_panel()
+    panel = panel[panel[YEAR] != year]
+    return check_year(pd.concat([panel, link_year(panel, df, year)], ignore_index=True), year)
+
+
+# Columns of the temporary table of StreamValidation, for the panel columns after site_id and Jahr
+STORED_COLUMNS = ["ik", "location_number", "name", "city", "street", "postal_code", "births", "csections", "rate",
+                  "latitude", "longitude"]
+
+# Rows of the year with their site_id, whether their identifiers or their name and address occur more than once
+# in the year, and the year and rate of the previous processed year of their site
+CHECKED_ROWS = f"""
+    SELECT {", ".join(f"r.{column}" for column in STORED_COLUMNS)}, s.site_id,
+        (SELECT COUNT(*) FROM rows d WHERE d.ik IS r.ik AND d.location_number IS r.location_number) > 1,
+        (SELECT COUNT(*) FROM rows d
+         WHERE d.name IS r.name AND d.street IS r.street AND d.postal_code IS r.postal_code) > 1,
+        p.year, p.rate
+    FROM rows r JOIN site_ids s USING (position)
+    LEFT JOIN previous p ON p.rowid = (SELECT q.rowid FROM previous q WHERE q.site_id = s.site_id
+                                       ORDER BY q.year DESC, q.rowid DESC LIMIT 1)
+    ORDER BY r.position
+"""
+
+
+class StreamValidation:
+    """
+    The checks of validate_table for a hospital_statistics table that is written chunk by chunk, with the same
+    violations. The rows of the year and the linkage keys of the panel go to a temporary SQLite database, which
+    also finds the duplicates and previous years, so memory does not grow with the number of hospitals.
+    """
+
+    def __init__(self, year: int, panel_file: str = PANEL_FILE, chunk_size: int = STREAM_CHUNK_SIZE):
+        self.year = year
+        self.panel_file = panel_file
+        self.chunk_size = chunk_size
+        self.size = 0
+        self.connection = sqlite3.connect("")  # Private database in a temporary file, removed on close
+        self.connection.execute(f"CREATE TABLE rows (position INTEGER PRIMARY KEY, {', '.join(STORED_COLUMNS)})")
+
+    def add(self, df: pd.DataFrame) -> None:
+        """Add a chunk of the year's table, in the layout of hospital_statistics.csv."""
+        rows = year_rows(df, self.year)[PANEL_COLUMNS[2:]].astype(object)
+        values = rows.where(rows.notna(), None).values.tolist()
+        self.connection.executemany(f"INSERT INTO rows VALUES (?{', ?' * len(STORED_COLUMNS)})",
+                                    ((self.size + position, *row) for position, row in enumerate(values)))
+        self.size += len(values)
+
+    def link(self) -> None:
+        """Assign the site ids of the year against the other years of the panel, like link_year."""
+        connection = self.connection
+        index = StoredLinkageIndex(connection, self.year)
+        known_ids = StoredIds(connection, "known_ids")
+        connection.execute("CREATE TABLE previous (site_id TEXT, year INTEGER, rate)")
+        rate_column = COLUMN_NAMES["csection_rate"]
+        for chunk in load_panel(self.panel_file, self.chunk_size):
+            chunk = chunk[chunk[YEAR] != self.year]
+            index.add(chunk)
+            known_ids.update(chunk[SITE_ID])
+            earlier = chunk[chunk[YEAR] < self.year].astype(object)
+            connection.executemany("INSERT INTO previous VALUES (?, ?, ?)", zip(
+                earlier[SITE_ID], earlier[YEAR], earlier[rate_column].where(earlier[rate_column].notna(), None)))
+        connection.execute("CREATE INDEX previous_sites ON previous (site_id, year)")
+
+        connection.execute("CREATE TABLE site_ids (position INTEGER PRIMARY KEY, site_id TEXT)")
+        site_ids = enumerate(assign_site_ids(
+            index, lambda: connection.execute("SELECT ik, location_number, name, street, postal_code FROM rows "
+                                              "ORDER BY position"),
+            known_ids, StoredIds(connection, "used_ids"), self.year))
+        batch = list(islice(site_ids, self.chunk_size))
+        while batch:
+            connection.executemany("INSERT INTO site_ids VALUES (?, ?)", batch)
+            batch = list(islice(site_ids, self.chunk_size))
+
+    def violations(self) -> pd.DataFrame:
+        """Link the sites and check all rows of the year, one chunk at a time."""
+        self.link()
+        self.connection.execute("CREATE INDEX rows_identifiers ON rows (ik, location_number)")
+        self.connection.execute("CREATE INDEX rows_addresses ON rows (name, street, postal_code)")
+        cursor = self.connection.execute(CHECKED_ROWS)
+        columns = [*PANEL_COLUMNS[2:], SITE_ID, "duplicate_site", "duplicate_address", "previous_year",
+                   "previous_rate"]
+        violations = []
+        records = cursor.fetchmany(self.chunk_size)
+        while records:
+            rows = pd.DataFrame(records, columns=columns, dtype=object)
+            rows.insert(0, YEAR, self.year)
+            violations.extend(check_rows(rows, rows["duplicate_site"].astype(bool),
+                                         rows["duplicate_address"].astype(bool), rows["previous_year"],
+                                         rows["previous_rate"]))
+            records = cursor.fetchmany(self.chunk_size)
+        return sort_violations(violations) if violations else pd.DataFrame(columns=VIOLATION_COLUMNS)
+
+    def finish(self) -> pd.DataFrame:
+        """Write the violations of the year and close the database, see check_year."""
+        try:
+            violations = self.violations()
+        finally:
+            self.close()
+        return report_year(violations, self.year)
+
+    def close(self) -> None:
+        self.connection.close()
+
+
+def main(years: Optional[List[int]] = None) -> int:
+    """Validate the given processed years (default: all), writing output/validation_violations.csv."""
+    violations = validate(build_panel(years or processed_years()))
+    path = write_violations(violations, os.path.join(OUTPUT_DIR, VALIDATION_FILE))
+    summary = violations.groupby([SEVERITY, CHECK]).size()
+    print(f"{len(violations)} violations saved to: {path}")
+    for (severity, check), count in summary.items():
+        print(f"   {severity}: {count} {check}")
+    return 1 if (violations[SEVERITY] == ERROR).any() else 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Check the plausibility of the processed results")
+    parser.add_argument("--year", type=int, nargs="*", help="Processed years to check (default: all)")
+    args = parser.parse_args()
+    raise SystemExit(main(args.year))
@@ -0,0 +1,137 @@
+"""
+watch.py
+Watch mode: keeps the results of a year in memory and refreshes the outputs when report files
+in data/xml_{year} are added, changed or removed. Only the changed sites are re-extracted; the later stages
+of the complete analysis run through the pipeline, which skips those whose inputs did not change and keeps
+the manifest up to date.
+"""
+import os
+import time
+import logging
+import xml.etree.ElementTree as ET
+from typing import Dict, Iterable, List, Optional, Sequence, Set, Tuple
+from config import DATA_DIR, DAS_FILE_SUFFIX, XML_FILE_SUFFIX, WATCH_INTERVAL
+from records import HospitalRecord, HospitalTableBuilder
+from process_hospital_data import list_sites, process_site
+from outputs import write_all_outputs
+from pipeline import Stage, run_pipeline, analysis_stages, EXTRACTED_FILES, FAILED, BLOCKED
+
+SiteKey = Tuple[str, str]  # (IK, Standortnummer)
+Snapshot = Dict[str, Tuple[int, int]]  # filename -> (modification time in ns, size)
+
+
+def snapshot(year: int) -> Snapshot:
+    """Modification time and size of every report file of a year."""
+    snapshot = {}
+    with os.scandir(os.path.join(DATA_DIR, f"xml_{year}")) as entries:
+        for entry in entries:
+            if entry.is_file() and entry.name.endswith((DAS_FILE_SUFFIX, XML_FILE_SUFFIX)):
+                stat = entry.stat()
+                snapshot[entry.name] = (stat.st_mtime_ns, stat.st_size)
+    return snapshot
+
+
+def changed_sites(old: Snapshot, new: Snapshot) -> Set[SiteKey]:
+    """Sites with at least one report file that was added, changed or removed."""
+    changed = {name for name in old.keys() | new.keys() if old.get(name) != new.get(name)}
+    return {(name.split("-")[0], name.split("-")[1]) for name in changed}
+
+
+class ResultTable:
+    """Results of a year keyed by site, patched site by site."""
+
+    def __init__(self, year: int):
+        self.year = year
+        self.records: Dict[SiteKey, Optional[HospitalRecord]] = {}
+
+    def refresh(self, sites: Iterable[SiteKey]) -> None:
+        """Re-extract the given sites; sites whose das.xml is gone are removed."""
+        for IK, Standortnummer in sites:
+            das_path = os.path.join(DATA_DIR, f"xml_{self.year}", f"{IK}-{Standortnummer}-{self.year}-{DAS_FILE_SUFFIX}")
+            if os.path.isfile(das_path):
+                self.records[(IK, Standortnummer)] = process_site(IK, Standortnummer, self.year)
+            else:
+                self.records.pop((IK, Standortnummer), None)
+
+    def to_frame(self):
+        """The compact table, in the same site order as a full run (sorted by filename, which starts with the
+        IK and Standortnummer)."""
+        sites = sorted(self.records, key=lambda site: f"{site[0]}-{site[1]}-")
+        builder = HospitalTableBuilder(capacity=len(sites), year=self.year)
+        for site in sites:
+            record = self.records[site]
+            if record is not None:
+                builder.append(record)
+        return builder.to_frame()
+
+
+def watch_stages(results: ResultTable) -> List[Stage]:
+    """The stages of the complete analysis, with the extraction writing the lists of the results in memory."""
+    def write_lists(year: int) -> None:
+        table = results.to_frame()
+        if not write_all_outputs(table, year, EXTRACTED_FILES):
+            raise RuntimeError(f"Lists of {year} could not be written")
+        print(f"   {len(table)} hospitals")
+
+    return [stage._replace(run=write_lists, code=(*stage.code, ResultTable)) if stage.name == "extract" else stage
+            for stage in analysis_stages()]
+
+
+def refresh_outputs(results: ResultTable, stages: Sequence[Stage]) -> bool:
+    """Run the stages whose inputs changed: the lists, the panel entry, the plausibility checks, the rankings,
+    the maps, the plots and the report of the year. Returns False if a stage failed or was blocked,
+    e.g. because the results fail the plausibility checks."""
+    year = results.year
+    stage_results = run_pipeline(year, stages)
+    failed = sorted(name for name, result in stage_results.items() if result in (FAILED, BLOCKED))
+    if failed:
+        logging.error(f"Could not refresh the outputs of {year}, stages not completed: {', '.join(failed)}")
+        return False
+    print(f"Outputs of {year} refreshed")
+    return True
+
+
+def watch(year: int, interval: float = WATCH_INTERVAL) -> None:
+    """
+    Build the results of a year, then poll its data directory every interval seconds.
+    Changes are applied once the directory has been unchanged for one interval, so that
+    files still being copied are not parsed. If applying them fails (e.g. a file removed while it is read,
+    an output that cannot be written or results that fail the plausibility checks), the error is logged and
+    they are applied again on the next poll.
+    """
+    results = ResultTable(year)
+    stages = watch_stages(results)
+    applied = snapshot(year)
+    results.refresh(list_sites(year) or [])
+    if not refresh_outputs(results, stages):
+        print(f"Could not refresh the outputs of {year}")
+    print(f"Watching {os.path.join(DATA_DIR, f'xml_{year}')} for changes (Ctrl+C to stop)")
+
+    previous = applied
+    try:
+        while True:
+            time.sleep(interval)
+            try:
+                current = snapshot(year)
+            except OSError as e:
+                logging.error(f"Could not list the report files of {year}: {e}")
+                continue
+            if current == applied or current != previous:
+                previous = current
+                continue
+            sites = changed_sites(applied, current)
+            start_time = time.time()
+            logging.info(f"Report files changed for {len(sites)} sites, re-extracting them")
+            try:
+                results.refresh(sorted(sites))
+                refreshed = refresh_outputs(results, stages)
+            except (OSError, ET.ParseError) as e:
+                logging.error(f"Could not refresh the outputs of {year}: {e}")
+                refreshed = False
+            if not refreshed:  # Keep the applied snapshot, so that the changes are retried on the next poll
+                print(f"Updating {len(sites)} sites failed, retrying")
+                continue
+            applied = current
+            print(f"Updated {len(sites)} sites in {time.time() - start_time:.1f} seconds")
+    except KeyboardInterrupt:
+        print("Watch mode stopped")